@@ -16,7 +16,8 @@ case $1 in
 		export PYTHONPATH=$PYTHONPATH$; $EXECUTABLE$
 	;;
 	stop)
-		rm /var/log/shotgunEventDaemon.pid
+		# Sharded instances and standbys have pid files of their own.
+		rm -f /var/log/shotgunEventDaemon.pid /var/log/shotgunEventDaemon.pid.shard* /var/log/shotgunEventDaemon.pid.standby*
 	;;
 	*)
 		log_success_msg "Usage: /etc/init.d/shotgunEventDaemon {start|stop}"
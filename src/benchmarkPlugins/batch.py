@@ -0,0 +1,13 @@
+"""Benchmark plugin with a batch callback.
+
+The events are gathered for a short window and handed over together, so its
+latency includes the time events wait for their batch.
+"""
+
+
+def registerCallbacks(reg):
+    reg.registerBatchCallback('benchmark', 'benchmark', noop, None, window=0.1)
+
+
+def noop(sg, events, args):
+    pass
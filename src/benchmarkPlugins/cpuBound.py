@@ -0,0 +1,19 @@
+"""Benchmark plugin whose callback keeps the processor busy.
+
+It stands for plugins that parse paths, build payloads or diff versions by
+repeatedly hashing a payload built from the event.
+"""
+
+import hashlib
+
+ROUNDS = 2000
+
+
+def registerCallbacks(reg):
+    reg.registerCallback('benchmark', 'benchmark', digest, None)
+
+
+def digest(sg, event, args):
+    payload = repr(sorted(event.items()))
+    for i in xrange(ROUNDS):
+        payload = hashlib.sha1(payload).hexdigest()
@@ -0,0 +1,15 @@
+"""Benchmark plugin whose callback waits on Shotgun.
+
+Like most real plugins it fetches the entity of the event, so each run pays
+the simulated query latency of the benchmark server.
+"""
+
+
+def registerCallbacks(reg):
+    reg.registerCallback('benchmark', 'benchmark', fetchEntity, None)
+
+
+def fetchEntity(sg, event, args):
+    entity = event['entity']
+    if entity:
+        sg.find_one(entity['type'], [['id', 'is', entity['id']]], ['code', 'sg_status_list'])
@@ -0,0 +1,13 @@
+"""Benchmark plugin whose callback does nothing.
+
+It measures the overhead of the framework itself: fetching, dispatching and
+checkpointing events.
+"""
+
+
+def registerCallbacks(reg):
+    reg.registerCallback('benchmark', 'benchmark', noop, None)
+
+
+def noop(sg, event, args):
+    pass
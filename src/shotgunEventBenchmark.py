@@ -0,0 +1,384 @@
+#!/usr/bin/python
+"""
+Shotgun event framework benchmark
+---------------------------------
+
+Measures how fast the event daemon drains a stream of events without any
+Shotgun server. The shotgun_api3.Shotgun class is replaced by an in process
+stand-in that serves a synthetic EventLogEntry stream with a chosen size,
+arrival rate, query latency and error rate. The daemon engine runs unchanged
+against it with any of the synthetic plugins shipped in benchmarkPlugins:
+
+    noop: does nothing with the event.
+    ioBound: fetches the event entity, paying the simulated query latency.
+    cpuBound: hashes a payload built from the event for a while.
+    batch: does nothing with batches of events gathered for 0.1s.
+
+Once every event has been processed the benchmark reports the throughput, the
+end to end latency percentiles (from event creation to the end of each
+callback run) and the peak resident memory of the daemon.
+
+Examples:
+
+    Drain a backlog of 20000 events with the noop plugin:
+
+    $ python shotgunEventBenchmark.py --events 20000 --plugins noop
+
+    Compare serial and concurrent dispatch for I/O bound plugins:
+
+    $ python shotgunEventBenchmark.py --plugins ioBound --latency 0.01
+    $ python shotgunEventBenchmark.py --plugins ioBound --latency 0.01 \\
+        --set daemon.dispatchWorkers=8
+
+    The same with the asynchronous engine:
+
+    $ python shotgunEventBenchmark.py --plugins ioBound --latency 0.01 \\
+        --set daemon.asyncEngine=true
+
+    Events arriving at 200 per second with 1% of queries failing:
+
+    $ python shotgunEventBenchmark.py --rate 200 --error-rate 0.01
+"""
+
+import logging
+import optparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+try:
+    import shotgun_api3
+except ImportError:
+    # The benchmark has to run on machines without the Shotgun API so a bare
+    # module with what the daemon uses from it is provided instead.
+    shotgun_api3 = types.ModuleType('shotgun_api3')
+
+    class ProtocolError(Exception):
+        pass
+
+    class ResponseError(Exception):
+        pass
+
+    shotgun_api3.ProtocolError = ProtocolError
+    shotgun_api3.ResponseError = ResponseError
+    shotgun_api3.Shotgun = None
+    sys.modules['shotgun_api3'] = shotgun_api3
+
+import shotgunEventDaemon
+
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkPlugins')
+
+ENTITY_TYPES = ['Shot', 'Asset', 'Task', 'Version', 'PublishedFile']
+ATTRIBUTE_NAMES = ['sg_status_list', 'code', 'description', 'task_assignees', 'sg_cut_in']
+
+
+class FakeServer(object):
+    def __init__(self, events, rate=0.0, latency=0.0, errorRate=0.0, entityCount=1000, seed=0):
+        self.events = events
+        self.rate = rate
+        self.latency = latency
+        self.errorRate = errorRate
+        self.entityCount = entityCount
+        self.queries = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._start = None
+        self._stream = []
+
+    def start(self):
+        # With a rate, events become visible as time goes by, otherwise they
+        # are all there from the start like after a daemon outage.
+        self._start = time.time()
+        self._stream = []
+        for i in xrange(self.events):
+            entityType = self._random.choice(ENTITY_TYPES)
+            self._stream.append({
+                'type': 'EventLogEntry',
+                'id': i + 1,
+                'event_type': 'Shotgun_%s_Change' % entityType,
+                'attribute_name': self._random.choice(ATTRIBUTE_NAMES),
+                'meta': {'type': 'attribute_change', 'old_value': 'ip', 'new_value': 'fin'},
+                'entity': {'type': entityType, 'id': self._random.randint(1, self.entityCount)},
+                'created_at': self._createdAt(i),
+            })
+
+    def _createdAt(self, index):
+        if self.rate:
+            return self._start + index / self.rate
+        return self._start
+
+    def getVisibleCount(self):
+        if not self.rate:
+            return self.events
+        return min(self.events, int((time.time() - self._start) * self.rate))
+
+    def query(self, entityType, filters, fields, order, limit):
+        self._lock.acquire()
+        try:
+            self.queries += 1
+            failed = self.errorRate and self._random.random() < self.errorRate
+            if failed:
+                self.errors += 1
+        finally:
+            self._lock.release()
+
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise shotgun_api3.ProtocolError('Simulated protocol error.')
+
+        if entityType == 'EventLogEntry':
+            records = self._stream[:self.getVisibleCount()]
+        else:
+            records = None
+
+        minId, maxId, ids = 0, None, None
+        for field, operator, value in [f[:3] for f in filters]:
+            if field != 'id':
+                continue
+            if operator == 'greater_than':
+                minId = max(minId, value)
+            elif operator == 'less_than':
+                maxId = value if maxId is None else min(maxId, value)
+            elif operator == 'is':
+                ids = set([value])
+            elif operator == 'in':
+                ids = set(value)
+
+        if records is None:
+            # Any other entity is made up on the spot.
+            records = [self._makeEntity(entityType, eid, fields) for eid in sorted(ids or [])]
+
+        result = [r for r in records if r['id'] > minId and (maxId is None or r['id'] < maxId) and (ids is None or r['id'] in ids)]
+        if order and order[0].get('direction') == 'desc':
+            result.reverse()
+        if limit:
+            result = result[:limit]
+        return [dict(r) for r in result]
+
+    def _makeEntity(self, entityType, eid, fields):
+        record = {'type': entityType, 'id': eid}
+        for field in fields or []:
+            if field not in record:
+                record[field] = '%s %d %s' % (entityType, eid, field)
+        return record
+
+
+class FakeShotgun(object):
+    server = None
+
+    def __init__(self, baseUrl, scriptName=None, apiKey=None, *args, **kwargs):
+        self.base_url = baseUrl
+        self.script_name = scriptName
+
+    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, *args, **kwargs):
+        return self.server.query(entity_type, filters, fields, order, limit)
+
+    def find_one(self, entity_type, filters, fields=None, order=None, *args, **kwargs):
+        result = self.find(entity_type, filters, fields, order, limit=1)
+        if result:
+            return result[0]
+        return None
+
+    def close(self):
+        pass
+
+
+class _BenchmarkMixin(object):
+    # Times the main loop and records the latency of every callback run of
+    # either engine.
+    def __init__(self, config, server, timeout):
+        super(_BenchmarkMixin, self).__init__(config)
+        self._fakeServer = server
+        self._timeout = timeout
+        self._latencies = []
+        self._startTime = None
+        self._endTime = None
+
+    def _mainLoop(self):
+        self._startTime = time.time()
+        super(_BenchmarkMixin, self)._mainLoop()
+        self._endTime = time.time()
+
+    def _runCallback(self, callback, event):
+        duration = super(_BenchmarkMixin, self)._runCallback(callback, event)
+        self._recordLatency(event)
+        return duration
+
+    def _recordLatency(self, event):
+        # Batch callbacks are given a list of events, the batch is as late as
+        # its last event. list.append is atomic so callbacks on worker threads
+        # can record too.
+        event = event[-1] if isinstance(event, list) else event
+        self._latencies.append(time.time() - event['created_at'])
+
+    def _checkContinue(self):
+        if self._processedEventId >= self._fakeServer.events:
+            return False
+        if self._startTime is not None and time.time() - self._startTime > self._timeout:
+            logging.error('Benchmark timed out after %ds.', self._timeout)
+            return False
+        return super(_BenchmarkMixin, self)._checkContinue()
+
+    def getResults(self):
+        elapsed = (self._endTime or time.time()) - self._startTime
+        latencies = sorted(self._latencies)
+        results = {
+            'events': self._processedEventId or 0,
+            'callbackRuns': len(latencies),
+            'elapsed': elapsed,
+            'eventsPerSecond': (self._processedEventId or 0) / max(elapsed, 1e-9),
+            'queries': self._fakeServer.queries,
+            'queryErrors': self._fakeServer.errors,
+            'peakRssSelf': _getPeakRss(resource.RUSAGE_SELF),
+            'peakRssChildren': _getPeakRss(resource.RUSAGE_CHILDREN),
+        }
+        for name, percentile in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+            results['latency_' + name] = _percentile(latencies, percentile)
+        return results
+
+
+class BenchmarkEngine(_BenchmarkMixin, shotgunEventDaemon.Engine):
+    pass
+
+
+class AsyncBenchmarkEngine(_BenchmarkMixin, shotgunEventDaemon.AsyncEngine):
+    def _runCallbackAsync(self, callback, event):
+        duration = yield shotgunEventDaemon.From(shotgunEventDaemon.AsyncEngine._runCallbackAsync(self, callback, event))
+        self._recordLatency(event)
+        raise shotgunEventDaemon.Return(duration)
+
+
+def _percentile(values, percentile):
+    if not values:
+        return 0.0
+    index = min(int(round(percentile * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def _getPeakRss(who):
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def _makeConfig(workDir, pluginDir, settings):
+    config = shotgunEventDaemon.Config(os.path.join(workDir, 'missing.conf'))
+    values = {
+        'daemon': {
+            'pidFile': os.path.join(workDir, 'benchmark.pid'),
+            'eventIdFile': os.path.join(workDir, 'benchmark.id'),
+            'logFile': os.path.join(workDir, 'benchmark.log'),
+            'logging': '30',
+            'pollInterval': '0.1',
+            'pollMaxInterval': '0.1',
+        },
+        'shotgun': {
+            'server': 'https://benchmark.invalid',
+            'name': 'benchmark',
+            'key': 'benchmark',
+        },
+        'plugins': {
+            'paths': pluginDir,
+            'rescanInterval': '3600',
+        },
+    }
+    for section, options in values.items():
+        config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, value)
+
+    for setting in settings:
+        name, value = setting.split('=', 1)
+        section, option = name.split('.', 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+
+    return config
+
+
+def runBenchmark(events, plugins, rate=0.0, latency=0.0, errorRate=0.0, settings=(), timeout=600, seed=0):
+    server = FakeServer(events, rate, latency, errorRate, seed=seed)
+    FakeShotgun.server = server
+    originalShotgun = shotgun_api3.Shotgun
+    shotgunEventDaemon.sg.Shotgun = FakeShotgun
+
+    workDir = tempfile.mkdtemp(prefix='shotgunEventBenchmark')
+    try:
+        pluginDir = os.path.join(workDir, 'plugins')
+        os.mkdir(pluginDir)
+        for plugin in plugins:
+            shutil.copy(os.path.join(PLUGIN_DIR, plugin + '.py'), pluginDir)
+
+        config = _makeConfig(workDir, pluginDir, settings)
+
+        # Start from the beginning of the synthetic stream.
+        fh = open(config.get('daemon', 'eventIdFile'), 'w')
+        fh.write('0\n')
+        fh.close()
+
+        # The asynchronous engine is benchmarked when the settings ask for it.
+        if config.getOptionalBoolean('daemon', 'asyncEngine', False):
+            if shotgunEventDaemon.asyncio is None:
+                raise RuntimeError('The asynchronous engine needs the trollius package.')
+            engine = AsyncBenchmarkEngine(config, server, timeout)
+        else:
+            engine = BenchmarkEngine(config, server, timeout)
+        server.start()
+        engine.start()
+        return engine.getResults()
+    finally:
+        shotgunEventDaemon.sg.Shotgun = originalShotgun
+        shutil.rmtree(workDir, True)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--events', type='int', default=10000, help='Number of events in the stream [%default].')
+    parser.add_option('--rate', type='float', default=0.0, help='Events created per second, 0 for a backlog of all events [%default].')
+    parser.add_option('--latency', type='float', default=0.0, help='Seconds each Shotgun query takes [%default].')
+    parser.add_option('--error-rate', type='float', default=0.0, help='Fraction of Shotgun queries that fail [%default].')
+    parser.add_option('--plugins', default='noop', help='Comma delimited plugins from benchmarkPlugins to load [%default].')
+    parser.add_option('--set', action='append', default=[], metavar='SECTION.OPTION=VALUE', help='Daemon config setting, can be repeated.')
+    parser.add_option('--timeout', type='float', default=600, help='Seconds after which the benchmark is stopped [%default].')
+    parser.add_option('--seed', type='int', default=0, help='Random seed of the synthetic stream [%default].')
+    parser.add_option('--log-level', type='int', default=logging.WARNING, help='Daemon logging level [%default].')
+    options, args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(options.log_level)
+
+    plugins = [p.strip() for p in options.plugins.split(',') if p.strip()]
+    try:
+        results = runBenchmark(options.events, plugins, options.rate, options.latency, options.error_rate, options.set, options.timeout, options.seed)
+    except RuntimeError, e:
+        parser.error(str(e))
+
+    print 'Plugins:            %s' % ', '.join(plugins)
+    print 'Settings:           %s' % (', '.join(options.set) or 'defaults')
+    print 'Events processed:   %d' % results['events']
+    print 'Callback runs:      %d' % results['callbackRuns']
+    print 'Elapsed:            %.3fs' % results['elapsed']
+    print 'Throughput:         %.1f events/s' % results['eventsPerSecond']
+    print 'Latency p50:        %.4fs' % results['latency_p50']
+    print 'Latency p90:        %.4fs' % results['latency_p90']
+    print 'Latency p99:        %.4fs' % results['latency_p99']
+    print 'Latency max:        %.4fs' % results['latency_max']
+    print 'Shotgun queries:    %d (%d failed)' % (results['queries'], results['queryErrors'])
+    print 'Peak RSS:           %.1f MB (children %.1f MB)' % (results['peakRssSelf'], results['peakRssChildren'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,213 +1,3721 @@
 #!/usr/bin/python
 
+import BaseHTTPServer
+import bisect
+import calendar
+import collections
 import ConfigParser
+import cPickle
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import fcntl
+import fnmatch
+import hashlib
 import imp
 import logging
+import json
 import logging.handlers
+import marshal
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import optparse
 import os
+import Queue
+import re
+import signal
+import struct
 import sys
+import tempfile
+import threading
 import time
 import types
 import traceback
+import zlib
 
 import daemonizer
 import shotgun_api3 as sg
 
+# The asynchronous engine is optional, it needs the trollius port of asyncio.
+try:
+    import concurrent.futures
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+
+# The event fields given to callbacks that do not say which ones they need.
+DEFAULT_EVENT_FIELDS = ['id', 'event_type', 'attribute_name', 'meta', 'entity', 'created_at']
+
+# The event fields the framework itself needs to dispatch events.
+REQUIRED_EVENT_FIELDS = ['id', 'event_type', 'attribute_name', 'entity', 'created_at']
+
+# The most entity ids asked for in a single prefetch query.
+PREFETCH_BATCH_SIZE = 500
+
+# The most log records waiting to be written before new ones are dropped.
+LOG_QUEUE_SIZE = 10000
+
+# The changes of Shotgun_<Entity>_<Change> event types.
+ENTITY_CHANGES = ('New', 'Change', 'Retirement', 'Revival')
+
+
+def _queryEvents(conn, lastEventId, limit=0, maxEventId=None, fields=None):
+    filters = [['id', 'greater_than', lastEventId]]
+    if maxEventId is not None:
+        filters.append(['id', 'less_than', maxEventId + 1])
+    # Paging walks forward on the id so the order has to follow the id.
+    order = [{'column':'id', 'direction':'asc'}]
+    return conn.find("EventLogEntry", filters=filters, fields=fields or DEFAULT_EVENT_FIELDS, order=order, filter_operator='all', limit=limit)
+
+
+def _queryEventIds(conn, ids, fields=None):
+    filters = [['id', 'in', ids]]
+    order = [{'column':'id', 'direction':'asc'}]
+    return conn.find("EventLogEntry", filters=filters, fields=fields or DEFAULT_EVENT_FIELDS, order=order, filter_operator='all')
+
+
+def _getEntityType(event):
+    # Retired entities are not returned with their events, their type is
+    # taken from the meta data or else from the event type. Only the entity
+    # changes are named after the entity type, other events like
+    # Shotgun_User_Login have none.
+    entity = event.get('entity')
+    if entity:
+        return entity.get('type')
+    meta = event.get('meta') or {}
+    if meta.get('entity_type'):
+        return meta['entity_type']
+    parts = (event.get('event_type') or '').split('_')
+    if len(parts) > 2 and parts[0] == 'Shotgun' and parts[-1] in ENTITY_CHANGES:
+        return '_'.join(parts[1:-1])
+    return None
+
+
+def _prefetchEntities(conn, dispatchTable, events):
+    # Gather, per entity type, the entities of the events and the fields the
+    # callbacks they go to have asked for, then get them in one query per type.
+    if not dispatchTable.hasEntityFields():
+        return
+
+    wanted = {}
+    for event in events:
+        entity = event.get('entity')
+        if not entity:
+            continue
+        for callback in dispatchTable.getCallbacks(event):
+            fields = callback.getEntityFields(entity['type'])
+            if fields:
+                fieldSet, ids = wanted.setdefault(entity['type'], (set(), set()))
+                fieldSet.update(fields)
+                ids.add(entity['id'])
+
+    for entityType, (fields, ids) in wanted.items():
+        ids = sorted(ids)
+        records = {}
+        for i in range(0, len(ids), PREFETCH_BATCH_SIZE):
+            try:
+                for record in conn.find(entityType, [['id', 'in', ids[i:i + PREFETCH_BATCH_SIZE]]], sorted(fields)):
+                    records[record['id']] = record
+            except (sg.ProtocolError, sg.ResponseError), e:
+                logging.warning('Could not prefetch %s entities. %s', entityType, e)
+
+        for event in events:
+            entity = event.get('entity')
+            if entity and entity['type'] == entityType and entity['id'] in records:
+                entity.update(records[entity['id']])
+
+
+class Config(ConfigParser.ConfigParser):
+    def __init__(self, path):
+        ConfigParser.ConfigParser.__init__(self)
+        self.read(path)
+
+    def getOptional(self, section, option, default=None):
+        if self.has_option(section, option):
+            return self.get(section, option)
+        return default
+
+    def getOptionalInt(self, section, option, default=None):
+        if self.has_option(section, option):
+            return self.getint(section, option)
+        return default
+
+    def getOptionalFloat(self, section, option, default=None):
+        if self.has_option(section, option):
+            return self.getfloat(section, option)
+        return default
+
+    def getOptionalBoolean(self, section, option, default=None):
+        if self.has_option(section, option):
+            return self.getboolean(section, option)
+        return default
+
+    def getList(self, section, option, default=None):
+        value = self.getOptional(section, option)
+        if value is None:
+            return default or []
+        return [s.strip() for s in value.split(',') if s.strip()]
+
 
 class Engine(object):
-    def __init__(self, pluginPaths, server, name, key, pidFile=None, eventIdFile=None):
+    def __init__(self, config, shardId=None):
+        self._config = config
         self._modules = {}
-        self._paths = pluginPaths
-        self._server = server
-        self._sg = sg.Shotgun(self._server, name, key)
-        self._pidFile = pidFile
-        self._eventIdFile = eventIdFile
+        self._dispatchTable = DispatchTable([])
+        self._paths = config.getList('plugins', 'paths')
+        self._pluginWatcher = PluginWatcher(self._paths, config.getOptionalFloat('plugins', 'rescanInterval', 60.0))
+
+        # Plugins are loaded in parallel, which overlaps the time they spend
+        # registering callbacks but not their imports, from cached byte code,
+        # and those whose callbacks are known from an earlier run only when
+        # needed.
+        self._loadWorkers = config.getOptionalInt('plugins', 'loadWorkers', 8)
+        self._pluginCache = None
+        cacheDir = config.getOptional('plugins', 'cacheDir')
+        if cacheDir:
+            self._pluginCache = PluginCache(cacheDir)
+        self._lazyLoad = config.getOptionalBoolean('plugins', 'lazyLoad', False)
+
+        # The time budget of callbacks that do not register one.
+        self._callbackTimeout = config.getOptionalFloat('daemon', 'callbackTimeout', 0.0)
+        self._server = config.get('shotgun', 'server')
+        self._entityCache = EntityCache(config.getOptionalInt('shotgun', 'entityCacheSize', 10000))
+        self._connectionPool = ConnectionPool(config.getOptionalInt('shotgun', 'connectionPoolSize', 4), self._entityCache)
+        self._sgScriptName = config.get('shotgun', 'name')
+        self._sgScriptKey = config.get('shotgun', 'key')
+        self._sg = sg.Shotgun(self._server, self._sgScriptName, self._sgScriptKey)
+        self._pidFile = config.getOptional('daemon', 'pidFile')
+        self._eventIdFile = config.getOptional('daemon', 'eventIdFile')
         self._lastEventId = None
+        self._processedEventId = None
+
+        # A sharded instance only runs its share of the plugins, or of the
+        # entities, and keeps its files apart from the other shards.
+        self._shardId = shardId
+        self._shardCount = config.getOptionalInt('shards', 'count', 1)
+        self._shardBy = config.getOptional('shards', 'by', 'plugin')
+        if shardId is not None:
+            if self._shardBy not in ('plugin', 'entity'):
+                raise ValueError('Unknown shard split %r, expected plugin or entity.' % self._shardBy)
+            if self._pidFile:
+                self._pidFile = '%s.shard%d' % (self._pidFile, shardId)
+            if self._eventIdFile:
+                self._eventIdFile = '%s.shard%d' % (self._eventIdFile, shardId)
+
+        # Fetched events can be kept in a local journal that is read before
+        # going to the server.
+        self._journal = None
+        journalPath = config.getOptional('journal', 'path')
+        if journalPath:
+            if shardId is not None:
+                journalPath = '%s.shard%d' % (journalPath, shardId)
+            self._journal = _getJournal(config, journalPath)
+
+        # Event fetching is done in pages so a large backlog is never held in
+        # memory all at once. Pages are fetched in a background thread while
+        # the previous one is being dispatched.
+        self._fetchPageSize = config.getOptionalInt('daemon', 'fetchPageSize', 500)
+        self._fetchMaxPages = config.getOptionalInt('daemon', 'fetchMaxPages', 2)
+
+        # Instrumentation, served over HTTP when a port is configured.
+        self._metrics = None
+        self._metricsServer = None
+        metricsPort = config.getOptionalInt('metrics', 'port', 0)
+        if metricsPort:
+            # Shards on the same host serve their metrics on consecutive ports.
+            metricsPort += shardId or 0
+            self._metrics = Metrics()
+            self._metricsServer = MetricsServer(config.getOptional('metrics', 'host', '127.0.0.1'), metricsPort, self._getMetrics)
+        # The lag is measured against the newest event on the server, asked
+        # for at most every headInterval seconds.
+        self._headInterval = config.getOptionalFloat('metrics', 'headInterval', 30.0)
+        self._headQueried = 0.0
+        self._headConn = None
+
+        # A profile of the running daemon is taken when it is sent SIGUSR1 and
+        # written next to the log file.
+        profilePath = os.path.splitext(config.getOptional('daemon', 'logFile') or os.path.join(tempfile.gettempdir(), 'shotgunEventDaemon.log'))[0] + '.profile'
+        if shardId is not None:
+            profilePath = '%s.shard%d' % (profilePath, shardId)
+        self._profiler = Profiler(
+            profilePath,
+            config.getOptionalFloat('daemon', 'profileDuration', 60.0),
+            config.getOptionalFloat('daemon', 'profileInterval', 0.01),
+        )
+
+        # The delay between polls adapts to how busy the event stream is.
+        self._fetchFailed = False
+        self._lastPageFull = False
+        self._pollScheduler = PollScheduler(
+            config.getOptionalFloat('daemon', 'pollInterval', 1.0),
+            config.getOptionalFloat('daemon', 'pollMaxInterval', 10.0),
+            config.getOptionalFloat('daemon', 'pollErrorMaxInterval', 60.0),
+            config.getOptionalFloat('daemon', 'pollBackoff', 2.0),
+        )
+
+        # The last processed event id is only written to disk every so many
+        # events or seconds, and always on shutdown.
+        self._checkpoint = Checkpoint(
+            self._eventIdFile,
+            config.getOptionalInt('daemon', 'checkpointEvents', 100),
+            config.getOptionalFloat('daemon', 'checkpointInterval', 5.0),
+            config.getOptionalInt('daemon', 'skippedEventsMax', 100000),
+        )
+
+        # Modules can have their callbacks run in a pool of worker processes.
+        # They are forked from a process that already runs threads, the log
+        # listener at least, so workers create their logging locks anew.
+        self._processPool = None
+        self._processModules = config.getList('plugins', 'processModules')
+        processWorkers = config.getOptionalInt('plugins', 'processWorkers', 0)
+        if processWorkers > 0:
+            self._processPool = ProcessPool(self._server, processWorkers, self._connectionPool.getMaxIdle(), self._callbackTimeout)
+
+        # With dispatch workers, callbacks run concurrently on a thread pool
+        # instead of one after the other in the main loop.
+        dispatchWorkers = config.getOptionalInt('daemon', 'dispatchWorkers', 0)
+        if self._processPool is not None and dispatchWorkers <= 0:
+            # Process workers need concurrent dispatch to be kept busy.
+            dispatchWorkers = processWorkers
+        self._dispatchPool = self._createDispatchPool(config, dispatchWorkers)
+
+        # Callbacks that hold up the live event stream for too long are moved
+        # to a catch up track where they work from their own cursor, in larger
+        # batches, until they are back with the others.
+        self._callbackMaxLag = config.getOptionalFloat('daemon', 'callbackMaxLag', 30.0)
+        self._catchUpPageSize = config.getOptionalInt('daemon', 'catchUpPageSize', 2000)
+        self._callbacksByName = {}
+        self._lagging = {}
+        self._catchingUp = set()
+        self._trackLock = threading.Lock()
+        self._catchUpStop = threading.Event()
+        self._catchUpThread = None
+        self._lastLagCheck = time.time()
+
+        # Callbacks that keep going over their time budget, or keep failing,
+        # are quarantined by a circuit breaker. The events they skip are
+        # recorded with the checkpoint and processed again on the catch up
+        # track once they have recovered or their module has been reloaded.
+        self._breakerSettings = (
+            config.getOptionalInt('daemon', 'breakerOverruns', 3),
+            config.getOptionalFloat('daemon', 'breakerFailureRate', 0.5),
+            config.getOptionalInt('daemon', 'breakerMinRuns', 10),
+            config.getOptionalFloat('daemon', 'breakerWindow', 60.0),
+            config.getOptionalFloat('daemon', 'breakerBackoff', 30.0),
+            config.getOptionalFloat('daemon', 'breakerMaxBackoff', 3600.0),
+        )
+        self._breakers = {}
+        self._replaySkippedEvents = config.getOptionalBoolean('daemon', 'replaySkippedEvents', True)
+        self._recovered = {}
+
+        # Events for batch callbacks are gathered here, by callback name,
+        # until their batch is due.
+        self._batchers = {}
+        self._nextBatchDue = None
+
+        # Ids skipped in the event stream are looked for again for a while in
+        # case their transaction was committed late.
+        self._gapTracker = None
+        gapTTL = config.getOptionalFloat('daemon', 'gapTTL', 300.0)
+        if gapTTL > 0:
+            self._gapTracker = GapTracker(
+                gapTTL,
+                config.getOptionalFloat('daemon', 'gapCheckInterval', 30.0),
+                config.getOptionalInt('daemon', 'gapBatchSize', 100),
+                config.getOptionalInt('daemon', 'gapMaxIds', 1000),
+            )
+
+    def _createDispatchPool(self, config, workers):
+        if workers <= 0:
+            return None
+        return DispatchPool(workers, config.getOptionalInt('daemon', 'dispatchMaxPending', workers * 10), self._runCallback)
 
     def start(self):
         if self._pidFile:
             if os.path.exists(self._pidFile):
-                logging.critical('The pid file (%s) allready exists. Is another event sink running?', self._pidFile)
+                # The shard lock is held so the pid file of a shard was left
+                # by an instance that died, it is taken over.
+                if self._shardId is None:
+                    logging.critical('The pid file (%s) allready exists. Is another event sink running?', self._pidFile)
+                    return
+                logging.warning('Taking over the pid file (%s) of a dead instance.', self._pidFile)
+
+            fh = open(self._pidFile, 'w')
+            fh.write("%d\n" % os.getpid())
+            fh.close()
+
+        self._loadLastEventId()
+
+        if self._metricsServer is not None:
+            self._metricsServer.start()
+
+        self._catchUpThread = threading.Thread(target=self._catchUpLoop, name='CatchUpTrack')
+        self._catchUpThread.setDaemon(True)
+        self._catchUpThread.start()
+
+        self._profiler.start()
+        try:
+            signal.signal(signal.SIGUSR1, self._onProfileSignal)
+            # System calls interrupted by the signal are carried on.
+            signal.siginterrupt(signal.SIGUSR1, False)
+        except (AttributeError, ValueError), e:
+            # Not on this platform or not in the main thread.
+            logging.debug('Can not profile on signal: %s', e)
+
+        try:
+            self._mainLoop()
+        except KeyboardInterrupt, e:
+            logging.warning('Keyboard interrupt. Cleaning up...')
+        except Exception, e:
+            logging.critical('Crash!!!!! Unexpected error in main loop.\n\n%s', traceback.format_exc(e))
+        finally:
+            self._catchUpStop.set()
+            self._catchUpThread.join()
+            if self._dispatchPool is not None:
+                self._dispatchPool.shutdown()
+                self._saveCompletedEventId()
+            if self._processPool is not None:
+                self._processPool.shutdown()
+            logging.info('Shotgun connection pool: %(hits)d hits, %(misses)d misses, %(connections)d connections.', self._connectionPool.getStats())
+            logging.info('Entity cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, %(invalidations)d invalidations.', self._entityCache.getStats())
+            self._checkpoint.flush()
+            if self._metricsServer is not None:
+                self._metricsServer.stop()
+            self._profiler.stop()
+            self._removePidFile()
+
+    def _onProfileSignal(self, signum, frame):
+        # Signal handlers run in the main thread in between two steps of
+        # whatever it was doing, they must not log or take locks it may hold.
+        self._profiler.request()
+
+    def _loadLastEventId(self):
+        eid = self._checkpoint.load()
+        if eid is not None:
+            self._lastEventId = eid
+            self._saveEventId(self._lastEventId)
+            logging.debug('Read last event id (%d) from file.', self._lastEventId)
+
+        # Callbacks that were catching up when the daemon stopped carry on
+        # from their own cursor.
+        self._lagging = self._checkpoint.getCursors()
+        for name, cursor in sorted(self._lagging.items()):
+            logging.info('Callback %s is catching up from event %d.', name, cursor)
+
+        if self._lastEventId is None:
+            result = self._sg.find_one("EventLogEntry", filters=[], fields=['id'], order=[{'column':'created_at', 'direction':'desc'}])
+            logging.info('Read last event id (%d) from the Shotgun database.', result['id'])
+            self._lastEventId = result['id']
+            self._saveEventId(self._lastEventId)
+            self._checkpoint.flush()
+
+    def _mainLoop(self):
+        logging.debug('Starting the event processing loop.')
+        while self._checkContinue():
+            pollStart = time.time()
+            if self._pluginWatcher.hasChanged():
+                self.load()
+            self._promoteCallbacks()
+            eventCount = 0
+            passTimes = {}
+            for event in self._getNewEvents():
+                eventCount += 1
+                if self._gapTracker is not None:
+                    self._gapTracker.observe(self._lastEventId, event['id'])
+                self._lastEventId = event['id']
+                self._entityCache.invalidate(event)
+                self._dispatchEvent(event, passTimes)
+                if self._dispatchPool is None:
+                    self._saveEventId(event['id'])
+                if self._metrics is not None:
+                    self._metrics.eventDispatched(event)
+                self._flushBatches()
+            if self._gapTracker is not None and self._gapTracker.isDue():
+                self._recoverGaps(passTimes)
+            self._flushBatches()
+            if self._dispatchPool is not None:
+                self._saveCompletedEventId()
+            self._checkpoint.flushIfDue()
+
+            delay = self._pollScheduler.poll(time.time() - pollStart, eventCount, self._lastPageFull, self._fetchFailed)
+            if self._nextBatchDue is not None:
+                delay = min(delay, max(self._nextBatchDue - time.time(), 0))
+            sleepStart = time.time()
+            self._sleep(delay)
+            self._pollScheduler.slept(time.time() - sleepStart)
+
+        # Events gathered for batch callbacks are processed before shutting
+        # down rather than fetched again on the next start.
+        self._flushBatches(True)
+        logging.debug('Shuting down event processing loop.')
+
+    def _dispatchEvent(self, event, passTimes):
+        if not self._isShardEvent(event):
+            return
+        callbacks = self._dispatchTable.getCallbacks(event)
+        if self._batchers:
+            for callback in callbacks:
+                if callback.isBatch():
+                    self._batchers[callback.getName()].add(event)
+            callbacks = [c for c in callbacks if not c.isBatch()]
+        if self._lagging:
+            callbacks = [c for c in callbacks if c.getName() not in self._lagging]
+
+        if self._dispatchPool is None:
+            for callback in callbacks:
+                duration = self._runCallback(callback, event)
+                if self._callbackMaxLag:
+                    self._checkPassTime(callback, passTimes, duration, event['id'])
+        else:
+            self._dispatchPool.dispatch(event, callbacks)
+            self._saveCompletedEventId()
+            if self._callbackMaxLag and time.time() - self._lastLagCheck >= 1.0:
+                self._lastLagCheck = time.time()
+                self._checkPendingAges()
+
+    def _runCallback(self, callback, event):
+        if not self._allowCallback(callback, event):
+            return 0.0
+        start = time.time()
+        success = callback.process(event)
+        return self._callbackDone(callback, event, time.time() - start, success)
+
+    def _allowCallback(self, callback, event):
+        breaker = self._breakers.get(callback.getName())
+        if breaker is None or breaker.allow():
+            return True
+        self._skipEvents(callback, event)
+        if isinstance(callback, Batcher):
+            callback.release()
+        return False
+
+    def _callbackDone(self, callback, event, duration, success):
+        # Callbacks report None when they were given up on for going over
+        # their time budget.
+        name = callback.getName()
+        if self._metrics is not None:
+            self._metrics.observeCallback(name, duration, success)
+        if self._profiler.isProfiling():
+            self._profiler.observeCallback(name, duration)
+        if success is None:
+            self._skipEvents(callback, event)
+
+        breaker = self._getBreaker(name)
+        if breaker is not None:
+            state = breaker.record(success, success is None)
+            if state == CircuitBreaker.OPEN:
+                if breaker.getTrips() == 1:
+                    logging.error('Callback %s keeps going over its time budget or failing, it is quarantined for %.1fs. Its events are skipped and recorded until then.', name, breaker.getDelay())
+                else:
+                    logging.warning('Callback %s is still not working, it is quarantined for %.1fs.', name, breaker.getDelay())
+            elif state == CircuitBreaker.CLOSED:
+                logging.info('Callback %s has recovered from its quarantine.', name)
+                self._scheduleSkippedReplay(name)
+        return duration
+
+    def _getBreaker(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None and (self._breakerSettings[0] > 0 or self._breakerSettings[1] > 0):
+            breaker = self._breakers.setdefault(name, CircuitBreaker(*self._breakerSettings))
+        return breaker
+
+    def _skipEvents(self, callback, event):
+        if isinstance(event, list):
+            ids = [e['id'] for e in event]
+        else:
+            ids = [event['id']]
+        self._checkpoint.addSkipped(callback.getName(), ids)
+
+    def _scheduleSkippedReplay(self, name):
+        if not self._replaySkippedEvents or not self._checkpoint.getSkipped(name, limit=1):
+            return
+        self._trackLock.acquire()
+        try:
+            if name in self._recovered:
+                return
+            self._recovered[name] = 0
+        finally:
+            self._trackLock.release()
+        logging.info('Callback %s is processing the events it skipped.', name)
+
+    def _getSkippedReplay(self):
+        # The next callback to process skipped events with, and from where.
+        # A quarantined callback that is due for a trial run is given the
+        # oldest event it skipped when it would not get a new one.
+        self._trackLock.acquire()
+        try:
+            for name, cursor in self._recovered.items():
+                return name, cursor, False
+        finally:
+            self._trackLock.release()
+        for name, breaker in self._breakers.items():
+            if breaker.isTrialDue() and self._checkpoint.getSkipped(name, limit=1):
+                return name, 0, True
+        return None
+
+    def _replaySkipped(self, conn, name, cursor, trial, pageSize=100):
+        # Events a callback skipped are processed again in id order, a page
+        # at a time, while the callback keeps being given new events.
+        callback = self._callbacksByName.get(name)
+        ids = self._checkpoint.getSkipped(name, cursor, trial and 1 or pageSize)
+        breaker = self._breakers.get(name)
+        if not trial and (callback is None or not ids or (breaker is not None and breaker.isOpen())):
+            self._trackLock.acquire()
+            try:
+                del self._recovered[name]
+            finally:
+                self._trackLock.release()
+            if callback is not None and not ids:
+                logging.info('Callback %s is done with the events it had skipped.', name)
+            return conn
+        if callback is None or not ids:
+            return conn
+
+        if conn is None:
+            conn = sg.Shotgun(self._server, self._sgScriptName, self._sgScriptKey)
+        dispatchTable = self._dispatchTable
+        events = _queryEventIds(conn, ids, dispatchTable.getEventFields())
+        _prefetchEntities(conn, dispatchTable, events)
+
+        # Events skipped again while being processed are recorded again.
+        self._checkpoint.removeSkipped(name, ids)
+        if callback.isBatch():
+            if events:
+                self._runCallback(callback, events)
+        else:
+            for i, event in enumerate(events):
+                if self._catchUpStop.isSet():
+                    self._checkpoint.addSkipped(name, [e['id'] for e in events[i:]])
+                    break
+                self._runCallback(callback, event)
+
+        self._trackLock.acquire()
+        try:
+            if name in self._recovered:
+                self._recovered[name] = ids[-1]
+        finally:
+            self._trackLock.release()
+        return conn
+
+    def _flushBatches(self, force=False):
+        if not self._batchers:
+            return
+
+        now = time.time()
+        flushed = False
+        self._nextBatchDue = None
+        for batcher in self._batchers.values():
+            due = batcher.getDueTime()
+            if due is None:
+                continue
+            if not force and due > now:
+                self._nextBatchDue = min(self._nextBatchDue or due, due)
+                continue
+
+            events = batcher.take()
+            if self._dispatchPool is None:
+                self._runCallback(batcher, events)
+            else:
+                self._dispatchPool.dispatchBatch(events, batcher, self._lastEventId)
+            flushed = True
+
+        if flushed and self._dispatchPool is None:
+            self._saveEventId(self._lastEventId)
+
+    def _recoverGaps(self, passTimes):
+        # Events whose ids were skipped may show up late because their
+        # transaction was committed after later ones. Only those ids are looked
+        # for, a few at a time.
+        for ids in self._gapTracker.getBatches():
+            try:
+                events = _queryEventIds(self._sg, ids, self._dispatchTable.getEventFields())
+                _prefetchEntities(self._sg, self._dispatchTable, events)
+            except (sg.ProtocolError, sg.ResponseError), e:
+                logging.warning(str(e))
+                return
+
+            self._gapTracker.fill([event['id'] for event in events])
+            for event in events:
+                logging.info('Recovered late event %d.', event['id'])
+                self._entityCache.invalidate(event)
+                self._dispatchEvent(event, passTimes)
+
+    def _getMetrics(self):
+        # Called from the metrics server thread for every scrape.
+        gauges = {
+            'processed_event_id': self._processedEventId,
+            'modules': len(self._modules),
+            'callbacks': len(self._dispatchTable),
+            'lagging_callbacks': len(self._lagging),
+            'quarantined_callbacks': len([b for b in self._breakers.values() if b.isOpen()]),
+            'skipped_events': sum(self._checkpoint.getSkippedCounts().values()),
+        }
+        if self._gapTracker is not None:
+            gauges['tracked_gaps'] = len(self._gapTracker)
+        for name, value in self._pollScheduler.getStats().items():
+            gauges['poll_' + name] = value
+        for name, value in self._connectionPool.getStats().items():
+            gauges['connection_pool_' + name] = value
+        for name, value in self._entityCache.getStats().items():
+            gauges['entity_cache_' + name] = value
+        self._queryServerHead()
+        return self._metrics.render(self._processedEventId, gauges)
+
+    def _queryServerHead(self):
+        # Fetched pages are capped, so the newest event fetched says little
+        # of how far behind the server the daemon is.
+        if time.time() - self._headQueried < self._headInterval:
+            return
+        self._headQueried = time.time()
+        try:
+            if self._headConn is None:
+                self._headConn = sg.Shotgun(self._server, self._sgScriptName, self._sgScriptKey)
+            result = self._headConn.find_one('EventLogEntry', [], ['id'], order=[{'column':'id', 'direction':'desc'}])
+        except (sg.ProtocolError, sg.ResponseError), e:
+            logging.warning('Could not get the newest event for the metrics. %s', e)
+            return
+        if result is not None:
+            self._metrics.setServerHead(result['id'])
+
+    def _sleep(self, delay):
+        # Sleep in short steps so a long delay does not hold up a shutdown.
+        end = time.time() + delay
+        while self._checkContinue():
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 1.0))
+
+    def _checkPassTime(self, callback, passTimes, duration, eid):
+        name = callback.getName()
+        passTimes[name] = passTimes.get(name, 0.0) + duration
+        if passTimes[name] > self._callbackMaxLag:
+            self._demoteCallback(name, eid)
+
+    def _checkPendingAges(self):
+        for callback, age in self._dispatchPool.getPendingAges().items():
+            # Batch callbacks hold back the checkpoint but never the others.
+            if age > self._callbackMaxLag and callback.getName() not in self._batchers:
+                # Everything up to the current event has been handed to the
+                # callback already, catching up starts after it.
+                self._demoteCallback(callback.getName(), self._lastEventId)
+
+    def _demoteCallback(self, name, cursor):
+        self._trackLock.acquire()
+        try:
+            if name in self._lagging:
+                return
+            self._lagging[name] = cursor
+            self._checkpoint.setCursor(name, cursor)
+        finally:
+            self._trackLock.release()
+        logging.warning('Callback %s is falling behind, it will catch up on its own from event %d.', name, cursor)
+
+    def _promoteCallbacks(self):
+        self._trackLock.acquire()
+        try:
+            for name, cursor in self._lagging.items():
+                # Batch callbacks do not catch up on their own.
+                if name not in self._catchingUp and (cursor >= self._lastEventId or name in self._batchers):
+                    del self._lagging[name]
+                    self._checkpoint.removeCursor(name)
+                    logging.info('Callback %s has caught up at event %d.', name, cursor)
+        finally:
+            self._trackLock.release()
+
+    def _getCatchUpBatch(self):
+        self._trackLock.acquire()
+        try:
+            batch = {}
+            for name, cursor in self._lagging.items():
+                callback = self._callbacksByName.get(name)
+                if callback is None or callback.isBatch() or cursor >= self._lastEventId:
+                    continue
+                # Events the callback was given on the live track have to be
+                # done before it catches up on the following ones.
+                if self._dispatchPool is not None and self._dispatchPool.hasPending(callback):
+                    continue
+                batch[name] = [callback, cursor]
+                self._catchingUp.add(name)
+            return batch, self._lastEventId
+        finally:
+            self._trackLock.release()
+
+    def _endCatchUpBatch(self, batch):
+        self._trackLock.acquire()
+        try:
+            for name, (callback, cursor) in batch.items():
+                self._catchingUp.discard(name)
+                if name in self._lagging:
+                    self._lagging[name] = cursor
+                    self._checkpoint.setCursor(name, cursor)
+        finally:
+            self._trackLock.release()
+
+    def _catchUpLoop(self):
+        conn = None
+        while not self._catchUpStop.isSet():
+            replay = self._getSkippedReplay()
+            if replay is not None:
+                try:
+                    conn = self._replaySkipped(conn, *replay)
+                except (sg.ProtocolError, sg.ResponseError), e:
+                    logging.warning(str(e))
+                    self._catchUpStop.wait(5.0)
+                except Exception, e:
+                    logging.error('Unexpected error processing skipped events.\n\n%s', traceback.format_exc(e))
+                    self._catchUpStop.wait(5.0)
+                continue
+
+            batch, ceiling = self._getCatchUpBatch()
+            if not batch:
+                self._catchUpStop.wait(1.0)
+                continue
+
+            try:
+                if conn is None:
+                    conn = sg.Shotgun(self._server, self._sgScriptName, self._sgScriptKey)
+
+                # One fetch from the slowest cursor serves all lagging callbacks.
+                start = min([cursor for callback, cursor in batch.values()])
+                dispatchTable = self._dispatchTable
+                events = _queryEvents(conn, start, self._catchUpPageSize, ceiling, dispatchTable.getEventFields())
+                _prefetchEntities(conn, dispatchTable, events)
+                for event in events:
+                    if self._catchUpStop.isSet():
+                        break
+                    if not self._isShardEvent(event):
+                        for state in batch.values():
+                            state[1] = max(state[1], event['id'])
+                        continue
+                    key = (event.get('event_type'), _getEntityType(event), event.get('attribute_name'))
+                    for name, state in batch.items():
+                        if state[1] < event['id']:
+                            if state[0].matches(*key):
+                                self._runCallback(state[0], event)
+                            state[1] = event['id']
+                else:
+                    # Every event up to the ceiling has been seen.
+                    if len(events) < self._catchUpPageSize:
+                        for state in batch.values():
+                            state[1] = max(state[1], ceiling)
+            except (sg.ProtocolError, sg.ResponseError), e:
+                logging.warning(str(e))
+                self._catchUpStop.wait(5.0)
+            except Exception, e:
+                logging.error('Unexpected error catching up on events.\n\n%s', traceback.format_exc(e))
+                self._catchUpStop.wait(5.0)
+            finally:
+                self._endCatchUpBatch(batch)
+
+    def stop(self):
+        self._removePidFile()
+        logging.info('Stopping gracefully once current events have been processed.')
+
+    def load(self):
+        filePaths = []
+        for path in self._paths:
+            if not os.path.isdir(path):
+                continue
+
+            for basename in os.listdir(path):
+                if not basename.endswith('.py') or basename.startswith('.'):
+                    continue
+
+                if not self._isShardModule(basename):
+                    continue
+
+                filePaths.append(os.path.join(path, basename))
+
+        # Modules do not depend on each other so they are loaded at the same
+        # time, most of the time goes into imports and Shotgun connections.
+        start = time.time()
+        if self._loadWorkers > 1 and len(filePaths) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(self._loadWorkers, len(filePaths)))
+            try:
+                results = pool.map(self._loadModule, filePaths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._loadModule(filePath) for filePath in filePaths]
+
+        newModules = dict([(module.getPath(), module) for module, loaded in results])
+        loaded = [module for module, loaded in results if loaded]
+        changed = bool(loaded)
+        if loaded:
+            self._logLoadTimes(loaded, time.time() - start)
+            if self._metrics is not None:
+                for module in loaded:
+                    if module.getPath() in self._modules:
+                        self._metrics.moduleReloaded()
+
+        if changed or len(newModules) != len(self._modules):
+            self._dispatchTable = DispatchTable([self._getModuleCallbacks(newModules[p]) for p in sorted(newModules)])
+            callbacksByName = dict([(c.getName(), c) for c in self._dispatchTable])
+            self._trackLock.acquire()
+            try:
+                self._callbacksByName = callbacksByName
+                # The callbacks of a module whose file is gone no longer catch
+                # up, their cursors would hold the reported lag up forever.
+                # Those of a module that failed to load are kept for when it
+                # loads again.
+                moduleNames = [m.getName() for m in newModules.values()]
+                for name in self._lagging.keys():
+                    if name not in callbacksByName and not [n for n in moduleNames if name.startswith(n + '.')]:
+                        del self._lagging[name]
+                        self._checkpoint.removeCursor(name)
+                        logging.info('The module of callback %s is gone, its cursor is dropped.', name)
+            finally:
+                self._trackLock.release()
+
+            # Events gathered for a batch callback are kept across reloads of
+            # its module.
+            batchers = {}
+            for callback in self._dispatchTable:
+                if callback.isBatch():
+                    batcher = batchers[callback.getName()] = self._batchers.get(callback.getName()) or Batcher(callback)
+                    batcher.setCallback(callback)
+            self._batchers = batchers
+
+        # Reloaded callbacks get a fresh start and process the events they
+        # skipped before.
+        for module in loaded:
+            for callback in module:
+                self._breakers.pop(callback.getName(), None)
+                self._scheduleSkippedReplay(callback.getName())
+
+        self._modules = newModules
+
+    def _loadModule(self, filePath):
+        module = self._modules.get(filePath)
+        if module is None:
+            return Module(self._server, filePath, self._connectionPool, self._pluginCache, self._lazyLoad, self._callbackTimeout), True
+        return module, module.load()
+
+    def _logLoadTimes(self, modules, duration):
+        lines = []
+        lazy = 0
+        modules = sorted(modules, key=lambda m: -sum(m.getLoadTimes() or (0.0, 0.0)))
+        for module in modules:
+            if module.isLazy():
+                lazy += 1
+                continue
+            importTime, registerTime = module.getLoadTimes() or (0.0, 0.0)
+            lines.append('  %8.3fs %8.3fs %9d  %s' % (importTime, registerTime, len(list(module)), module.getPath()))
+        if lines:
+            lines.insert(0, '%11s %9s %9s  %s' % ('import', 'register', 'callbacks', 'module'))
+        logging.info('Loaded %d modules (%d lazily) in %.3fs.%s', len(modules), lazy, duration, ''.join(['\n' + line for line in lines]))
+
+    def _getModuleCallbacks(self, module):
+        if self._processPool is None or not self._isProcessModule(module):
+            return list(module)
+        return [ProcessCallback(self._processPool, module, i, c) for i, c in enumerate(module)]
+
+    def _isShardModule(self, basename):
+        if self._shardId is None or self._shardBy != 'plugin':
+            return True
+        moduleName = os.path.splitext(basename)[0]
+        return (zlib.crc32(moduleName) & 0xffffffff) % self._shardCount == self._shardId
+
+    def _isShardEvent(self, event):
+        if self._shardId is None or self._shardBy != 'entity':
+            return True
+        # All the events of an entity go to the same shard, retired entities
+        # are only known through the meta data.
+        entity = event.get('entity') or {}
+        key = entity.get('id') or (event.get('meta') or {}).get('entity_id') or event['id']
+        return key % self._shardCount == self._shardId
+
+    def _isProcessModule(self, module):
+        # With no module list, all modules are run in the process pool.
+        if not self._processModules:
+            return True
+        return module.getName() in self._processModules or module.getPath() in self._processModules
+
+    def _checkContinue(self):
+        if self._pidFile is None:
+            return True
+
+        if os.path.exists(self._pidFile):
+            return True
+
+        return False
+
+    def _getNewEvents(self):
+        self._fetchFailed = False
+        # Whether the last page fetched was full, which means more events
+        # were waiting when fetching stopped.
+        self._lastPageFull = False
+
+        # A page size of 0 is a single unbounded query.
+        if not self._fetchPageSize:
+            for event in self._fetchPage(self._lastEventId):
+                yield event
+            return
+
+        # A limit of 0 lets the fetcher run as far ahead as it can.
+        pages = Queue.Queue(max(self._fetchMaxPages, 0))
+        stop = threading.Event()
+        errors = []
+        fetcher = threading.Thread(target=self._fetchPages, args=(self._lastEventId, pages, stop, errors), name='EventFetcher')
+        fetcher.setDaemon(True)
+        fetcher.start()
+
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                for event in page:
+                    yield event
+            # Errors in the fetcher are raised in the main loop like they
+            # would have been had the fetch been done there.
+            if errors:
+                raise errors[0][0], errors[0][1], errors[0][2]
+        finally:
+            # Unblock the fetcher if the consumer stopped before the end.
+            stop.set()
+            while fetcher.isAlive():
+                try:
+                    pages.get_nowait()
+                except Queue.Empty:
+                    fetcher.join(0.1)
+
+    def _fetchPages(self, lastEventId, pages, stop, errors):
+        try:
+            while not stop.isSet():
+                page = self._fetchPage(lastEventId, self._fetchPageSize)
+                self._lastPageFull = len(page) >= self._fetchPageSize
+                if page:
+                    lastEventId = page[-1]['id']
+                    self._putPage(pages, page, stop)
+                if not self._lastPageFull:
+                    break
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            self._putPage(pages, None, stop)
+
+    def _putPage(self, pages, page, stop):
+        while not stop.isSet():
+            try:
+                pages.put(page, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _fetchPage(self, lastEventId, limit=0):
+        dispatchTable = self._dispatchTable
+        fields = dispatchTable.getEventFields()
+        page = []
+        complete = False
+        if self._journal is not None:
+            page = self._readJournal(lastEventId, limit, fields)
+            complete = limit and len(page) >= limit
+            if page:
+                lastEventId = page[-1]['id']
+                limit = limit and limit - len(page)
+            # Journaled events have all the default fields so they can be used
+            # by callbacks that do not ask for fields.
+            fields = sorted(set(fields).union(DEFAULT_EVENT_FIELDS))
+
+        start = time.time()
+        try:
+            # Only the events past the end of the journal are fetched.
+            if not complete:
+                fetched = _queryEvents(self._sg, lastEventId, limit, fields=fields)
+                if self._metrics is not None:
+                    self._metrics.observeFetch(time.time() - start, fetched)
+                if self._journal is not None:
+                    self._writeJournal(lastEventId, fetched)
+                page = page + fetched
+            _prefetchEntities(self._sg, dispatchTable, page)
+            return page
+        except (sg.ProtocolError, sg.ResponseError), e:
+            logging.warning(str(e))
+            self._fetchFailed = True
+            if self._metrics is not None:
+                self._metrics.fetchFailed()
+
+        return []
+
+    def _readJournal(self, lastEventId, limit, fields):
+        try:
+            page = self._journal.read(lastEventId, limit)[0]
+        except (EnvironmentError, cPickle.UnpicklingError), e:
+            logging.error('Could not read the event journal.\n\n%s', traceback.format_exc(e))
+            return []
+        # Events journaled before a callback asked for more fields are fetched
+        # again.
+        if page and [f for f in fields if f not in page[0]]:
+            return []
+        if page:
+            logging.debug('Read %d events (%d to %d) from the journal.', len(page), page[0]['id'], page[-1]['id'])
+        return page
+
+    def _writeJournal(self, lastEventId, page):
+        try:
+            self._journal.append(lastEventId, page)
+        except (EnvironmentError, cPickle.PicklingError), e:
+            logging.error('Could not write to the event journal.\n\n%s', traceback.format_exc(e))
+
+    def _saveEventId(self, eid):
+        # Events waiting in a batch, or in a batch being processed, are not
+        # done yet.
+        for batcher in self._batchers.values():
+            held = batcher.getHeldEventId()
+            if held is not None and held <= eid:
+                eid = max(held - 1, self._processedEventId)
+        self._checkpoint.update(eid)
+        self._processedEventId = eid
+
+    def _saveCompletedEventId(self):
+        # Only checkpoint up to the last event for which it and every event
+        # before it have been handled by all of their callbacks.
+        eid = self._dispatchPool.getCompletedEventId()
+        if eid is not None:
+            self._saveEventId(eid)
+
+    def _removePidFile(self):
+        if self._pidFile and os.path.exists(self._pidFile):
+            try:
+                os.unlink(self._pidFile)
+            except OSError, e:
+                logging.error('Error removing pid file.\n\n%s', traceback.format_exc(e))
+
+
+class AsyncEngine(Engine):
+    # An engine where fetching, dispatching and checkpointing run as tasks on
+    # an event loop. Callbacks that are coroutines are run on the loop, the
+    # others on a pool of threads, with at most asyncConcurrency callback runs
+    # at once.
+    def __init__(self, config, shardId=None):
+        if asyncio is None:
+            raise RuntimeError('The asynchronous engine needs the trollius package.')
+        self._loop = asyncio.new_event_loop()
+        self._concurrency = max(config.getOptionalInt('daemon', 'asyncConcurrency', 20), 1)
+        self._fetchExecutor = concurrent.futures.ThreadPoolExecutor(1)
+        Engine.__init__(self, config, shardId)
+
+    def _createDispatchPool(self, config, workers):
+        return AsyncDispatcher(self._loop, self._concurrency, config.getOptionalInt('daemon', 'dispatchMaxPending', self._concurrency * 10), self._runCallback, self._runCallbackAsync)
+
+    def _mainLoop(self):
+        logging.debug('Starting the asynchronous event processing loop.')
+        # Coroutine callbacks that do not pass a loop around use this one.
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._run())
+        finally:
+            self._fetchExecutor.shutdown()
+        self._flushBatches(True)
+        logging.debug('Shuting down event processing loop.')
+
+    def _run(self):
+        # Fetched pages are handed to the dispatcher through a bounded queue,
+        # as (late, events) or None once fetching has stopped.
+        pages = asyncio.Queue(max(self._fetchMaxPages, 0), loop=self._loop)
+        stop = asyncio.Event(loop=self._loop)
+        tasks = [
+            self._loop.create_task(self._fetchTask(pages, stop)),
+            self._loop.create_task(self._dispatchTask(pages)),
+            self._loop.create_task(self._checkpointTask(stop)),
+        ]
+        try:
+            done, pending = yield From(asyncio.wait(tasks, loop=self._loop, return_when=asyncio.FIRST_EXCEPTION))
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _fetchTask(self, pages, stop):
+        cursor = self._lastEventId
+        while not stop.is_set():
+            pollStart = time.time()
+            self._fetchFailed = False
+            eventCount = 0
+            while True:
+                page = yield From(self._loop.run_in_executor(self._fetchExecutor, self._fetchPage, cursor, self._fetchPageSize))
+                # A full last page means more events were waiting when
+                # fetching stopped.
+                full = self._fetchPageSize and len(page) >= self._fetchPageSize
+                if page:
+                    cursor = page[-1]['id']
+                    eventCount += len(page)
+                    yield From(pages.put((False, page)))
+                if not full or stop.is_set():
+                    break
+
+            if self._gapTracker is not None and self._gapTracker.isDue():
+                yield From(self._recoverGapsAsync(pages))
+
+            delay = self._pollScheduler.poll(time.time() - pollStart, eventCount, full, self._fetchFailed)
+            sleepStart = time.time()
+            end = sleepStart + delay
+            while not stop.is_set() and time.time() < end:
+                yield From(asyncio.sleep(min(end - time.time(), 0.1), loop=self._loop))
+            self._pollScheduler.slept(time.time() - sleepStart)
+        yield From(pages.put(None))
+
+    def _recoverGapsAsync(self, pages):
+        for ids in self._gapTracker.getBatches():
+            try:
+                events = yield From(self._loop.run_in_executor(self._fetchExecutor, self._queryLateEvents, ids))
+            except (sg.ProtocolError, sg.ResponseError), e:
+                logging.warning(str(e))
+                return
+            self._gapTracker.fill([event['id'] for event in events])
+            if events:
+                yield From(pages.put((True, events)))
+
+    def _queryLateEvents(self, ids):
+        dispatchTable = self._dispatchTable
+        events = _queryEventIds(self._sg, ids, dispatchTable.getEventFields())
+        _prefetchEntities(self._sg, dispatchTable, events)
+        return events
+
+    def _dispatchTask(self, pages):
+        while True:
+            page = yield From(pages.get())
+            if page is None:
                 return
+            late, events = page
+            for event in events:
+                if late:
+                    logging.info('Recovered late event %d.', event['id'])
+                else:
+                    if self._gapTracker is not None:
+                        self._gapTracker.observe(self._lastEventId, event['id'])
+                    self._lastEventId = event['id']
+                self._entityCache.invalidate(event)
+                self._dispatchEvent(event, None)
+                if self._metrics is not None and not late:
+                    self._metrics.eventDispatched(event)
+                if self._dispatchPool.isFull():
+                    yield From(self._dispatchPool.wait())
+
+    def _checkpointTask(self, stop):
+        while self._checkContinue():
+            if self._pluginWatcher.hasChanged():
+                self.load()
+            self._promoteCallbacks()
+            self._flushBatches()
+            self._saveCompletedEventId()
+            self._checkpoint.flushIfDue()
+            yield From(asyncio.sleep(0.1, loop=self._loop))
+        stop.set()
+
+    def _runCallbackAsync(self, callback, event):
+        if not self._allowCallback(callback, event):
+            raise Return(0.0)
+        start = time.time()
+        success = yield From(callback.processAsync(event))
+        raise Return(self._callbackDone(callback, event, time.time() - start, success))
+
+
+class AsyncDispatcher(object):
+    # The counterpart of the DispatchPool for the asynchronous engine, with
+    # the same ordering guarantees. Callback runs are tasks on the loop that
+    # wait for the previous run with the same ordering key.
+    def __init__(self, loop, concurrency, maxPending, runCallback, runCallbackAsync):
+        self._loop = loop
+        self._runCallback = runCallback
+        self._runCallbackAsync = runCallbackAsync
+        self._executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        self._semaphore = asyncio.Semaphore(concurrency, loop=loop)
+        self._maxPending = max(maxPending, 1)
+        # The state below is changed on the loop only, the lock is for the
+        # catch up and metrics threads reading it.
+        self._lock = threading.Lock()
+        self._tails = {}
+        self._events = collections.deque()
+        self._callbackTasks = {}
+        self._futures = set()
+
+    def dispatch(self, event, callbacks):
+        entry = [event['id'], len(callbacks)]
+        self._lock.acquire()
+        try:
+            self._events.append(entry)
+            for callback in callbacks:
+                self._queue(_DispatchTask(event, callback, entry))
+        finally:
+            self._lock.release()
+
+    def dispatchBatch(self, events, batcher, eventId):
+        entry = [eventId, 1]
+        self._lock.acquire()
+        try:
+            self._events.append(entry)
+            self._queue(_DispatchTask(events, batcher, entry, [(batcher,)]))
+        finally:
+            self._lock.release()
+
+    def _queue(self, task):
+        previous = [self._tails[key] for key in task.keys if key in self._tails]
+        future = self._loop.create_task(self._run(task, previous))
+        for key in task.keys:
+            self._tails[key] = future
+        task.future = future
+        self._callbackTasks.setdefault(task.callback, {})[task] = task.submitted
+        self._futures.add(future)
+
+    def _run(self, task, previous):
+        try:
+            if previous:
+                yield From(asyncio.wait(previous, loop=self._loop))
+            yield From(self._semaphore.acquire())
+            try:
+                if task.callback.isAsync():
+                    yield From(self._runCallbackAsync(task.callback, task.event))
+                else:
+                    yield From(self._loop.run_in_executor(self._executor, self._runCallback, task.callback, task.event))
+            finally:
+                self._semaphore.release()
+        finally:
+            self._lock.acquire()
+            try:
+                task.entry[1] -= 1
+                tasks = self._callbackTasks[task.callback]
+                del tasks[task]
+                if not tasks:
+                    del self._callbackTasks[task.callback]
+                for key in task.keys:
+                    if self._tails.get(key) is task.future:
+                        del self._tails[key]
+                self._futures.discard(task.future)
+            finally:
+                self._lock.release()
+
+    def isFull(self):
+        return len(self._futures) >= self._maxPending
+
+    def wait(self):
+        # Holds up the dispatcher while too many callback runs are waiting.
+        while self.isFull():
+            yield From(asyncio.wait(list(self._futures), loop=self._loop, return_when=asyncio.FIRST_COMPLETED))
+
+    def hasPending(self, callback):
+        self._lock.acquire()
+        try:
+            return callback in self._callbackTasks
+        finally:
+            self._lock.release()
+
+    def getPendingAges(self):
+        self._lock.acquire()
+        try:
+            now = time.time()
+            return dict([(c, now - min(tasks.values())) for c, tasks in self._callbackTasks.items()])
+        finally:
+            self._lock.release()
+
+    def getCompletedEventId(self):
+        self._lock.acquire()
+        try:
+            eid = None
+            while self._events and not self._events[0][1]:
+                eid = max(eid, self._events.popleft()[0])
+            return eid
+        finally:
+            self._lock.release()
+
+    def shutdown(self):
+        if self._futures:
+            self._loop.run_until_complete(asyncio.wait(list(self._futures), loop=self._loop))
+        self._executor.shutdown()
+        self._loop.close()
+
+
+class PluginWatcher(object):
+    def __init__(self, paths, rescanInterval=60.0):
+        self._paths = paths
+        self._rescanInterval = rescanInterval
+        self._lastScan = None
+        self._inotify = None
+        self._watched = set()
+
+        if Inotify.isAvailable():
+            try:
+                self._inotify = Inotify()
+            except OSError, e:
+                logging.warning('Could not use inotify to watch plugin paths, rescanning every %ss instead. %s', rescanInterval, e)
+
+    def hasChanged(self):
+        changed = False
+
+        if self._inotify is not None:
+            self._watchPaths()
+            for name in self._inotify.read():
+                # Only plugin sources matter, compiled files written next to
+                # them when they are loaded do not.
+                if not name or (name.endswith('.py') and not name.startswith('.')):
+                    changed = True
+
+        # Inotify does not see changes made from other hosts on network file
+        # systems so there is always a periodic rescan as a fallback.
+        now = time.time()
+        if self._lastScan is None or now - self._lastScan >= self._rescanInterval:
+            changed = True
+
+        if changed:
+            self._lastScan = now
+        return changed
+
+    def _watchPaths(self):
+        for path in self._paths:
+            if path in self._watched or not os.path.isdir(path):
+                continue
+            try:
+                self._inotify.addWatch(path)
+                self._watched.add(path)
+            except OSError, e:
+                logging.warning('Could not watch plugin path %s. %s', path, e)
+
+
+class Inotify(object):
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    _EVENT_HEADER = struct.Struct('iIII')
+    _libc = None
+
+    @classmethod
+    def isAvailable(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        if cls._libc is None:
+            try:
+                cls._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            except OSError:
+                return False
+        return hasattr(cls._libc, 'inotify_init1')
+
+    def __init__(self):
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+
+    def addWatch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, path, self.WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return wd
+
+    def read(self):
+        names = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+
+            offset = 0
+            while offset + self._EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                names.append(data[offset:offset + length].rstrip('\0'))
+                offset += length
+        return names
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollScheduler(object):
+    def __init__(self, interval=1.0, maxInterval=10.0, errorMaxInterval=60.0, backoff=2.0):
+        self._interval = interval
+        self._maxInterval = max(maxInterval, interval)
+        self._errorMaxInterval = max(errorMaxInterval, interval)
+        self._backoff = max(backoff, 1.0)
+        self._delay = interval
+        self._errors = 0
+        self._stats = {
+            'polls': 0,
+            'pollTime': 0.0,
+            'lastPollTime': 0.0,
+            'sleeps': 0,
+            'sleepTime': 0.0,
+            'lastSleepTime': 0.0,
+        }
+
+    def poll(self, duration, eventCount, full, failed):
+        self._stats['polls'] += 1
+        self._stats['pollTime'] += duration
+        self._stats['lastPollTime'] = duration
+
+        if failed:
+            # Back off exponentially while the server has problems.
+            self._errors += 1
+            self._delay = min(self._interval * self._backoff ** self._errors, self._errorMaxInterval)
+        elif full:
+            # A full last page means a backlog or a burst, look again right
+            # away.
+            self._errors = 0
+            self._delay = 0.0
+        elif eventCount:
+            self._errors = 0
+            self._delay = self._interval
+        else:
+            # Nothing new, slowly back off while the site is idle.
+            self._errors = 0
+            self._delay = min(max(self._delay, self._interval) * self._backoff, self._maxInterval)
+
+        logging.debug('Poll took %.3fs for %d events, next poll in %.3fs.', duration, eventCount, self._delay)
+        return self._delay
+
+    def slept(self, duration):
+        self._stats['sleeps'] += 1
+        self._stats['sleepTime'] += duration
+        self._stats['lastSleepTime'] = duration
+
+    def getStats(self):
+        return dict(self._stats)
+
+
+class Histogram(object):
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        lines = []
+        total = 0
+        for bound, count in zip(self.BUCKETS + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, total))
+        if labels:
+            labels = '{%s}' % labels.rstrip(',')
+        lines.append('%s_sum%s %f' % (name, labels, self.sum))
+        lines.append('%s_count%s %d' % (name, labels, self.count))
+        return lines
+
+
+class Metrics(object):
+    PREFIX = 'shotgun_events_'
+
+    def __init__(self):
+        # Recording is a few attribute updates. Counts updated from several
+        # threads without a lock may very rarely miss an increment, which is
+        # fine for monitoring.
+        self._eventsDispatched = 0
+        self._lastDispatchedId = None
+        self._lastDispatchedTime = None
+        self._headEventId = None
+        self._serverHeadId = None
+        self._fetchErrors = 0
+        self._moduleReloads = 0
+        self._fetchLatency = Histogram()
+        self._callbackLatency = {}
+        self._callbackErrors = {}
+
+    def eventDispatched(self, event):
+        self._eventsDispatched += 1
+        self._lastDispatchedId = event['id']
+        self._lastDispatchedTime = event.get('created_at')
+
+    def observeFetch(self, duration, page):
+        self._fetchLatency.observe(duration)
+        if page:
+            self._headEventId = max(self._headEventId, page[-1]['id'])
+
+    def setServerHead(self, eventId):
+        self._serverHeadId = eventId
+
+    def fetchFailed(self):
+        self._fetchErrors += 1
+
+    def moduleReloaded(self):
+        self._moduleReloads += 1
+
+    def observeCallback(self, name, duration, success):
+        histogram = self._callbackLatency.get(name)
+        if histogram is None:
+            histogram = self._callbackLatency.setdefault(name, Histogram())
+        histogram.observe(duration)
+        if not success:
+            self._callbackErrors[name] = self._callbackErrors.get(name, 0) + 1
+
+    def render(self, processedEventId, gauges):
+        p = self.PREFIX
+        lines = []
+
+        # The lag is measured against the newest event on the server, or the
+        # newest event fetched when that is newer.
+        headEventId = max(self._headEventId, self._serverHeadId)
+        lagEvents = 0
+        if headEventId is not None and processedEventId is not None:
+            lagEvents = max(headEventId - processedEventId, 0)
+        lagSeconds = 0.0
+        if self._lastDispatchedId is not None and self._lastDispatchedId < headEventId:
+            lagSeconds = max(time.time() - _toTimestamp(self._lastDispatchedTime), 0.0)
+
+        lines.append('# TYPE %slag_events gauge' % p)
+        lines.append('%slag_events %d' % (p, lagEvents))
+        lines.append('# TYPE %slag_seconds gauge' % p)
+        lines.append('%slag_seconds %f' % (p, lagSeconds))
+        lines.append('# TYPE %shead_event_id gauge' % p)
+        lines.append('%shead_event_id %d' % (p, headEventId or 0))
+        for name, value in sorted(gauges.items()):
+            name = re.sub('([A-Z])', r'_\1', name).lower()
+            lines.append('# TYPE %s%s gauge' % (p, name))
+            lines.append('%s%s %s' % (p, name, value or 0))
+
+        lines.append('# TYPE %sevents_dispatched_total counter' % p)
+        lines.append('%sevents_dispatched_total %d' % (p, self._eventsDispatched))
+        lines.append('# TYPE %sfetch_errors_total counter' % p)
+        lines.append('%sfetch_errors_total %d' % (p, self._fetchErrors))
+        lines.append('# TYPE %smodule_reloads_total counter' % p)
+        lines.append('%smodule_reloads_total %d' % (p, self._moduleReloads))
+
+        lines.append('# TYPE %sfetch_duration_seconds histogram' % p)
+        lines.extend(self._fetchLatency.render(p + 'fetch_duration_seconds'))
+
+        lines.append('# TYPE %scallback_duration_seconds histogram' % p)
+        for name, histogram in sorted(self._callbackLatency.items()):
+            lines.extend(histogram.render(p + 'callback_duration_seconds', 'callback="%s",' % name))
+
+        lines.append('# TYPE %scallback_errors_total counter' % p)
+        for name, count in sorted(self._callbackErrors.items()):
+            lines.append('%scallback_errors_total{callback="%s"} %d' % (p, name, count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _toTimestamp(value):
+    if value is None:
+        return time.time()
+    if isinstance(value, (int, long, float)):
+        return value
+    if value.tzinfo is not None:
+        return calendar.timegm(value.utctimetuple())
+    return time.mktime(value.timetuple())
+
+
+class MetricsServer(object):
+    def __init__(self, host, port, render):
+        self._server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+        self._server.render = render
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='MetricsServer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        logging.info('Serving metrics on http://%s:%d/metrics', *self._server.server_address)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        try:
+            body = self.server.render()
+        except Exception, e:
+            logging.error('Could not render metrics.\n\n%s', traceback.format_exc(e))
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics request from %s: %s', self.client_address[0], format % args)
+
+
+class Profiler(object):
+    # Takes a profile of the running daemon when requested. The stacks of all
+    # threads are sampled every interval seconds for duration seconds, which
+    # costs little and leaves the daemon processing events all along. The
+    # report tells, for each thread, the share of time spent in each phase of
+    # event processing, the run times of the callbacks and the functions most
+    # of the samples were taken in.
+    PHASES = {
+        '_getNewEvents': 'fetch events',
+        '_fetchPages': 'fetch events',
+        '_fetchPage': 'fetch events',
+        '_fetchTask': 'fetch events',
+        '_recoverGaps': 'fetch late events',
+        '_queryLateEvents': 'fetch late events',
+        'load': 'load plugins',
+        '_dispatchEvent': 'dispatch',
+        '_dispatchTask': 'dispatch',
+        '_flushBatches': 'dispatch batches',
+        '_runCallback': 'run callbacks',
+        '_runCallbackAsync': 'run callbacks',
+        '_replaySkipped': 'replay skipped events',
+        '_saveEventId': 'checkpoint',
+        '_saveCompletedEventId': 'checkpoint',
+        '_checkpointTask': 'checkpoint',
+        '_sleep': 'sleep',
+    }
+
+    # Phases left out of the function report.
+    IDLE_PHASES = ('sleep', 'waiting')
+
+    # Threads whose innermost frames are in these modules are blocked on a
+    # lock or a queue, or are an event loop with nothing to do.
+    WAITING_MODULES = ('threading', 'Queue', 'selectors')
+
+    def __init__(self, path, duration=60.0, interval=0.01):
+        self._path = path
+        self._duration = duration
+        self._interval = max(interval, 0.001)
+        self._filename = sys._getframe().f_code.co_filename
+        self._requested = threading.Event()
+        self._finished = threading.Event()
+        self._profiling = False
+        self._stopping = False
+        self._callbacks = {}
+        self._thread = threading.Thread(target=self._run, name='Profiler')
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+
+    def request(self):
+        # A new profile is not finished until its report is written.
+        self._finished.clear()
+        self._requested.set()
+
+    def stop(self):
+        # A profile being taken when the daemon stops is cut short but its
+        # report is still written.
+        self._stopping = True
+        if self._requested.isSet():
+            self._finished.wait(10)
+
+    def isProfiling(self):
+        return self._profiling
+
+    def observeCallback(self, name, duration):
+        # Called from the threads running callbacks, like the metrics a very
+        # rare missed update is fine.
+        stats = self._callbacks.get(name)
+        if stats is None:
+            stats = self._callbacks.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+
+    def _run(self):
+        while True:
+            self._requested.wait()
+            path = '%s-%s.txt' % (self._path, time.strftime('%Y%m%d-%H%M%S'))
+            logging.info('Profiling for %gs, the report will be written to %s.', self._duration, path)
+            try:
+                self._profile(path)
+            except Exception, e:
+                logging.error('Could not profile the daemon.\n\n%s', traceback.format_exc(e))
+            # Requests made while profiling are served by this profile.
+            self._requested.clear()
+            self._finished.set()
+
+    def _profile(self, path):
+        self._callbacks = {}
+        self._profiling = True
+        phases = {}
+        threadSamples = {}
+        own = {}
+        cumulated = {}
+        samples = 0
+        start = time.time()
+        try:
+            while not self._stopping and time.time() - start < self._duration:
+                self._sample(phases, threadSamples, own, cumulated)
+                samples += 1
+                time.sleep(self._interval)
+        finally:
+            self._profiling = False
+        end = time.time()
+        callbacks = self._callbacks
+
+        lines = ['Profile from %s to %s, %d samples taken every %gs.' % (_formatTime(start), _formatTime(end), samples, self._interval)]
+
+        lines.extend(['', 'Time spent per thread and phase', '%8s %7s  %-20s %s' % ('samples', '%', 'thread', 'phase')])
+        for (thread, phase), count in sorted(phases.items(), key=lambda i: (i[0][0], -i[1])):
+            lines.append('%8d %6.1f%%  %-20s %s' % (count, 100.0 * count / threadSamples[thread], thread, phase))
+
+        lines.extend(['', 'Callbacks', '%8s %10s %10s %10s  %s' % ('runs', 'total', 'mean', 'max', 'callback')])
+        for name, (runs, total, longest) in sorted(callbacks.items(), key=lambda i: -i[1][1]):
+            lines.append('%8d %9.3fs %9.4fs %9.3fs  %s' % (runs, total, total / runs, longest, name))
+
+        busy = sum([c for (thread, phase), c in phases.items() if phase not in self.IDLE_PHASES]) or 1
+        lines.extend(['', 'Functions most busy samples were taken in, themselves and with the functions they called',
+            '%8s %7s %8s %7s  %s' % ('own', '%', 'cumul', '%', 'function')])
+        for key, count in sorted(own.items(), key=lambda i: -i[1])[:40]:
+            lines.append('%8d %6.1f%% %8d %6.1f%%  %s:%d(%s)' % (count, 100.0 * count / busy, cumulated[key], 100.0 * cumulated[key] / busy, key[0], key[1], key[2]))
+        lines.append('')
+        for key, count in sorted(cumulated.items(), key=lambda i: -i[1])[:40]:
+            lines.append('%8d %6.1f%% %8d %6.1f%%  %s:%d(%s)' % (own.get(key, 0), 100.0 * own.get(key, 0) / busy, count, 100.0 * count / busy, key[0], key[1], key[2]))
+
+        fh = open(path, 'w')
+        try:
+            fh.write('\n'.join(lines) + '\n')
+        finally:
+            fh.close()
+        logging.info('Profile written to %s.', path)
+
+    def _sample(self, phases, threadSamples, own, cumulated):
+        # Threads are known by their name without any number, so the workers
+        # of a pool are counted together.
+        names = {}
+        for thread in threading.enumerate():
+            names[thread.ident] = re.match('[A-Za-z]*', thread.name).group() or thread.name
+        myIdent = threading.current_thread().ident
+
+        for ident, frame in sys._current_frames().items():
+            if ident == myIdent:
+                continue
+            stack = []
+            phase = None
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                if phase is None and code.co_filename == self._filename:
+                    phase = self.PHASES.get(code.co_name)
+                frame = frame.f_back
+            if phase is None:
+                if [f for f, l, n in stack[:2] if os.path.basename(f).split('.')[0] in self.WAITING_MODULES]:
+                    phase = 'waiting'
+                elif [n for f, l, n in stack if n == '_run_once']:
+                    # Coroutines run by the event loop of the async engine.
+                    phase = 'event loop'
+                else:
+                    phase = 'other'
+
+            thread = names.get(ident, str(ident))
+            threadSamples[thread] = threadSamples.get(thread, 0) + 1
+            phases[(thread, phase)] = phases.get((thread, phase), 0) + 1
+            if phase in self.IDLE_PHASES:
+                continue
+            own[stack[0]] = own.get(stack[0], 0) + 1
+            for key in set(stack):
+                cumulated[key] = cumulated.get(key, 0) + 1
+
+
+class GapTracker(object):
+    def __init__(self, ttl=300.0, checkInterval=30.0, batchSize=100, maxIds=1000):
+        self._ttl = ttl
+        self._checkInterval = checkInterval
+        self._batchSize = max(batchSize, 1)
+        self._maxIds = maxIds
+        # Missing event id -> time it was found missing.
+        self._gaps = {}
+        self._lastCheck = time.time()
+
+    def observe(self, previousId, eventId):
+        if previousId is None or eventId <= previousId + 1:
+            return
+
+        missing = eventId - previousId - 1
+        if len(self._gaps) + missing > self._maxIds:
+            logging.debug('Not tracking the %d ids missing between events %d and %d.', missing, previousId, eventId)
+            return
+
+        now = time.time()
+        for eid in xrange(previousId + 1, eventId):
+            self._gaps[eid] = now
+
+    def isDue(self):
+        return bool(self._gaps) and time.time() - self._lastCheck >= self._checkInterval
+
+    def getBatches(self):
+        self._lastCheck = time.time()
+
+        expired = [eid for eid, seen in self._gaps.items() if self._lastCheck - seen >= self._ttl]
+        for eid in expired:
+            del self._gaps[eid]
+
+        ids = sorted(self._gaps)
+        return [ids[i:i + self._batchSize] for i in range(0, len(ids), self._batchSize)]
+
+    def fill(self, ids):
+        for eid in ids:
+            self._gaps.pop(eid, None)
+
+    def __len__(self):
+        return len(self._gaps)
+
+
+class CircuitBreaker(object):
+    # Quarantines a callback that went over its time budget maxOverruns times
+    # or failed on at least failureRate of its runs (out of minRuns or more)
+    # within window seconds. A quarantined callback is given a single trial
+    # run after a delay that doubles each time the trial does not go well.
+    CLOSED, OPEN, TRIAL = range(3)
+
+    def __init__(self, maxOverruns=3, failureRate=0.5, minRuns=10, window=60.0, backoff=30.0, maxBackoff=3600.0):
+        self._maxOverruns = maxOverruns
+        self._failureRate = failureRate
+        self._minRuns = max(minRuns, 1)
+        self._window = window
+        self._backoff = backoff
+        self._maxBackoff = max(maxBackoff, backoff)
+        self._lock = threading.Lock()
+        # (time, failed, overran) for the runs within the window.
+        self._runs = collections.deque()
+        self._failures = 0
+        self._overruns = 0
+        self._state = self.CLOSED
+        self._delay = backoff
+        self._retryTime = None
+        self._trips = 0
+
+    def isOpen(self):
+        return self._state != self.CLOSED
+
+    def getDelay(self):
+        return self._delay
+
+    def getTrips(self):
+        return self._trips
+
+    def isTrialDue(self):
+        return self._state == self.OPEN and time.time() >= self._retryTime
+
+    def allow(self):
+        if self._state == self.CLOSED:
+            return True
+        self._lock.acquire()
+        try:
+            if self._state == self.OPEN and time.time() >= self._retryTime:
+                self._state = self.TRIAL
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def record(self, success, overran):
+        # Returns the new state when the run changed it.
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self._state == self.TRIAL:
+                if success:
+                    self._state = self.CLOSED
+                    self._delay = self._backoff
+                    self._trips = 0
+                    self._runs.clear()
+                    self._failures = self._overruns = 0
+                    return self.CLOSED
+                self._delay = min(self._delay * 2, self._maxBackoff)
+                return self._open(now)
+            if self._state == self.OPEN:
+                # A run that started before the quarantine.
+                return None
+
+            run = (now, not success, overran)
+            self._runs.append(run)
+            self._failures += run[1]
+            self._overruns += run[2]
+            while self._runs[0][0] < now - self._window:
+                run = self._runs.popleft()
+                self._failures -= run[1]
+                self._overruns -= run[2]
+
+            if self._maxOverruns > 0 and self._overruns >= self._maxOverruns:
+                return self._open(now)
+            if self._failureRate > 0 and len(self._runs) >= self._minRuns and self._failures >= self._failureRate * len(self._runs):
+                return self._open(now)
+            return None
+        finally:
+            self._lock.release()
+
+    def _open(self, now):
+        self._state = self.OPEN
+        self._retryTime = now + self._delay
+        self._trips += 1
+        return self.OPEN
+
+
+class Checkpoint(object):
+    def __init__(self, path, maxEvents=100, maxSeconds=5.0, maxSkipped=100000):
+        self._path = path
+        self._maxEvents = maxEvents
+        self._maxSeconds = maxSeconds
+        self._eventId = None
+        # Cursors of the callbacks that are not at the event id above.
+        self._cursors = {}
+        # Sorted ids of the events each callback skipped, kept in a file next
+        # to the event id file.
+        self._skipped = {}
+        self._maxSkipped = maxSkipped
+        self._skippedDirty = False
+        self._dirty = False
+        self._pending = 0
+        self._lastFlush = time.time()
+        self._lock = threading.Lock()
+
+    def load(self):
+        self._loadSkipped()
+        if self._path is None or not os.path.exists(self._path):
+            return None
+
+        try:
+            fh = open(self._path)
+            try:
+                lines = fh.read().splitlines()
+            finally:
+                fh.close()
+        except (IOError, OSError), e:
+            logging.error('Could not load event id from file.\n\n%s', traceback.format_exc(e))
+            return None
+
+        if not lines or not lines[0].strip().isdigit():
+            return None
+
+        self._eventId = int(lines[0].strip())
+        for line in lines[1:]:
+            parts = line.rsplit(' ', 1)
+            if len(parts) == 2 and parts[1].isdigit():
+                self._cursors[parts[0]] = int(parts[1])
+        return self._eventId
+
+    def _loadSkipped(self):
+        if self._path is None or not os.path.exists(self._path + '.skipped'):
+            return
+
+        try:
+            fh = open(self._path + '.skipped')
+            try:
+                lines = fh.read().splitlines()
+            finally:
+                fh.close()
+        except (IOError, OSError), e:
+            logging.error('Could not load skipped events from file.\n\n%s', traceback.format_exc(e))
+            return
+
+        for line in lines:
+            parts = line.split()
+            ids = [int(p) for p in parts[1:] if p.isdigit()]
+            if ids:
+                self._skipped[parts[0]] = sorted(set(ids))
+
+    def getCursors(self):
+        self._lock.acquire()
+        try:
+            return dict(self._cursors)
+        finally:
+            self._lock.release()
+
+    def setCursor(self, name, eventId):
+        self._lock.acquire()
+        try:
+            if self._cursors.get(name) != eventId:
+                self._cursors[name] = eventId
+                self._dirty = True
+                self._pending += 1
+        finally:
+            self._lock.release()
+
+    def removeCursor(self, name):
+        self._lock.acquire()
+        try:
+            if name in self._cursors:
+                del self._cursors[name]
+                self._dirty = True
+                self._pending += 1
+        finally:
+            self._lock.release()
+
+    def addSkipped(self, name, ids):
+        self._lock.acquire()
+        try:
+            skipped = self._skipped.setdefault(name, [])
+            wasFull = len(skipped) >= self._maxSkipped
+            for eventId in ids:
+                i = bisect.bisect_left(skipped, eventId)
+                if i == len(skipped) or skipped[i] != eventId:
+                    skipped.insert(i, eventId)
+            dropped = len(skipped) - self._maxSkipped
+            if self._maxSkipped and dropped > 0:
+                del skipped[:dropped]
+            self._skippedDirty = True
+            self._pending += 1
+        finally:
+            self._lock.release()
+
+        if self._maxSkipped and dropped > 0 and not wasFull:
+            logging.warning('Callback %s has skipped more than %d events, the oldest ones are no longer recorded.', name, self._maxSkipped)
+
+    def getSkipped(self, name, afterId=0, limit=100):
+        self._lock.acquire()
+        try:
+            skipped = self._skipped.get(name) or []
+            i = bisect.bisect_right(skipped, afterId)
+            return skipped[i:i + limit]
+        finally:
+            self._lock.release()
+
+    def removeSkipped(self, name, ids):
+        self._lock.acquire()
+        try:
+            skipped = self._skipped.get(name) or []
+            for eventId in ids:
+                i = bisect.bisect_left(skipped, eventId)
+                if i < len(skipped) and skipped[i] == eventId:
+                    del skipped[i]
+            if not skipped:
+                self._skipped.pop(name, None)
+            self._skippedDirty = True
+            self._pending += 1
+        finally:
+            self._lock.release()
+
+    def getSkippedCounts(self):
+        self._lock.acquire()
+        try:
+            return dict([(name, len(ids)) for name, ids in self._skipped.items()])
+        finally:
+            self._lock.release()
+
+    def update(self, eventId):
+        # Cursors and skipped events are updated from other threads.
+        self._lock.acquire()
+        try:
+            if eventId != self._eventId:
+                self._eventId = eventId
+                self._dirty = True
+            self._pending += 1
+            due = self._maxEvents and self._pending >= self._maxEvents
+        finally:
+            self._lock.release()
+        if due:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        if self._pending and time.time() - self._lastFlush >= self._maxSeconds:
+            self.flush()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._pending = 0
+            self._lastFlush = time.time()
+
+            if self._path is None:
+                return
+
+            skippedLines = None
+            if self._skippedDirty:
+                self._skippedDirty = False
+                skippedLines = ['%s %s' % (name, ' '.join([str(i) for i in ids])) for name, ids in sorted(self._skipped.items())]
+
+            lines = None
+            if self._eventId is not None and self._dirty:
+                self._dirty = False
+                lines = ['%d' % self._eventId]
+                for name, eventId in sorted(self._cursors.items()):
+                    lines.append('%s %d' % (name, eventId))
+        finally:
+            self._lock.release()
+
+        # The skipped events are written first so the event id is never
+        # saved past an event that was skipped without it being recorded.
+        if skippedLines is not None:
+            self._write(self._path + '.skipped', skippedLines)
+        if lines is not None:
+            self._write(self._path, lines)
+
+    def _write(self, path, lines):
+        # Write to a temporary file next to the real one and rename it into
+        # place so a crash can never leave a partially written file.
+        tmpPath = path + '.tmp'
+        try:
+            fh = open(tmpPath, 'w')
+            try:
+                fh.write(''.join([line + '\n' for line in lines]))
+                fh.flush()
+                os.fsync(fh.fileno())
+            finally:
+                fh.close()
+            os.rename(tmpPath, path)
+        except (IOError, OSError), e:
+            logging.error('Can not write to %s.\n\n%s', path, traceback.format_exc(e))
+
+
+class EventJournal(object):
+    # An append-only local copy of the event stream, in segments named after
+    # the event id they follow. A segment holds every event after that id up
+    # to its last one, so a read is answered from the journal only when it
+    # starts within a segment. Each segment has an index of fixed size
+    # (event id, offset) entries that is searched in place through mmap.
+    # Late events are not journaled, they are looked for on the server like
+    # any other gap.
+    INDEX_ENTRY = struct.Struct('<QQ')
+    RECORD_HEADER = struct.Struct('<I')
+
+    def __init__(self, path, segmentSize=64 * 1024 * 1024, maxSize=1024 * 1024 * 1024, maxAge=7 * 86400):
+        self._path = path
+        self._segmentSize = segmentSize
+        self._maxSize = maxSize
+        self._maxAge = maxAge
+        self._data = None
+        self._index = None
+        self._afterId = None
+        self._lastId = None
+
+    def _getSegments(self):
+        # Sorted (after id, base path) of the segments, read again every time
+        # since other processes may write or prune the journal.
+        segments = []
+        if not os.path.isdir(self._path):
+            return segments
+        for basename in os.listdir(self._path):
+            name, ext = os.path.splitext(basename)
+            if ext == '.index' and name.isdigit():
+                segments.append((int(name), os.path.join(self._path, name)))
+        segments.sort()
+        return segments
+
+    def read(self, afterId, limit=0, maxId=None):
+        # Returns the events after afterId and the id up to which they are
+        # all the events there are, or None when the journal does not have
+        # the events right after afterId.
+        segments = self._getSegments()
+        i = bisect.bisect_right([segmentAfterId for segmentAfterId, basePath in segments], afterId) - 1
+        if i < 0:
+            return [], None
+
+        events = []
+        coveredId = None
+        while i < len(segments):
+            segmentEvents, lastId = self._readSegment(segments[i][1], afterId, limit and limit - len(events), maxId)
+            if lastId is None or lastId <= afterId:
+                break
+            events.extend(segmentEvents)
+            if limit and len(events) >= limit:
+                return events, events[-1]['id']
+            if maxId is not None and lastId >= maxId:
+                return events, maxId
+            coveredId = lastId
+
+            # Carry on in the next segment only if it follows this one.
+            i += 1
+            if i >= len(segments) or segments[i][0] > lastId:
+                break
+            afterId = lastId
+        return events, coveredId
+
+    def _readSegment(self, basePath, afterId, limit, maxId):
+        try:
+            indexFile = open(basePath + '.index', 'rb')
+        except IOError:
+            # Pruned since it was listed.
+            return [], None
+        try:
+            count = os.fstat(indexFile.fileno()).st_size // self.INDEX_ENTRY.size
+            if not count:
+                return [], None
+            index = mmap.mmap(indexFile.fileno(), count * self.INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+        finally:
+            indexFile.close()
+
+        try:
+            lastId = self.INDEX_ENTRY.unpack_from(index, (count - 1) * self.INDEX_ENTRY.size)[0]
+
+            # First entry after afterId.
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.INDEX_ENTRY.unpack_from(index, mid * self.INDEX_ENTRY.size)[0] <= afterId:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == count:
+                return [], lastId
+
+            dataFile = open(basePath + '.events', 'rb')
+            try:
+                data = mmap.mmap(dataFile.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                dataFile.close()
+            try:
+                events = []
+                for i in xrange(lo, count):
+                    eventId, offset = self.INDEX_ENTRY.unpack_from(index, i * self.INDEX_ENTRY.size)
+                    if maxId is not None and eventId > maxId:
+                        break
+                    length = self.RECORD_HEADER.unpack_from(data, offset)[0]
+                    start = offset + self.RECORD_HEADER.size
+                    events.append(cPickle.loads(data[start:start + length]))
+                    if limit and len(events) >= limit:
+                        return events, events[-1]['id']
+                return events, lastId
+            finally:
+                data.close()
+        finally:
+            index.close()
+
+    def append(self, afterId, events):
+        if not events:
+            return
+        if self._data is None:
+            self._openLastSegment()
+
+        if self._lastId is not None and afterId <= self._lastId:
+            # Events the journal has already.
+            events = [e for e in events if e['id'] > self._lastId]
+            if not events:
+                return
+            afterId = self._lastId
+        if self._lastId is None or afterId > self._lastId or self._data.tell() >= self._segmentSize:
+            self._startSegment(afterId)
+
+        # The index is written after the events it points to so readers
+        # never see an entry for an event that is not there yet.
+        offset = self._data.tell()
+        entries = []
+        for event in events:
+            payload = cPickle.dumps(event, cPickle.HIGHEST_PROTOCOL)
+            self._data.write(self.RECORD_HEADER.pack(len(payload)))
+            self._data.write(payload)
+            entries.append(self.INDEX_ENTRY.pack(event['id'], offset))
+            offset += self.RECORD_HEADER.size + len(payload)
+        self._data.flush()
+        self._index.write(''.join(entries))
+        self._index.flush()
+        self._lastId = events[-1]['id']
+
+    def _openLastSegment(self):
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+        segments = self._getSegments()
+        if not segments:
+            return
+        afterId, basePath = segments[-1]
+        self._open(afterId, basePath)
+
+        # An entry cut short by a crash is dropped.
+        size = os.path.getsize(basePath + '.index')
+        count = size // self.INDEX_ENTRY.size
+        if size != count * self.INDEX_ENTRY.size:
+            self._index.truncate(count * self.INDEX_ENTRY.size)
+        self._lastId = afterId
+        if count:
+            self._index.seek((count - 1) * self.INDEX_ENTRY.size)
+            self._lastId = self.INDEX_ENTRY.unpack(self._index.read(self.INDEX_ENTRY.size))[0]
+        self._index.seek(0, os.SEEK_END)
+        self.prune()
+
+    def _startSegment(self, afterId):
+        self.close()
+        self._open(afterId, os.path.join(self._path, '%020d' % afterId))
+        self._lastId = afterId
+        self.prune()
+
+    def _open(self, afterId, basePath):
+        self._data = open(basePath + '.events', 'ab')
+        self._data.seek(0, os.SEEK_END)
+        self._index = open(basePath + '.index', 'a+b')
+        self._afterId = afterId
+
+    def prune(self):
+        # Drop the oldest segments while the journal is too big or they are
+        # too old, never the one being written.
+        segments = self._getSegments()
+        sizes = []
+        for afterId, basePath in segments:
+            try:
+                stat = os.stat(basePath + '.events')
+                sizes.append((afterId, basePath, stat.st_size, stat.st_mtime))
+            except OSError:
+                pass
+        total = sum([size for afterId, basePath, size, mtime in sizes])
+        now = time.time()
+        for afterId, basePath, size, mtime in sizes:
+            if afterId == self._afterId:
+                break
+            if (not self._maxSize or total <= self._maxSize) and (not self._maxAge or now - mtime <= self._maxAge):
+                break
+            for ext in ('.index', '.events'):
+                try:
+                    os.unlink(basePath + ext)
+                except OSError:
+                    pass
+            total -= size
+            logging.info('Removed journal segment %s.', basePath)
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = None
+            self._index = None
+
+
+def _getJournal(config, path):
+    megabyte = 1024 * 1024
+    return EventJournal(
+        path,
+        config.getOptionalInt('journal', 'segmentSize', 64) * megabyte,
+        config.getOptionalInt('journal', 'maxSize', 1024) * megabyte,
+        config.getOptionalFloat('journal', 'maxAge', 7.0) * 86400,
+    )
+
+
+class ShardLock(object):
+    # Each shard is owned by the instance holding the lock on its lock file.
+    # The lock goes away with the process holding it so the shard of a dead
+    # instance can be taken over right away by one that is waiting.
+    def __init__(self, lockDir, shardCount):
+        self._lockDir = lockDir
+        self._shardCount = shardCount
+        self._fh = None
+        self._shardId = None
+
+    def getPath(self, shardId):
+        return os.path.join(self._lockDir, 'shotgunEventDaemon.shard%d.lock' % shardId)
+
+    def acquire(self, preferredId=None, retryInterval=5.0, checkContinue=None):
+        # The preferred shard is tried first, then any other one, until one
+        # is free or checkContinue says to stop waiting.
+        order = range(self._shardCount)
+        if preferredId is not None:
+            order.remove(preferredId)
+            order.insert(0, preferredId)
+
+        waiting = False
+        while True:
+            for shardId in order:
+                if self.tryAcquire(shardId):
+                    return shardId
+            if not waiting:
+                logging.info('All %d shards are taken, waiting for one to be free.', self._shardCount)
+                waiting = True
+            if checkContinue is not None and not checkContinue():
+                return None
+            time.sleep(retryInterval)
+
+    def tryAcquire(self, shardId):
+        fh = open(self.getPath(shardId), 'a+')
+        try:
+            fcntl.lockf(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            fh.close()
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+
+        # Who holds the shard is written in the file for the curious.
+        fh.truncate(0)
+        fh.write('%s %d\n' % (os.uname()[1], os.getpid()))
+        fh.flush()
+        self._fh = fh
+        self._shardId = shardId
+        return True
+
+    def getShardId(self):
+        return self._shardId
+
+    def release(self):
+        if self._fh is not None:
+            fcntl.lockf(self._fh, fcntl.LOCK_UN)
+            self._fh.close()
+            self._fh = None
+            self._shardId = None
+
+
+class PluginCache(object):
+    # Compiled plugin sources and the callbacks plugins registered, kept on
+    # disk and used for as long as the plugin source does not change.
+    MAGIC = imp.get_magic()
+    HEADER = struct.Struct('<dq')
+
+    def __init__(self, path):
+        self._path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _getBasePath(self, sourcePath):
+        name = os.path.splitext(os.path.basename(sourcePath))[0]
+        return os.path.join(self._path, '%s-%08x' % (name, zlib.crc32(os.path.abspath(sourcePath)) & 0xffffffff))
+
+    def getCode(self, sourcePath):
+        stat = os.stat(sourcePath)
+        cachePath = self._getBasePath(sourcePath) + '.pyc'
+        try:
+            fh = open(cachePath, 'rb')
+            try:
+                data = fh.read()
+            finally:
+                fh.close()
+            if data[:4] == self.MAGIC and self.HEADER.unpack_from(data, 4) == (stat.st_mtime, stat.st_size):
+                return marshal.loads(data[4 + self.HEADER.size:])
+        except (IOError, struct.error, EOFError, ValueError, TypeError):
+            pass
+
+        code = _compileSource(sourcePath)
+        self._write(cachePath, self.MAGIC + self.HEADER.pack(stat.st_mtime, stat.st_size) + marshal.dumps(code))
+        return code
+
+    def getRegistrations(self, sourcePath):
+        stat = os.stat(sourcePath)
+        try:
+            fh = open(self._getBasePath(sourcePath) + '.json')
+            try:
+                data = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+        if data.get('mtime') != stat.st_mtime or data.get('size') != stat.st_size:
+            return None
+        return data.get('callbacks')
+
+    def setRegistrations(self, sourcePath, registrations):
+        stat = os.stat(sourcePath)
+        data = {'mtime': stat.st_mtime, 'size': stat.st_size, 'callbacks': registrations}
+        self._write(self._getBasePath(sourcePath) + '.json', json.dumps(data))
+
+    def _write(self, path, data):
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            fh = open(tmpPath, 'wb')
+            try:
+                fh.write(data)
+            finally:
+                fh.close()
+            os.rename(tmpPath, path)
+        except (IOError, OSError), e:
+            logging.warning('Could not write plugin cache file %s: %s', path, e)
+
+
+def _compileSource(path):
+    fh = open(path, 'rU')
+    try:
+        source = fh.read()
+    finally:
+        fh.close()
+    return compile(source + '\n', path, 'exec')
+
+
+class Module(object):
+    def __init__(self, server, path, connectionPool, cache=None, lazy=False, timeout=0.0):
+        self._server = server
+        self._path = path
+        self._connectionPool = connectionPool
+        self._cache = cache
+        # The time budget of the callbacks that do not register one.
+        self._timeout = timeout
+        self._callbacks = []
+        self._mtime = None
+        self._lazy = False
+        self._lock = threading.RLock()
+        self._loadTimes = None
+        self.load(lazy)
+
+    def getName(self):
+        return os.path.splitext(os.path.basename(self._path))[0]
+
+    def getPath(self):
+        return self._path
+
+    def getMtime(self):
+        return self._mtime
+
+    def isLazy(self):
+        return self._lazy
+
+    def getLoadTimes(self):
+        # Seconds spent importing the module and registering its callbacks
+        # the last time it was loaded.
+        return self._loadTimes
+
+    def load(self, lazy=False):
+        dirname, basename = os.path.split(self._path)
+        moduleName = os.path.splitext(basename)[0]
+
+        mtime = os.path.getmtime(self._path)
+        if self._mtime is not None and self._mtime >= mtime:
+            return False
+
+        self._lock.acquire()
+        try:
+            # A module whose callbacks are known from an earlier run is only
+            # imported once one of them has an event to process.
+            registrations = lazy and self._cache is not None and self._cache.getRegistrations(self._path)
+            if registrations:
+                logging.info('Loading module at %s lazily', self._path)
+                self._mtime = mtime
+                self._callbacks = [LazyCallback(self, registration) for registration in registrations]
+                self._lazy = True
+                self._loadTimes = (0.0, 0.0)
+            elif self._mtime is None:
+                self._load(moduleName, mtime, 'Loading module at %s' % self._path)
+            else:
+                self._load(moduleName, mtime, 'Reloading module at %s' % self._path)
+        finally:
+            self._lock.release()
+        return True
+
+    def realize(self):
+        self._lock.acquire()
+        try:
+            if self._lazy:
+                self._load(self.getName(), self._mtime, 'Importing module at %s for its first event' % self._path)
+        finally:
+            self._lock.release()
+
+    def getCallback(self, name):
+        self.realize()
+        for callback in self._callbacks:
+            if callback.getName() == name:
+                return callback
+        return None
+
+    def _load(self, moduleName, mtime, message):
+        logging.info(message)
+        self._mtime = mtime
+        self._callbacks = []
+        self._lazy = False
+        self._loadTimes = None
+
+        start = time.time()
+        try:
+            module = self._import(moduleName)
+        except Exception, e:
+            logging.error('Could not load the module at %s.\n\n%s', self._path, traceback.format_exc(e))
+            return
+        imported = time.time()
+
+        regFunc = getattr(module, 'registerCallbacks', None)
+        if isinstance(regFunc, types.FunctionType):
+            try:
+                regFunc(Registrar(self))
+            except Exception, e:
+                logging.error('Error running register callback function from module at %s.\n\n%s', self._path, traceback.format_exc(e))
+            else:
+                if self._cache is not None:
+                    self._cache.setRegistrations(self._path, [c.getRegistration() for c in self._callbacks])
+        else:
+            logging.error('Did not find a registerCallbacks function in module at %s.', self._path)
+        self._loadTimes = (imported - start, time.time() - imported)
+
+    def _import(self, moduleName):
+        # The module is run from cached byte code when there is some, like
+        # imp.load_source does. The plugin module itself is not imported under
+        # the import lock, but the imports it makes still take it, so plugins
+        # that import heavy libraries load one after the other.
+        if self._cache is not None:
+            code = self._cache.getCode(self._path)
+        else:
+            code = _compileSource(self._path)
+        module = imp.new_module(moduleName)
+        module.__file__ = self._path
+        sys.modules[moduleName] = module
+        exec code in module.__dict__
+        return module
+
+    def registerCallback(self, sgScriptName, sgScriptKey, callback, args=None, eventTypes=None, entityTypes=None, attributeNames=None, ordered=False, eventFields=None, entityFields=None, timeout=None):
+        name = self._getCallbackName(callback)
+        if timeout is None:
+            timeout = self._timeout
+        self._callbacks.append(Callback(self._connectionPool, self._server, sgScriptName, sgScriptKey, callback, args, eventTypes, entityTypes, attributeNames, ordered, name, eventFields, entityFields, timeout))
+
+    def registerBatchCallback(self, sgScriptName, sgScriptKey, callback, args=None, eventTypes=None, entityTypes=None, attributeNames=None, eventFields=None, entityFields=None, window=5.0, coalesce=None, maxEvents=1000, timeout=None):
+        name = self._getCallbackName(callback)
+        if timeout is None:
+            timeout = self._timeout
+        self._callbacks.append(BatchCallback(self._connectionPool, self._server, sgScriptName, sgScriptKey, callback, args, eventTypes, entityTypes, attributeNames, name, eventFields, entityFields, window, coalesce, maxEvents, timeout))
+
+    def _getCallbackName(self, callback):
+        # Callbacks are known by a name that is stable across reloads and
+        # restarts so their cursors can be kept.
+        name = '%s.%s' % (self.getName(), getattr(callback, '__name__', callback.__class__.__name__))
+        names = set([c.getName() for c in self._callbacks])
+        if name in names:
+            i = 2
+            while '%s.%d' % (name, i) in names:
+                i += 1
+            name = '%s.%d' % (name, i)
+        return name
+
+    def __iter__(self):
+        return self._callbacks.__iter__()
+
+
+class Registrar(object):
+    def __init__(self, module):
+        self._module = module
+
+    def registerCallback(self, sgScriptName, sgScriptKey, callback, args=None, eventTypes=None, entityTypes=None, attributeNames=None, ordered=False, eventFields=None, entityFields=None, timeout=None):
+        self._module.registerCallback(sgScriptName, sgScriptKey, callback, args, eventTypes, entityTypes, attributeNames, ordered, eventFields, entityFields, timeout)
+
+    def registerBatchCallback(self, sgScriptName, sgScriptKey, callback, args=None, eventTypes=None, entityTypes=None, attributeNames=None, eventFields=None, entityFields=None, window=5.0, coalesce=None, maxEvents=1000, timeout=None):
+        self._module.registerBatchCallback(sgScriptName, sgScriptKey, callback, args, eventTypes, entityTypes, attributeNames, eventFields, entityFields, window, coalesce, maxEvents, timeout)
+
+
+class DispatchTable(object):
+    # Bound on the number of distinct (event type, entity type, attribute)
+    # keys remembered. In practice this is bounded by the site schema.
+    MAX_KEYS = 10000
+
+    def __init__(self, modules):
+        self._callbacks = []
+        for module in modules:
+            self._callbacks.extend(module)
+
+        # Callbacks with exact event types are indexed on them, the others are
+        # matched against every new event type they see.
+        self._byEventType = {}
+        self._anyEventType = []
+        for callback in self._callbacks:
+            exactTypes = callback.getExactEventTypes()
+            if exactTypes is None:
+                self._anyEventType.append(callback)
+            else:
+                for eventType in exactTypes:
+                    self._byEventType.setdefault(eventType, []).append(callback)
+
+        # Only the event fields some callback needs are fetched.
+        fields = set(REQUIRED_EVENT_FIELDS)
+        self._hasEntityFields = False
+        for callback in self._callbacks:
+            eventFields = callback.getEventFields()
+            if eventFields is None:
+                eventFields = DEFAULT_EVENT_FIELDS
+            fields.update(eventFields)
+            if callback.hasEntityFields():
+                self._hasEntityFields = True
+        self._eventFields = sorted(fields)
+
+        self._cache = {}
+
+    def getEventFields(self):
+        return self._eventFields
+
+    def hasEntityFields(self):
+        return self._hasEntityFields
+
+    def getCallbacks(self, event):
+        key = (event.get('event_type'), _getEntityType(event), event.get('attribute_name'))
+
+        callbacks = self._cache.get(key)
+        if callbacks is None:
+            candidates = set(self._byEventType.get(key[0], []))
+            candidates.update(self._anyEventType)
+            # Keep registration order among the callbacks that match.
+            callbacks = [c for c in self._callbacks if c in candidates and c.matches(*key)]
+            if len(self._cache) >= self.MAX_KEYS:
+                self._cache.clear()
+            self._cache[key] = callbacks
+
+        return callbacks
+
+    def __iter__(self):
+        return self._callbacks.__iter__()
+
+    def __len__(self):
+        return len(self._callbacks)
+
+
+class DispatchPool(object):
+    def __init__(self, workers, maxPending, runCallback):
+        self._runCallback = runCallback
+        self._lock = threading.Condition()
+        self._ready = collections.deque()
+        # The last queued task for each ordering key, new tasks with the same
+        # key wait for it to be done before they can run.
+        self._tails = {}
+        # [event id, callbacks left to run] for each event in dispatch order.
+        self._events = collections.deque()
+        self._pending = 0
+        # Submit times of the tasks not done yet, per callback.
+        self._callbackTasks = {}
+        self._maxPending = max(maxPending, 1)
+        self._stopping = False
+
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='DispatchWorker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def dispatch(self, event, callbacks):
+        self._lock.acquire()
+        try:
+            while self._pending >= self._maxPending:
+                self._lock.wait()
+
+            entry = [event['id'], len(callbacks)]
+            self._events.append(entry)
+
+            for callback in callbacks:
+                self._queue(_DispatchTask(event, callback, entry))
+
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+    def dispatchBatch(self, events, batcher, eventId):
+        # A batch takes the place of the event with the given id in the
+        # dispatch order, the completed event id does not pass it until the
+        # batch is done.
+        self._lock.acquire()
+        try:
+            while self._pending >= self._maxPending:
+                self._lock.wait()
+
+            entry = [eventId, 1]
+            self._events.append(entry)
+            self._queue(_DispatchTask(events, batcher, entry, [(batcher,)]))
+
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+    def _queue(self, task):
+        for key in task.keys:
+            previous = self._tails.get(key)
+            if previous is not None:
+                previous.dependents.append(task)
+                task.waitingOn += 1
+            self._tails[key] = task
+        if not task.waitingOn:
+            self._ready.append(task)
+        self._callbackTasks.setdefault(task.callback, {})[task] = task.submitted
+        self._pending += 1
+
+    def hasPending(self, callback):
+        self._lock.acquire()
+        try:
+            return callback in self._callbackTasks
+        finally:
+            self._lock.release()
+
+    def getPendingAges(self):
+        self._lock.acquire()
+        try:
+            now = time.time()
+            return dict([(c, now - min(tasks.values())) for c, tasks in self._callbackTasks.items()])
+        finally:
+            self._lock.release()
+
+    def getCompletedEventId(self):
+        self._lock.acquire()
+        try:
+            eid = None
+            while self._events and not self._events[0][1]:
+                # Late events dispatched after later ones never move the
+                # completed id backward.
+                eid = max(eid, self._events.popleft()[0])
+            return eid
+        finally:
+            self._lock.release()
+
+    def shutdown(self):
+        self._lock.acquire()
+        try:
+            while self._pending:
+                self._lock.wait()
+            self._stopping = True
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            self._lock.acquire()
+            try:
+                while not self._ready and not self._stopping:
+                    self._lock.wait()
+                if not self._ready:
+                    return
+                task = self._ready.popleft()
+            finally:
+                self._lock.release()
+
+            try:
+                self._runCallback(task.callback, task.event)
+            except Exception, e:
+                # The task is done either way or the pool would wait for it
+                # forever.
+                logging.critical('Unexpected error running callback %s.\n\n%s', task.callback.getName(), traceback.format_exc(e))
+            finally:
+                self._taskDone(task)
+
+    def _taskDone(self, task):
+        self._lock.acquire()
+        try:
+            task.entry[1] -= 1
+            tasks = self._callbackTasks[task.callback]
+            del tasks[task]
+            if not tasks:
+                del self._callbackTasks[task.callback]
+            for key in task.keys:
+                if self._tails.get(key) is task:
+                    del self._tails[key]
+            for dependent in task.dependents:
+                dependent.waitingOn -= 1
+                if not dependent.waitingOn:
+                    self._ready.append(dependent)
+            self._pending -= 1
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+
+class _DispatchTask(object):
+    def __init__(self, event, callback, entry, keys=None):
+        self.event = event
+        self.callback = callback
+        self.entry = entry
+        self.submitted = time.time()
+        self.dependents = []
+        self.waitingOn = 0
+
+        # A callback always sees the events of a given entity in order, the
+        # retired ones included. An ordered callback sees all of its events in
+        # order.
+        if keys is not None:
+            self.keys = keys
+        elif callback.isOrdered():
+            self.keys = [(callback,)]
+        else:
+            entity = event.get('entity')
+            if entity:
+                self.keys = [(callback, entity.get('type'), entity.get('id'))]
+            else:
+                entityType = _getEntityType(event)
+                entityId = (event.get('meta') or {}).get('entity_id')
+                if entityType is not None and entityId is not None:
+                    self.keys = [(callback, entityType, entityId)]
+                else:
+                    self.keys = []
+
+
+class ProcessPool(object):
+    def __init__(self, server, workers, connectionPoolSize, callbackTimeout=0.0):
+        self._server = server
+        self._connectionPoolSize = connectionPoolSize
+        self._callbackTimeout = callbackTimeout
+        self._idle = Queue.Queue()
+        self._workers = []
+        for i in range(workers):
+            self._idle.put(self._startWorker())
+
+    def _startWorker(self):
+        parentConn, childConn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_processWorker, args=(childConn, self._server, self._connectionPoolSize, self._callbackTimeout), name='ProcessWorker')
+        process.daemon = True
+        process.start()
+        childConn.close()
+        worker = (process, parentConn)
+        self._workers.append(worker)
+        return worker
+
+    def process(self, module, index, event):
+        worker = self._idle.get()
+        process, conn = worker
+        success = False
+        try:
+            conn.send((module.getPath(), module.getMtime(), index, event))
+            # Poll so a worker that dies processing the event is noticed
+            # instead of waiting for it forever.
+            while not conn.poll(1):
+                if not process.is_alive():
+                    raise EOFError()
+            success = conn.recv()
+        except (EOFError, IOError, OSError):
+            # Batch callbacks are given a list of events.
+            if isinstance(event, list):
+                description = 'the batch of events %d to %d' % (event[0]['id'], event[-1]['id'])
+            else:
+                description = 'event %d' % event['id']
+            logging.critical('Worker process %d died processing %s for module %s (exit code %s).',
+                process.pid, description, module.getPath(), process.exitcode)
+            self._workers.remove(worker)
+            conn.close()
+            worker = self._startWorker()
+        finally:
+            self._idle.put(worker)
+        return success
+
+    def shutdown(self):
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for process, conn in self._workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self._workers = []
+
+
+def _processWorker(conn, server, connectionPoolSize, callbackTimeout):
+    _resetLoggingLocks()
+    try:
+        _processTasks(conn, server, connectionPoolSize, callbackTimeout)
+    finally:
+        # Worker processes do not run exit handlers, log records held back,
+        # such as errors waiting to be mailed, are sent now.
+        logging.shutdown()
+
+
+def _resetLoggingLocks():
+    # Another thread of the parent, such as the log listener, a plugin being
+    # loaded or a callback, may have held a logging lock when the worker was
+    # forked, or restarted after one died. It would never be released in the
+    # worker.
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler is not None:
+            handler.createLock()
+
+
+def _processTasks(conn, server, connectionPoolSize, callbackTimeout):
+    modules = {}
+    connectionPool = ConnectionPool(connectionPoolSize)
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if task is None:
+            return
+
+        path, mtime, index, event = task
+        # The module and its callbacks, with connections of their own, are
+        # loaded in the worker and reloaded when the parent reloaded them.
+        module = modules.get(path)
+        if module is None:
+            module = modules[path] = Module(server, path, connectionPool, timeout=callbackTimeout)
+        elif module.getMtime() != mtime:
+            module.load()
+
+        callbacks = list(module)
+        success = False
+        if index < len(callbacks):
+            success = callbacks[index].process(event)
+        else:
+            logging.error('Callback %d of module at %s was not registered in worker process.', index, path)
+
+        conn.send(success)
+
+
+class ProcessCallback(object):
+    def __init__(self, pool, module, index, callback):
+        self._pool = pool
+        self._module = module
+        self._index = index
+        self._callback = callback
+
+    def getExactEventTypes(self):
+        return self._callback.getExactEventTypes()
+
+    def matches(self, eventType, entityType, attributeName):
+        return self._callback.matches(eventType, entityType, attributeName)
+
+    def isOrdered(self):
+        return self._callback.isOrdered()
+
+    def isBatch(self):
+        return self._callback.isBatch()
+
+    def isAsync(self):
+        # Coroutines are run to completion in the worker process.
+        return False
+
+    def getWindow(self):
+        return self._callback.getWindow()
+
+    def getCoalesce(self):
+        return self._callback.getCoalesce()
+
+    def getMaxEvents(self):
+        return self._callback.getMaxEvents()
+
+    def getName(self):
+        return self._callback.getName()
+
+    def getEventFields(self):
+        return self._callback.getEventFields()
+
+    def hasEntityFields(self):
+        return self._callback.hasEntityFields()
+
+    def getEntityFields(self, entityType):
+        return self._callback.getEntityFields(entityType)
+
+    def process(self, event):
+        # Batch callbacks are given the list of events of a batch.
+        return self._pool.process(self._module, self._index, event)
+
+
+class ConnectionPool(object):
+    def __init__(self, maxIdle=4, entityCache=None):
+        self._maxIdle = max(maxIdle, 1)
+        self._entityCache = entityCache or EntityCache(0)
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._hits = 0
+        self._misses = 0
+        self._connections = 0
+
+    def getMaxIdle(self):
+        return self._maxIdle
+
+    def acquire(self, server, sgScriptName, sgScriptKey):
+        key = (server, sgScriptName, sgScriptKey)
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle:
+                self._hits += 1
+                return idle.pop()
+            self._misses += 1
+        finally:
+            self._lock.release()
+
+        conn = sg.Shotgun(server, sgScriptName, sgScriptKey)
+        # Callbacks reach the shared entity cache through their connection.
+        conn.entityCache = _EntityCacheReader(self._entityCache, conn)
+
+        self._lock.acquire()
+        try:
+            self._connections += 1
+        finally:
+            self._lock.release()
+        return conn
+
+    def release(self, conn, server, sgScriptName, sgScriptKey):
+        key = (server, sgScriptName, sgScriptKey)
+        self._lock.acquire()
+        try:
+            # The most recently used connection is handed out first so the
+            # connections kept alive are the ones that are warm.
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._maxIdle:
+                idle.append(conn)
+                return
+            self._connections -= 1
+        finally:
+            self._lock.release()
+
+        close = getattr(conn, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+
+    def getStats(self):
+        self._lock.acquire()
+        try:
+            return {'hits': self._hits, 'misses': self._misses, 'connections': self._connections}
+        finally:
+            self._lock.release()
+
+
+class EntityCache(object):
+    # A read-through cache of entity fields shared by all callbacks. Entries
+    # are kept fresh by the event stream: every event the engine dispatches
+    # drops the changed field, or the whole entity, before any callback sees
+    # the event. The least recently used entities are evicted once maxEntries
+    # are cached. A maxEntries of 0 disables caching.
+    def __init__(self, maxEntries=10000):
+        self._maxEntries = max(maxEntries, 0)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+        # A read that was sent to Shotgun before an invalidation of the same
+        # entity may return what was there before the change. Such reads are
+        # not cached. Invalidations are remembered by generation, the oldest
+        # ones being forgotten in bulk.
+        self._generation = 0
+        self._floor = 0
+        self._invalidated = {}
+
+    def get(self, conn, entityType, entityId, fields=None):
+        fields = fields or ['id']
+        # Linked fields change with the linked entity, they are never cached.
+        if not self._maxEntries or [f for f in fields if '.' in f]:
+            return conn.find_one(entityType, [['id', 'is', entityId]], fields)
+
+        key = (entityType, entityId)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and not [f for f in fields if f not in entry]:
+                self._hits += 1
+                del self._entries[key]
+                self._entries[key] = entry
+                return self._toEntity(entityType, entityId, entry, fields)
+            self._misses += 1
+            generation = self._generation
+        finally:
+            self._lock.release()
+
+        result = conn.find_one(entityType, [['id', 'is', entityId]], fields)
+        if result is None:
+            return None
+
+        self._lock.acquire()
+        try:
+            if not self._isInvalidated(key, generation):
+                entry = self._entries.pop(key, {})
+                for field in fields:
+                    entry[field] = result.get(field)
+                self._entries[key] = entry
+                while len(self._entries) > self._maxEntries:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
+        finally:
+            self._lock.release()
+        return result
+
+    def _toEntity(self, entityType, entityId, entry, fields):
+        entity = {'type': entityType, 'id': entityId}
+        for field in fields:
+            entity[field] = entry[field]
+        return entity
+
+    def _isInvalidated(self, key, generation):
+        if generation < self._floor:
+            return True
+        return (self._invalidated.get(key, 0) > generation or
+            self._invalidated.get((key[0], None), 0) > generation)
+
+    def invalidate(self, event):
+        if not self._maxEntries:
+            return
+
+        entity = event.get('entity')
+        attributeName = event.get('attribute_name')
+        eventType = event.get('event_type') or ''
+        if entity:
+            key = (entity['type'], entity['id'])
+        else:
+            # Without the meta data of a retirement every entity of the type
+            # is dropped.
+            entityType = _getEntityType(event)
+            if entityType is None:
+                return
+            key = (entityType, (event.get('meta') or {}).get('entity_id'))
+
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            if len(self._invalidated) >= max(self._maxEntries, 1000):
+                self._floor = self._generation
+                self._invalidated = {}
+            self._invalidated[key] = self._generation
+
+            if key[1] is None:
+                for cached in [k for k in self._entries if k[0] == key[0]]:
+                    del self._entries[cached]
+                self._invalidations += 1
+                return
+
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self._invalidations += 1
+            if attributeName and eventType.endswith('_Change'):
+                entry.pop(attributeName, None)
+            else:
+                del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        self._lock.acquire()
+        try:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'entries': len(self._entries),
+            }
+        finally:
+            self._lock.release()
+
+
+class _EntityCacheReader(object):
+    # The entity cache as seen by callbacks, as sg.entityCache.
+    def __init__(self, cache, conn):
+        self._cache = cache
+        self._conn = conn
+
+    def get(self, entityType, entityId, fields=None):
+        return self._cache.get(self._conn, entityType, entityId, fields)
 
-            fh = open(self._pidFile, 'w')
-            fh.write("%d\n" % os.getpid())
-            fh.close()
 
-        self._loadLastEventId()
+class _BudgetedRun(object):
+    # A callback run in a thread of its own, so the caller can stop waiting
+    # for it once its time budget is spent.
+    def __init__(self, target, args, description):
+        self._target = target
+        self._args = args
+        self._description = description
+        self._result = None
+        self._abandoned = False
+        self._deadline = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
 
+    def start(self, timeout):
+        # Returns whether the run was done within timeout seconds.
+        self._deadline = time.time() + timeout
+        thread = threading.Thread(target=self._run, name=self._description)
+        thread.setDaemon(True)
+        thread.start()
+        self._done.wait(timeout)
+        self._lock.acquire()
         try:
-            self._mainLoop()
-        except KeyboardInterrupt, e:
-            logging.warning('Keyboard interrupt. Cleaning up...')
-        except Exception, e:
-            logging.critical('Crash!!!!! Unexpected error in main loop.\n\n%s', traceback.format_exc(e))
+            self._abandoned = not self._done.isSet()
+            return not self._abandoned
         finally:
-            self._removePidFile()
+            self._lock.release()
 
-    def _loadLastEventId(self):
-        if self._eventIdFile and os.path.exists(self._eventIdFile):
+    def getResult(self):
+        return self._result
+
+    def _run(self):
+        try:
+            self._result = self._target(*self._args)
+        finally:
+            self._lock.acquire()
             try:
-                fh = open(self._eventIdFile)
-                line = fh.readline()
-                if line.isdigit():
-                    self._saveEventId(int(line))
-                    logging.debug('Read last event id (%d) from file.', self._lastEventId)
-                fh.close()
-            except OSError, e:
-                logging.error('Could not load event id from file.\n\n%s', traceback.format_exc(e))
+                self._done.set()
+                late = self._abandoned
+            finally:
+                self._lock.release()
+            if late:
+                logging.warning('%s finished %.1fs after its time budget.', self._description, time.time() - self._deadline)
 
-        if self._lastEventId is None:
-            result = self._sg.find_one("EventLogEntry", filters=[], fields=['id'], order=[{'column':'created_at', 'direction':'desc'}])
-            logging.info('Read last event id (%d) from the Shotgun database.', result['id'])
-            self._saveEventId(result['id'])
 
-    def _mainLoop(self):
-        logging.debug('Starting the event processing loop.')
-        while self._checkContinue():
-            self.load()
-            for event in self._getNewEvents():
-                for module in self._modules.values():
-                    for callback in module:
-                        callback.process(event)
-                self._saveEventId(event['id'])
-            time.sleep(1)
-        logging.debug('Shuting down event processing loop.')
+class Callback(object):
+    def __init__(self, connectionPool, server, sgScriptName, sgScriptKey, callback, args=None, eventTypes=None, entityTypes=None, attributeNames=None, ordered=False, name=None, eventFields=None, entityFields=None, timeout=None):
+        if not callable(callback):
+            raise TypeError('The callback must be a callable object (function, method or callable class instance).')
 
-    def stop(self):
-        self._removePidFile()
-        logging.info('Stopping gracefully once current events have been processed.')
+        self._server = server
+        self._sgScriptName = sgScriptName
+        self._sgScriptKey = sgScriptKey
+        self._callback = callback
+        self._args = args
+        self._eventTypes = _toPatternList(eventTypes)
+        self._entityTypes = _toPatternList(entityTypes)
+        self._attributeNames = _toPatternList(attributeNames)
+        self._ordered = ordered
+        self._async = asyncio is not None and asyncio.iscoroutinefunction(callback)
+        self._name = name or getattr(callback, '__name__', callback.__class__.__name__)
+        self._eventFields = _toPatternList(eventFields)
+        # Either a list of fields for any entity type or a dictionary of lists
+        # of fields keyed by entity type.
+        if isinstance(entityFields, dict):
+            self._entityFields = dict([(k, _toPatternList(v)) for k, v in entityFields.items()])
+        else:
+            self._entityFields = _toPatternList(entityFields)
+        # The seconds a run may take, without limit when 0 or None.
+        self._timeout = timeout
 
-    def load(self):
-        newModules = {}
+        # Shotgun connections can not be used by two threads at once so one is
+        # taken from the pool of connections shared by all callbacks with the
+        # same credentials for each event. One is created right away so bad
+        # credentials are reported at registration.
+        self._connectionPool = connectionPool
+        self._connectionPool.release(self._acquireShotgun(), server, sgScriptName, sgScriptKey)
 
-        for path in self._paths:
-            if not os.path.isdir(path):
-                continue
+    def _acquireShotgun(self):
+        return self._connectionPool.acquire(self._server, self._sgScriptName, self._sgScriptKey)
 
-            for basename in os.listdir(path):
-                if not basename.endswith('.py') or basename.startswith('.'):
-                    continue
+    def _releaseShotgun(self, conn):
+        self._connectionPool.release(conn, self._server, self._sgScriptName, self._sgScriptKey)
 
-                filePath = os.path.join(path, basename)
-                if filePath in self._modules:
-                    newModules[filePath] = self._modules[filePath]
-                    newModules[filePath].load()
-                else:
-                    module = Module(self._server, filePath)
-                    module.load()
-                    newModules[filePath] = module
+    def isOrdered(self):
+        return self._ordered
 
-        self._modules = newModules
+    def isBatch(self):
+        return False
 
-    def _checkContinue(self):
-        if self._pidFile is None:
-            return True
+    def isAsync(self):
+        return self._async
 
-        if os.path.exists(self._pidFile):
-            return True
+    def getName(self):
+        return self._name
 
-        return False
+    def getEventFields(self):
+        return self._eventFields
 
-    def _getNewEvents(self):
-        filters = [['id', 'greater_than', self._lastEventId]]
-        fields = ['id', 'event_type', 'attribute_name', 'meta', 'entity']
-        order = [{'column':'created_at', 'direction':'asc'}]
+    def hasEntityFields(self):
+        return bool(self._entityFields)
 
-        try:
-            return self._sg.find("EventLogEntry", filters=filters, fields=fields, order=order, filter_operator='all')
-        except (sg.ProtocolError, sg.ResponseError), e:
-            logging.warning(str(e))
+    def getEntityFields(self, entityType):
+        if isinstance(self._entityFields, dict):
+            return self._entityFields.get(entityType)
+        return self._entityFields
 
-        return []
+    def getExactEventTypes(self):
+        if self._eventTypes is None:
+            return None
+        for pattern in self._eventTypes:
+            if _isPattern(pattern):
+                return None
+        return self._eventTypes
 
-    def _saveEventId(self, eid):
-        self._lastEventId = eid
-        if self._eventIdFile is not None:
-            try:
-                fh = open(self._eventIdFile, 'w')
-                fh.write('%d' % eid)
-                fh.close()
-            except OSError, e:
-                logging.error('Can not write event eid to %s.\n\n%s', self._eventIdFile, traceback.format_exc(e))
+    def matches(self, eventType, entityType, attributeName):
+        return (_matchesAny(eventType, self._eventTypes) and
+            _matchesAny(entityType, self._entityTypes) and
+            _matchesAny(attributeName, self._attributeNames))
 
-    def _removePidFile(self):
-        if self._pidFile and os.path.exists(self._pidFile):
-            try:
-                os.unlink(self._pidFile)
-            except OSError, e:
-                logging.error('Error removing pid file.\n\n%s', traceback.format_exc(e))
+    def getRegistration(self):
+        # What is needed to dispatch events to the callback without loading
+        # its module, credentials and arguments are left out.
+        return {
+            'name': self._name,
+            'eventTypes': self._eventTypes,
+            'entityTypes': self._entityTypes,
+            'attributeNames': self._attributeNames,
+            'ordered': self._ordered,
+            'async': self._async,
+            'eventFields': self._eventFields,
+            'entityFields': self._entityFields,
+            'timeout': self._timeout,
+        }
 
+    def process(self, event):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('Processing event %d in callback %s.', event['id'], self._callback.__name__)
+        return self._process(event)
 
-class Module(object):
-    def __init__(self, server, path):
-        self._server = server
-        self._path = path
-        self._callbacks = []
-        self._mtime = None
-        self.load()
+    def _process(self, arg):
+        # Returns None when the run was given up on for going over its time
+        # budget.
+        conn = self._acquireShotgun()
+        if not self._timeout:
+            return self._run(conn, arg)
 
-    def load(self):
-        dirname, basename = os.path.split(self._path)
-        moduleName = os.path.splitext(basename)[0]
+        # The run has a thread of its own so it can be given up on. Threads
+        # can not be stopped, a run given up on carries on in the background
+        # with its connection.
+        run = _BudgetedRun(self._run, (conn, arg), 'Callback %s on %s' % (self._name, self._describe(arg)))
+        if run.start(self._timeout):
+            return run.getResult()
+        logging.warning('Callback %s went over its time budget of %gs on %s, it is left to finish in the background.', self._name, self._timeout, self._describe(arg))
+        return None
 
-        mtime = os.path.getmtime(self._path)
-        if self._mtime is None:
-            self._load(moduleName, mtime, 'Loading module at %s' % self._path)
-        elif self._mtime < mtime:
-            self._load(moduleName, mtime, 'Reloading module at %s' % self._path)
+    def _run(self, conn, arg):
+        try:
+            self._call(conn, arg)
+            success = True
+        except Exception, e:
+            logging.critical('An error occured processing %s in callback %s.\n\n%s', self._describe(arg), self._callback.__name__, traceback.format_exc(e))
+            success = False
+        self._releaseShotgun(conn)
+        return success
 
-    def _load(self, moduleName, mtime, message):
-        logging.info(message)
-        self._mtime = mtime
-        self._callbacks = []
+    def _describe(self, event):
+        return 'event %d' % event['id']
 
+    def processAsync(self, event):
+        # Only used by the asynchronous engine, for coroutine callbacks. Those
+        # are cancelled once they go over their time budget.
+        conn = self._acquireShotgun()
         try:
-            module = imp.load_source(moduleName, self._path)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug('Processing event %d in callback %s.', event['id'], self._callback.__name__)
+            result = self._callback(conn, event, self._args)
+            if self._timeout:
+                result = asyncio.wait_for(result, self._timeout)
+            yield From(result)
+            success = True
+        except asyncio.TimeoutError:
+            logging.warning('Callback %s went over its time budget of %gs on %s and was cancelled.', self._name, self._timeout, self._describe(event))
+            success = None
         except Exception, e:
-            logging.error('Could not load the module at %s.\n\n%s', self._path, traceback.format_exc(e))
-            return
+            logging.critical('An error occured processing an event in callback %s.\n\n%s', self._callback.__name__, traceback.format_exc(e))
+            success = False
+        self._releaseShotgun(conn)
+        raise Return(success)
 
-        regFunc = getattr(module, 'registerCallbacks', None)
-        if isinstance(regFunc, types.FunctionType):
+    def _call(self, conn, arg):
+        result = self._callback(conn, arg, self._args)
+        if self._async:
+            # Out of the asynchronous engine coroutines get a loop of their
+            # own for the run.
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
             try:
-                regFunc(Registrar(self))
-            except Exception, e:
-                logging.error('Error running register callback function from module at %s.\n\n%s', self._path, traceback.format_exc(e))
-        else:
-            logging.error('Did not find a registerCallbacks function in module at %s.', self._path)
+                loop.run_until_complete(result)
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
 
-    def registerCallback(self, sgScriptName, sgScriptKey, callback, args=None):
-        global sg
-        self._callbacks.append(Callback(sg.Shotgun(self._server, sgScriptName, sgScriptKey), callback, args))
 
-    def __iter__(self):
-        return self._callbacks.__iter__()
+class BatchCallback(Callback):
+    # A callback given lists of events instead of single events. Events are
+    # gathered for window seconds, or until maxEvents are waiting, and may be
+    # coalesced so only the latest event for each entity and/or attribute is
+    # kept.
+    COALESCE_KEYS = ('entity', 'attribute')
 
+    def __init__(self, connectionPool, server, sgScriptName, sgScriptKey, callback, args=None, eventTypes=None, entityTypes=None, attributeNames=None, name=None, eventFields=None, entityFields=None, window=5.0, coalesce=None, maxEvents=1000, timeout=None):
+        coalesce = _toPatternList(coalesce) or []
+        for key in coalesce:
+            if key not in self.COALESCE_KEYS:
+                raise ValueError('Can not coalesce events on %r, expected any of %s.' % (key, ', '.join(self.COALESCE_KEYS)))
 
-class Registrar(object):
-    def __init__(self, module):
+        # Batches of a callback are always processed one after the other.
+        Callback.__init__(self, connectionPool, server, sgScriptName, sgScriptKey, callback, args, eventTypes, entityTypes, attributeNames, True, name, eventFields, entityFields, timeout)
+        self._window = max(window, 0)
+        self._coalesce = coalesce
+        self._maxEvents = max(maxEvents, 1)
+
+    def isBatch(self):
+        return True
+
+    def getWindow(self):
+        return self._window
+
+    def getCoalesce(self):
+        return self._coalesce
+
+    def getMaxEvents(self):
+        return self._maxEvents
+
+    def getRegistration(self):
+        registration = Callback.getRegistration(self)
+        registration.update({'batch': True, 'window': self._window, 'coalesce': self._coalesce, 'maxEvents': self._maxEvents})
+        return registration
+
+    def process(self, events):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('Processing %d events (%d to %d) in callback %s.', len(events), events[0]['id'], events[-1]['id'], self._callback.__name__)
+        return self._process(events)
+
+    def _describe(self, events):
+        return 'the batch of events %d to %d' % (events[0]['id'], events[-1]['id'])
+
+
+class LazyCallback(Callback):
+    # Stands for a callback of a module that has not been imported yet, with
+    # the filters it registered the last time it was. The module is imported
+    # when the callback is first given an event.
+    def __init__(self, module, registration):
         self._module = module
+        self._registration = registration
+        self._callback = None
+        self._eventTypes = registration.get('eventTypes')
+        self._entityTypes = registration.get('entityTypes')
+        self._attributeNames = registration.get('attributeNames')
+        self._ordered = registration.get('ordered', False)
+        self._async = registration.get('async', False)
+        self._name = registration['name']
+        self._eventFields = registration.get('eventFields')
+        self._entityFields = registration.get('entityFields')
 
-    def registerCallback(self, sgScriptName, sgScriptKey, callback, args=None):
-        self._module.registerCallback(sgScriptName, sgScriptKey, callback, args)
+    def isBatch(self):
+        return self._registration.get('batch', False)
 
+    def getWindow(self):
+        return self._registration.get('window')
 
-class Callback(object):
-    def __init__(self, sg, callback, args=None):
-        if not callable(callback):
-            raise TypeError('The callback must be a callable object (function, method or callable class instance).')
+    def getCoalesce(self):
+        return self._registration.get('coalesce')
 
-        self._sg = sg
-        self._callback = callback
-        self._args = args
+    def getMaxEvents(self):
+        return self._registration.get('maxEvents')
+
+    def getRegistration(self):
+        return self._registration
+
+    def _getCallback(self):
+        if self._callback is None:
+            self._callback = self._module.getCallback(self._name)
+            if self._callback is None:
+                logging.error('Callback %s was not registered again by its module at %s.', self._name, self._module.getPath())
+        return self._callback
 
     def process(self, event):
+        callback = self._getCallback()
+        if callback is None:
+            return False
+        return callback.process(event)
+
+    def processAsync(self, event):
+        callback = self._getCallback()
+        success = False
+        if callback is not None:
+            success = yield From(callback.processAsync(event))
+        raise Return(success)
+
+
+class Batcher(object):
+    # Gathers the events of a batch callback until they are due to be
+    # processed. The oldest event gathered, or being processed, holds back
+    # the checkpoint until its batch is done.
+    def __init__(self, callback):
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._events = collections.OrderedDict()
+        self._firstId = None
+        self._started = None
+        self._running = collections.deque()
+
+    def setCallback(self, callback):
+        self._callback = callback
+
+    def getName(self):
+        return self._callback.getName()
+
+    def isOrdered(self):
+        return True
+
+    def isAsync(self):
+        return False
+
+    def add(self, event):
+        coalesce = self._callback.getCoalesce()
+        key = []
+        if 'entity' in coalesce:
+            entity = event.get('entity')
+            if entity:
+                key.extend([entity.get('type'), entity.get('id')])
+            else:
+                key.append(event['id'])
+        if 'attribute' in coalesce:
+            key.append(event.get('attribute_name'))
+        key = tuple(key) or event['id']
+
+        self._lock.acquire()
         try:
-            logging.debug('Processing event %d in callback %s.', event['id'], self._callback.__name__)
-            self._callback(self._sg, event, self._args)
-        except Exception, e:
-            logging.critical('An error occured processing an event in callback %s.\n\n%s', self._callback.__name__, traceback.format_exc(e))
+            if not self._events:
+                self._started = time.time()
+            # The latest event of a key takes the place of the earlier ones.
+            self._events.pop(key, None)
+            self._events[key] = event
+            self._firstId = min(self._firstId or event['id'], event['id'])
+        finally:
+            self._lock.release()
+
+    def getDueTime(self):
+        self._lock.acquire()
+        try:
+            if not self._events:
+                return None
+            if len(self._events) >= self._callback.getMaxEvents():
+                return self._started
+            return self._started + self._callback.getWindow()
+        finally:
+            self._lock.release()
+
+    def take(self):
+        self._lock.acquire()
+        try:
+            events = sorted(self._events.values(), key=lambda e: e['id'])
+            if events:
+                self._running.append(self._firstId)
+            self._events.clear()
+            self._firstId = None
+            return events
+        finally:
+            self._lock.release()
+
+    def getHeldEventId(self):
+        self._lock.acquire()
+        try:
+            ids = list(self._running)
+            if self._firstId is not None:
+                ids.append(self._firstId)
+            return ids and min(ids) or None
+        finally:
+            self._lock.release()
+
+    def process(self, events):
+        try:
+            return self._callback.process(events)
+        finally:
+            self.release()
+
+    def release(self):
+        # The oldest batch taken is done, or was skipped.
+        self._lock.acquire()
+        try:
+            self._running.popleft()
+        finally:
+            self._lock.release()
+
+
+def _toPatternList(value):
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def _isPattern(value):
+    return '*' in value or '?' in value or '[' in value
+
+
+def _matchesAny(value, patterns):
+    if patterns is None:
+        return True
+    if value is None:
+        return False
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(value, pattern):
+            return True
+    return False
 
 
 class CustomSMTPHandler(logging.handlers.SMTPHandler):
@@ -223,7 +3731,196 @@ class CustomSMTPHandler(logging.handlers.SMTPHandler):
         return subject
 
 
-def main():
+class DigestSMTPHandler(CustomSMTPHandler):
+    # Sends at most one email every interval seconds. The records logged in
+    # between are sent together in a digest where the errors logged again and
+    # again from the same place with the same message are counted instead of
+    # repeated, and only the first maxErrors kinds of errors are detailed.
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, interval=300.0, maxErrors=20):
+        CustomSMTPHandler.__init__(self, mailhost, fromaddr, toaddrs, subject)
+        self._interval = interval
+        self._maxErrors = max(maxErrors, 1)
+        # [first record, count, last record] by kind of error.
+        self._pending = collections.OrderedDict()
+        self._count = 0
+        self._lastSend = None
+
+    def emit(self, record):
+        key = (record.levelno, record.name, record.pathname, record.lineno, getattr(record, 'template', record.msg))
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [record, 1, record]
+        else:
+            entry[1] += 1
+            entry[2] = record
+        self._count += 1
+        self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self._pending and (self._lastSend is None or time.time() - self._lastSend >= self._interval):
+                self._sendDigest()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._pending:
+                self._sendDigest()
+        finally:
+            self.release()
+        CustomSMTPHandler.close(self)
+
+    def _sendDigest(self):
+        entries = self._pending.values()
+        count = self._count
+        self._pending = collections.OrderedDict()
+        self._count = 0
+        self._lastSend = time.time()
+
+        # A lone record is sent as it is.
+        if count == 1:
+            logging.handlers.SMTPHandler.emit(self, entries[0][0])
+            return
+
+        parts = ['%d errors were logged since %s.' % (count, _formatTime(entries[0][0].created))]
+        for first, repeats, last in entries[:self._maxErrors]:
+            part = CustomSMTPHandler.format(self, first)
+            if repeats > 1:
+                part = 'Logged %d times, last at %s:\n\n%s' % (repeats, _formatTime(last.created), part)
+            parts.append(part)
+        if len(entries) > self._maxErrors:
+            parts.append('%d other kinds of errors were logged, see the log file.' % (len(entries) - self._maxErrors))
+
+        record = max([entry[0] for entry in entries], key=lambda r: r.levelno)
+        digest = logging.makeLogRecord(record.__dict__)
+        digest.digest = ('\n\n' + '-' * 79 + '\n\n').join(parts)
+        digest.count = count
+        logging.handlers.SMTPHandler.emit(self, digest)
+
+    def format(self, record):
+        # Digests come formatted.
+        return getattr(record, 'digest', None) or CustomSMTPHandler.format(self, record)
+
+    def getSubject(self, record):
+        subject = CustomSMTPHandler.getSubject(self, record)
+        if getattr(record, 'count', 1) > 1:
+            subject += ' (%d errors)' % record.count
+        return subject
+
+
+def _formatTime(value):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value))
+
+
+class QueueHandler(logging.Handler):
+    # Puts log records on a queue and hands them to the given handlers from a
+    # listener thread, so logging never waits on a disk or a mail server.
+    # Python 2 has neither QueueHandler nor QueueListener, this is both. When
+    # the queue is full records are dropped and counted. Handlers are flushed
+    # every flushInterval seconds. Forked processes, such as process workers,
+    # have no listener and use the handlers directly.
+    def __init__(self, handlers, maxSize=LOG_QUEUE_SIZE, flushInterval=1.0):
+        logging.Handler.__init__(self)
+        self._handlers = handlers
+        self._queue = Queue.Queue(maxSize)
+        self._flushInterval = flushInterval
+        self._dropped = 0
+        self._pid = os.getpid()
+        self._forkPid = None
+        self._thread = threading.Thread(target=self._listen, name='LogListener')
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+
+    def handle(self, record):
+        # The queue has a lock of its own.
+        if self.filter(record):
+            self.emit(record)
+
+    def emit(self, record):
+        if self._isForked():
+            self._handle(record)
+            return
+        try:
+            self._queue.put_nowait(self._prepare(record))
+        except Queue.Full:
+            self._dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _prepare(self, record):
+        # The message is formatted right away, from objects that may have
+        # changed by the time the record is written. The message as given is
+        # kept to tell repeated errors apart.
+        message = self.format(record)
+        record.template = record.msg
+        record.msg = message
+        record.message = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def _isForked(self):
+        pid = os.getpid()
+        if pid == self._pid:
+            return False
+        if pid != self._forkPid:
+            # The listener may have held the locks of the handlers when the
+            # process was forked.
+            self._forkPid = pid
+            for handler in self._handlers:
+                handler.createLock()
+        return True
+
+    def _listen(self):
+        lastFlush = time.time()
+        while True:
+            try:
+                record = self._queue.get(True, self._flushInterval)
+            except Queue.Empty:
+                record = False
+            if record is None:
+                return
+            if record:
+                self._handle(record)
+
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                self._handle(logging.makeLogRecord({'name': 'root', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '%d log records were dropped, too many were waiting to be written.' % dropped}))
+            if time.time() - lastFlush >= self._flushInterval:
+                lastFlush = time.time()
+                for handler in self._handlers:
+                    handler.flush()
+
+    def _handle(self, record):
+        for handler in self._handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+
+    def close(self):
+        # Records already queued are written first.
+        if not self._isForked() and self._thread.isAlive():
+            self._queue.put(None)
+            self._thread.join()
+        for handler in self._handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--shard-id', type='int', help='Shard to run first when the daemon is sharded, overrides the id of the shards section.')
+    options, args = parser.parse_args(argv)
+
     daemonize = True
     configPath = _getConfigPath()
     if not os.path.exists(configPath):
@@ -240,20 +3937,11 @@ def main():
         logging.getLogger().addHandler(handler)
 
     # Read/parse the config
-    config = ConfigParser.ConfigParser()
-    config.read(configPath)
+    config = Config(configPath)
 
-    pidFile = config.get('daemon', 'pidFile')
-    eventIdFile = config.get('daemon', 'eventIdFile')
     loggingPath = config.get('daemon', 'logFile')
     loggingLevel = config.getint('daemon', 'logging')
 
-    server = config.get('shotgun', 'server')
-    name = config.get('shotgun', 'name')
-    key = config.get('shotgun', 'key')
-
-    pluginPaths = [s.strip() for s in config.get('plugins', 'paths').split(',')]
-
     smtpServer = config.get('emails', 'server')
     fromAddr = config.get('emails', 'from')
     toAddrs = [s.strip() for s in config.get('emails', 'to').split(',')]
@@ -264,7 +3952,7 @@ def main():
     logger.setLevel(loggingLevel)
     handler = logging.handlers.TimedRotatingFileHandler(loggingPath, 'midnight', backupCount=10)
     handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-    logger.addHandler(handler)
+    handlers = [handler]
 
     # Setup the mail logger
     if smtpServer and fromAddr and toAddrs and subject:
@@ -275,18 +3963,307 @@ Function: %(funcName)s
 Line: %(lineno)d
 
 %(message)s""")
-        mailHandler = CustomSMTPHandler(smtpServer, fromAddr, toAddrs, subject)
+        mailHandler = DigestSMTPHandler(smtpServer, fromAddr, toAddrs, subject,
+            config.getOptionalFloat('emails', 'digestInterval', 300.0),
+            config.getOptionalInt('emails', 'digestMaxErrors', 20))
         mailHandler.setLevel(logging.ERROR)
         mailHandler.setFormatter(mailFormatter)
-        logger.addHandler(mailHandler)
+        handlers.append(mailHandler)
+
+    # Records are written and mailed from a thread of their own so logging
+    # never holds up event processing.
+    queueHandler = QueueHandler(handlers)
+    queueHandler.start()
+    logger.addHandler(queueHandler)
+
+    # Sharded instances wait for a shard of their own before starting.
+    shardId = None
+    shardCount = config.getOptionalInt('shards', 'count', 1)
+    if shardCount > 1:
+        preferredId = options.shard_id
+        if preferredId is None:
+            preferredId = config.getOptionalInt('shards', 'id')
+        if preferredId is not None and not 0 <= preferredId < shardCount:
+            logging.critical('Shard id %d is not within the %d shards.', preferredId, shardCount)
+            return 1
+        lockDir = config.getOptional('shards', 'lockDir') or os.path.dirname(os.path.abspath(config.get('daemon', 'eventIdFile')))
+        shardLock = ShardLock(lockDir, shardCount)
+
+        # A waiting instance has a pid file of its own, removing it stops the
+        # instance like removing the pid file of a running one does.
+        standbyPidFile = None
+        pidFile = config.getOptional('daemon', 'pidFile')
+        if pidFile:
+            standbyPidFile = '%s.standby%d' % (pidFile, os.getpid())
+            fh = open(standbyPidFile, 'w')
+            fh.write("%d\n" % os.getpid())
+            fh.close()
+        try:
+            shardId = shardLock.acquire(preferredId, config.getOptionalFloat('shards', 'retryInterval', 5.0),
+                standbyPidFile and (lambda: os.path.exists(standbyPidFile)))
+        finally:
+            if standbyPidFile and os.path.exists(standbyPidFile):
+                os.unlink(standbyPidFile)
+        if shardId is None:
+            logging.info('Stopped while waiting for a shard.')
+            return 0
+        logging.info('Running shard %d of %d.', shardId, shardCount)
 
     # Start event processing
-    engine = Engine(pluginPaths, server, name, key, pidFile, eventIdFile)
+    if config.getOptionalBoolean('daemon', 'asyncEngine', False):
+        if asyncio is None:
+            logging.critical('The asynchronous engine needs the trollius package.')
+            return 1
+        engine = AsyncEngine(config, shardId)
+    else:
+        engine = Engine(config, shardId)
     engine.start()
 
     return 0
 
 
+def replay(argv=None):
+    parser = optparse.OptionParser(usage='%prog replay [options]', description=
+        'Process a range of past events with some or all plugins without '
+        'touching the cursor of the live daemon. The range is split in chunks '
+        'processed in parallel, each keeping its own checkpoint so an '
+        'interrupted replay resumes where it stopped when run again.')
+    parser.add_option('--from-id', type='int', help='First event id to replay.')
+    parser.add_option('--to-id', type='int', help='Last event id to replay.')
+    parser.add_option('--from-date', help='Replay events created at or after this date (YYYY-MM-DD[ HH:MM:SS]).')
+    parser.add_option('--to-date', help='Replay events created before this date (YYYY-MM-DD[ HH:MM:SS]).')
+    parser.add_option('--plugins', default='', help='Comma delimited plugin names or paths to run, all plugins by default.')
+    parser.add_option('--workers', type='int', default=4, help='Number of chunks processed at once [%default].')
+    parser.add_option('--chunk-size', type='int', default=10000, help='Number of event ids per chunk [%default].')
+    parser.add_option('--page-size', type='int', default=500, help='Number of events fetched per query [%default].')
+    parser.add_option('--state-dir', help='Where the chunk checkpoints are kept, next to the event id file by default.')
+    parser.add_option('--config', help='Daemon config file to use.')
+    options, args = parser.parse_args(argv)
+
+    configPath = options.config or _getConfigPath()
+    if not configPath or not os.path.exists(configPath):
+        print 'Config path not found!'
+        return 1
+    config = Config(configPath)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(processName)s - %(levelname)s - %(message)s"))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(config.getint('daemon', 'logging'))
+
+    server = config.get('shotgun', 'server')
+    credentials = (server, config.get('shotgun', 'name'), config.get('shotgun', 'key'))
+    conn = sg.Shotgun(*credentials)
+
+    try:
+        firstId, lastId = _getReplayRange(conn, options)
+    except ValueError, e:
+        parser.error(str(e))
+    if firstId is None or lastId is None or firstId > lastId:
+        logging.info('No events to replay.')
+        return 0
+
+    modulePaths = _getReplayModules(config.getList('plugins', 'paths'), options.plugins)
+    if not modulePaths:
+        logging.error('No plugins to replay events with.')
+        return 1
+
+    # The state directory is named after the arguments as given so a replay
+    # without an end resumes even though new events came in since.
+    stateDir = options.state_dir
+    if stateDir is None:
+        eventIdFile = config.getOptional('daemon', 'eventIdFile') or os.path.join(tempfile.gettempdir(), 'shotgunEventDaemon.id')
+        key = (options.from_id, options.to_id, options.from_date, options.to_date, sorted(modulePaths))
+        stateDir = '%s.replay-%s' % (eventIdFile, hashlib.md5(repr(key)).hexdigest()[:12])
+    if not os.path.isdir(stateDir):
+        os.makedirs(stateDir)
+
+    # The chunks are planned once and kept in a manifest, a resumed replay
+    # runs the chunks it was started with whether they were begun or not.
+    manifestPath = os.path.join(stateDir, 'manifest')
+    if os.path.exists(manifestPath):
+        manifest = json.load(open(manifestPath))
+        firstId, lastId = manifest['firstId'], manifest['lastId']
+        ranges = [tuple(r) for r in manifest['chunks']]
+        logging.info('Resuming the replay in %s.', stateDir)
+    elif [b for b in os.listdir(stateDir) if b.startswith('chunk-')]:
+        logging.error('%s holds chunk checkpoints but no manifest, remove it to start the replay over.', stateDir)
+        return 1
+    else:
+        ranges = []
+        chunkSize = max(options.chunk_size, 1)
+        for start in xrange(firstId, lastId + 1, chunkSize):
+            ranges.append((start, min(start + chunkSize - 1, lastId)))
+        manifest = {'firstId': firstId, 'lastId': lastId, 'chunks': ranges}
+        fh = open(manifestPath + '.tmp', 'w')
+        try:
+            json.dump(manifest, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+        os.rename(manifestPath + '.tmp', manifestPath)
+
+    chunks = []
+    for start, end in ranges:
+        chunks.append((credentials, config.getOptionalInt('shotgun', 'connectionPoolSize', 4), modulePaths,
+            os.path.join(stateDir, 'chunk-%d-%d' % (start, end)), options.page_size, start, end,
+            _getReplayJournalPaths(config)))
+
+    logging.info('Replaying events %d to %d in %d chunks with %d workers using %s. Checkpoints are in %s.',
+        firstId, lastId, len(chunks), options.workers, ', '.join(modulePaths), stateDir)
+
+    pool = multiprocessing.Pool(max(options.workers, 1))
+    events = 0
+    try:
+        for start, end, count in pool.imap_unordered(_replayChunk, chunks):
+            events += count
+            logging.info('Chunk %d to %d done, %d events.', start, end, count)
+        pool.close()
+    except KeyboardInterrupt:
+        logging.warning('Interrupted, run the same replay again to resume it.')
+        pool.terminate()
+        return 1
+    finally:
+        pool.join()
+
+    logging.info('Replayed %d events.', events)
+    return 0
+
+
+def _getReplayRange(conn, options):
+    firstId, lastId = options.from_id, options.to_id
+
+    if options.from_date:
+        result = conn.find_one('EventLogEntry', [['created_at', 'greater_than', _parseDate(options.from_date) - datetime.timedelta(seconds=1)]],
+            ['id'], order=[{'column':'id', 'direction':'asc'}])
+        if result is None:
+            return None, None
+        firstId = max(firstId, result['id'])
+    if options.to_date:
+        result = conn.find_one('EventLogEntry', [['created_at', 'less_than', _parseDate(options.to_date)]],
+            ['id'], order=[{'column':'id', 'direction':'desc'}])
+        if result is None:
+            return None, None
+        lastId = result['id'] if lastId is None else min(lastId, result['id'])
+
+    if firstId is None:
+        raise ValueError('A --from-id or --from-date is required.')
+    if lastId is None:
+        result = conn.find_one('EventLogEntry', [], ['id'], order=[{'column':'id', 'direction':'desc'}])
+        lastId = result and result['id']
+
+    return firstId, lastId
+
+
+def _parseDate(value):
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: %s' % value)
+
+
+def _getReplayModules(paths, plugins):
+    plugins = [p.strip() for p in plugins.split(',') if p.strip()]
+    modulePaths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        for basename in sorted(os.listdir(path)):
+            if not basename.endswith('.py') or basename.startswith('.'):
+                continue
+            filePath = os.path.join(path, basename)
+            if not plugins or os.path.splitext(basename)[0] in plugins or filePath in plugins:
+                modulePaths.append(filePath)
+    return modulePaths
+
+
+def _getReplayJournalPaths(config):
+    # Each shard of a sharded daemon keeps a journal of its own, with all the
+    # events it fetched. Any of them may hold the events of a chunk.
+    path = config.getOptional('journal', 'path')
+    if not path:
+        return []
+    shardCount = config.getOptionalInt('shards', 'count', 1)
+    if shardCount > 1:
+        return ['%s.shard%d' % (path, i) for i in range(shardCount)]
+    return [path]
+
+
+_replayModules = {}
+
+
+def _replayChunk(args):
+    credentials, connectionPoolSize, modulePaths, checkpointPath, pageSize, start, end, journalPaths = args
+
+    # Plugins are loaded once per worker process and kept for its next chunks.
+    key = tuple(modulePaths)
+    if key not in _replayModules:
+        connectionPool = ConnectionPool(connectionPoolSize)
+        _replayModules[key] = DispatchTable([Module(credentials[0], path, connectionPool) for path in modulePaths])
+    dispatchTable = _replayModules[key]
+
+    checkpoint = Checkpoint(checkpointPath)
+    cursor = checkpoint.load()
+    if cursor is None:
+        cursor = start - 1
+    elif cursor >= end:
+        return start, end, 0
+
+    # The journals of the daemon are read first, they are never written to
+    # here.
+    journals = [EventJournal(path) for path in journalPaths]
+
+    conn = sg.Shotgun(*credentials)
+    count = 0
+    try:
+        while True:
+            fields = dispatchTable.getEventFields()
+            events, coveredId = [], None
+            for journal in journals:
+                try:
+                    events, coveredId = journal.read(cursor, pageSize, end)
+                except (EnvironmentError, cPickle.UnpicklingError), e:
+                    logging.warning('Could not read the event journal: %s', e)
+                if events and [f for f in fields if f not in events[0]]:
+                    events, coveredId = [], None
+                if coveredId is not None:
+                    break
+
+            try:
+                if coveredId is None:
+                    events = _queryEvents(conn, cursor, pageSize, end, fields)
+                    coveredId = len(events) < pageSize and end or events[-1]['id']
+                _prefetchEntities(conn, dispatchTable, events)
+            except (sg.ProtocolError, sg.ResponseError), e:
+                logging.warning(str(e))
+                time.sleep(5)
+                continue
+
+            # Batch callbacks are given the events of a page at once.
+            batchers = {}
+            for event in events:
+                for callback in dispatchTable.getCallbacks(event):
+                    if callback.isBatch():
+                        batchers.setdefault(callback.getName(), Batcher(callback)).add(event)
+                    else:
+                        callback.process(event)
+                count += 1
+            for batcher in batchers.values():
+                batcher.process(batcher.take())
+            cursor = coveredId
+            checkpoint.update(cursor)
+
+            if cursor >= end:
+                break
+    finally:
+        checkpoint.flush()
+
+    return start, end, count
+
+
 def _getConfigPath():
     paths = ['$CONFIG_PATH$', '/etc/shotgunEventDaemon.conf']
     for path in paths:
@@ -296,4 +4273,6 @@ def _getConfigPath():
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    if sys.argv[1:2] == ['replay']:
+        sys.exit(replay(sys.argv[2:]))
+    sys.exit(main(sys.argv[1:]))
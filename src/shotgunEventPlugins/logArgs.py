@@ -17,15 +17,49 @@ process events.
 
 This function should take one argument which is a Registrar object.
 
-The Registrar has one method: registerCallback(name, key, callback, args)
+The Registrar has two registration methods, registerCallback for callbacks
+that are given one event at a time and registerBatchCallback for callbacks
+that are given lists of events.
+
+registerCallback(name, key, callback, args, eventTypes, entityTypes,
+attributeNames, ordered, eventFields, entityFields, timeout)
 
     name: script name as stored in Shotgun.
     key: script key as stored in Shotgun.
     callback: the function object you wish to be called to process events.
     args: an object that will be passed as is to your callback.
+    eventTypes: optional event type or list of event types (shell-style
+        patterns are allowed) the callback should receive.
+    entityTypes: optional entity type or list of entity types the callback
+        should receive.
+    attributeNames: optional attribute name or list of attribute names the
+        callback should receive.
+    ordered: when True the callback receives all of its events in order even
+        when the daemon runs callbacks concurrently.
+    eventFields: optional list of the event fields the callback needs besides
+        id, event_type, attribute_name, entity and created_at.
+    entityFields: optional list of fields, or dictionary of lists of fields
+        keyed by entity type, of the event entity the callback needs. They are
+        fetched in batches and added to event['entity'].
+    timeout: optional number of seconds a run of the callback may take, the
+        callbackTimeout of the daemon config by default. 0 means no limit. A
+        run that goes over it is left to finish in the background and its
+        event is processed again later, so the callback may be given the
+        same event twice.
+
+registerBatchCallback(name, key, callback, args, eventTypes, entityTypes,
+attributeNames, eventFields, entityFields, window, coalesce, maxEvents,
+timeout) takes the same arguments as registerCallback except ordered, and:
+
+    window: the number of seconds events are gathered for before the batch is
+        processed.
+    coalesce: optional 'entity', 'attribute' or a list of both. Only the latest
+        event for each entity and/or attribute is kept in a batch.
+    maxEvents: the batch is processed as soon as this many events are waiting.
 
 For each of your functions that should process Shotgun events, call
-reg.registerCallback once with the appropriate arguments.
+reg.registerCallback or reg.registerBatchCallback once with the appropriate
+arguments.
 
 You can register as many functions as you wish and not all functions need to be
 registered as event processing callbacks.
@@ -36,8 +70,11 @@ Callbacks
 
 Any callback function should take three arguments.
 
-    sg: a Shotgun object instance onto which you can do queries.
-    event: an event object to process.
+    sg: a Shotgun object instance onto which you can do queries. Entities
+        can be read through the cache shared by all callbacks with
+        sg.entityCache.get(entityType, entityId, fields).
+    event: an event object to process, or a list of them for batch
+        callbacks.
     arg: an arbitrary argument that was provided at callback registration.
 
 
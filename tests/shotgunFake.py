@@ -0,0 +1,155 @@
+"""
+An in memory stand-in for the Shotgun API used by the tests.
+
+Importing this module puts the daemon sources on the path and makes the
+daemon talk to the fake server below. Events are added to EVENTS and are
+served by any Shotgun instance, including the ones created in forked worker
+processes.
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import unittest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ResponseError(Exception):
+    pass
+
+
+class Fault(Exception):
+    pass
+
+
+EVENTS = []
+
+
+def makeEvents(firstId, lastId, entityType='Shot', eventType=None):
+    eventType = eventType or 'Shotgun_%s_Change' % entityType
+    return [{
+        'type': 'EventLogEntry',
+        'id': i,
+        'event_type': eventType,
+        'attribute_name': 'code',
+        'meta': {'entity_type': entityType, 'entity_id': i % 7},
+        'entity': {'type': entityType, 'id': i % 7},
+        'created_at': i,
+    } for i in range(firstId, lastId + 1)]
+
+
+class Shotgun(object):
+    def __init__(self, server, name, key, *args, **kwargs):
+        self.server = server
+        self.name = name
+        self.key = key
+
+    def find(self, entityType, filters, fields=None, order=None, filter_operator=None, limit=0, **kwargs):
+        if entityType != 'EventLogEntry':
+            return []
+        events = [e for e in EVENTS if self._match(e, filters)]
+        events.sort(key=lambda e: e['id'])
+        if order and order[0].get('direction') == 'desc':
+            events.reverse()
+        if limit:
+            events = events[:limit]
+        return [self._select(e, fields) for e in events]
+
+    def find_one(self, entityType, filters, fields=None, order=None, **kwargs):
+        result = self.find(entityType, filters, fields, order, limit=1)
+        return result and result[0] or None
+
+    def _match(self, event, filters):
+        for field, operator, value in filters:
+            if operator == 'greater_than' and not event[field] > value:
+                return False
+            if operator == 'less_than' and not event[field] < value:
+                return False
+            if operator == 'in' and event[field] not in value:
+                return False
+            if operator == 'is' and event[field] != value:
+                return False
+        return True
+
+    def _select(self, event, fields):
+        if not fields:
+            return dict(event)
+        return dict([(f, event.get(f)) for f in ['type', 'id'] + list(fields)])
+
+
+# The daemon is always pointed at the fake server, which also stands in for
+# the API when it is not installed.
+try:
+    import shotgun_api3
+except ImportError:
+    sys.modules['shotgun_api3'] = sys.modules[__name__]
+
+import shotgunEventDaemon as daemon
+daemon.sg = sys.modules[__name__]
+
+
+class DaemonTestCase(unittest.TestCase):
+    # Gives each test a directory of its own with a config file pointing in
+    # it and a plugins directory to write plugins to.
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix='shotgunEventDaemonTest')
+        self.pluginsDir = os.path.join(self.tempDir, 'plugins')
+        os.mkdir(self.pluginsDir)
+        EVENTS[:] = []
+        self.handlers = logging.getLogger().handlers[:]
+        self.level = logging.getLogger().level
+
+    def tearDown(self):
+        # Entry points add log handlers of their own and set the level.
+        logging.getLogger().handlers[:] = self.handlers
+        logging.getLogger().setLevel(self.level)
+        shutil.rmtree(self.tempDir)
+        EVENTS[:] = []
+
+    def writeConfig(self, sections=None):
+        sections = sections or {}
+        values = {
+            'daemon': {
+                'pidFile': os.path.join(self.tempDir, 'pid'),
+                'eventIdFile': os.path.join(self.tempDir, 'id'),
+                'logFile': os.path.join(self.tempDir, 'log'),
+                'logging': '40',
+            },
+            'shotgun': {'server': 'https://fake', 'name': 'name', 'key': 'key'},
+            'plugins': {'paths': self.pluginsDir},
+            'emails': {'server': '', 'from': '', 'to': '', 'subject': ''},
+        }
+        for section, options in sections.items():
+            values.setdefault(section, {}).update(options)
+        path = os.path.join(self.tempDir, 'shotgunEventDaemon.conf')
+        fh = open(path, 'w')
+        for section, options in sorted(values.items()):
+            fh.write('[%s]\n' % section)
+            for option, value in sorted(options.items()):
+                fh.write('%s: %s\n' % (option, value))
+            fh.write('\n')
+        fh.close()
+        return path
+
+    def writePlugin(self, name, source):
+        path = os.path.join(self.pluginsDir, name + '.py')
+        fh = open(path, 'w')
+        fh.write(textwrap.dedent(source))
+        fh.close()
+        return path
+
+    def readIds(self, name):
+        path = os.path.join(self.tempDir, name)
+        if not os.path.exists(path):
+            return []
+        return [int(line) for line in open(path).read().split()]
@@ -0,0 +1,135 @@
+import os
+import random
+import threading
+import time
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+# A coroutine callback run on the loop and a callback run on the threads,
+# both recording the events they are given.
+ASYNC_PLUGIN = """
+    import os, random
+    import trollius as asyncio
+
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', onEventAsync, %(tempDir)r)
+        reg.registerCallback('name', 'key', onEvent, %(tempDir)r)
+
+    @asyncio.coroutine
+    def onEventAsync(sg, event, tempDir):
+        yield asyncio.From(asyncio.sleep(random.random() * 0.01))
+        open(os.path.join(tempDir, 'async'), 'a').write('%%d %%d\\n' %% (event['entity']['id'], event['id']))
+
+    def onEvent(sg, event, tempDir):
+        open(os.path.join(tempDir, 'threaded'), 'a').write('%%d %%d\\n' %% (event['entity']['id'], event['id']))
+        if event['id'] == 50:
+            os.remove(os.path.join(tempDir, 'pid'))
+"""
+
+
+class _Callback(object):
+    def __init__(self, name, ordered=False, async=False):
+        self._name = name
+        self._ordered = ordered
+        self._async = async
+
+    def getName(self):
+        return self._name
+
+    def isOrdered(self):
+        return self._ordered
+
+    def isAsync(self):
+        return self._async
+
+
+@unittest.skipIf(daemon.asyncio is None, 'The asynchronous engine needs the trollius package.')
+class AsyncDispatcherTest(shotgunFake.DaemonTestCase):
+    def setUp(self):
+        shotgunFake.DaemonTestCase.setUp(self)
+        self.processed = {}
+        self.lock = threading.Lock()
+
+    def record(self, callback, event):
+        self.lock.acquire()
+        try:
+            self.processed.setdefault(callback.getName(), []).append(event)
+        finally:
+            self.lock.release()
+
+    def runCallback(self, callback, event):
+        time.sleep(random.random() * 0.005)
+        self.record(callback, event)
+
+    def runCallbackAsync(self, callback, event):
+        yield daemon.From(daemon.asyncio.sleep(random.random() * 0.005, loop=self.loop))
+        self.record(callback, event)
+
+    def dispatch(self, events, callbacks):
+        self.loop = daemon.asyncio.new_event_loop()
+        dispatcher = daemon.AsyncDispatcher(self.loop, 8, 100, self.runCallback, self.runCallbackAsync)
+        for event in events:
+            dispatcher.dispatch(event, callbacks)
+        dispatcher.shutdown()
+        return dispatcher.getCompletedEventId()
+
+    def getEntityOrders(self, events):
+        orders = {}
+        for event in events:
+            entity = event['entity'] or {'id': event['meta']['entity_id']}
+            orders.setdefault(entity['id'], []).append(event['id'])
+        return orders
+
+    def testOrdering(self):
+        events = shotgunFake.makeEvents(1, 60)
+        # Retired entities still follow the order of their entity.
+        for event in events[40:]:
+            event['event_type'] = 'Shotgun_Shot_Retirement'
+            event['entity'] = None
+        callbacks = [_Callback('threaded'), _Callback('async', async=True), _Callback('ordered', ordered=True)]
+        self.assertEqual(self.dispatch(events, callbacks), 60)
+
+        expected = self.getEntityOrders(events)
+        for name in ('threaded', 'async'):
+            self.assertEqual(len(self.processed[name]), 60)
+            self.assertEqual(self.getEntityOrders(self.processed[name]), expected)
+        self.assertEqual([e['id'] for e in self.processed['ordered']], range(1, 61))
+
+
+@unittest.skipIf(daemon.asyncio is None, 'The asynchronous engine needs the trollius package.')
+class AsyncEngineTest(shotgunFake.DaemonTestCase):
+    def readRecords(self, name):
+        orders = {}
+        path = os.path.join(self.tempDir, name)
+        for line in open(path).read().splitlines():
+            entityId, eventId = [int(v) for v in line.split()]
+            orders.setdefault(entityId, []).append(eventId)
+        return orders
+
+    def testEngine(self):
+        shotgunFake.EVENTS.extend(shotgunFake.makeEvents(1, 50))
+        self.writePlugin('async', ASYNC_PLUGIN % {'tempDir': self.tempDir})
+        open(os.path.join(self.tempDir, 'id'), 'w').write('0\n')
+        config = daemon.Config(self.writeConfig({'daemon': {'asyncEngine': 'true', 'asyncConcurrency': '8'}}))
+
+        engine = daemon.AsyncEngine(config)
+        thread = threading.Thread(target=engine.start)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.isAlive(), 'The daemon did not stop.')
+
+        # Each callback saw the events of every entity in order.
+        expected = {}
+        for event in shotgunFake.EVENTS:
+            expected.setdefault(event['entity']['id'], []).append(event['id'])
+        self.assertEqual(self.readRecords('async'), expected)
+        self.assertEqual(self.readRecords('threaded'), expected)
+        self.assertEqual(open(os.path.join(self.tempDir, 'id')).read(), '50\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+BATCH_PLUGIN = """
+    import os
+
+    def registerCallbacks(reg):
+        reg.registerBatchCallback('name', 'key', onEvents, %r, window=60, coalesce='entity')
+
+    def onEvents(sg, events, tempDir):
+        for event in events:
+            open(os.path.join(tempDir, 'processed'), 'a').write('%%d\\n' %% event['id'])
+"""
+
+
+class _Callback(object):
+    def __init__(self, coalesce=(), window=60.0, maxEvents=1000):
+        self._coalesce = list(coalesce)
+        self._window = window
+        self._maxEvents = maxEvents
+        self.batches = []
+
+    def getName(self):
+        return 'plugin.onEvents'
+
+    def getCoalesce(self):
+        return self._coalesce
+
+    def getWindow(self):
+        return self._window
+
+    def getMaxEvents(self):
+        return self._maxEvents
+
+    def process(self, events):
+        self.batches.append([e['id'] for e in events])
+        return True
+
+
+class BatcherTest(shotgunFake.DaemonTestCase):
+    def getIds(self, events):
+        return [e['id'] for e in events]
+
+    def testCoalesceOnEntity(self):
+        batcher = daemon.Batcher(_Callback(['entity']))
+        for event in shotgunFake.makeEvents(1, 10):
+            batcher.add(event)
+        # Only the latest event of each of the 7 entities is kept.
+        self.assertEqual(self.getIds(batcher.take()), [4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual(batcher.take(), [])
+
+    def testCoalesceOnEntityAndAttribute(self):
+        batcher = daemon.Batcher(_Callback(['entity', 'attribute']))
+        events = shotgunFake.makeEvents(1, 4)
+        events[0]['entity'] = events[1]['entity'] = {'type': 'Shot', 'id': 1}
+        events[2]['entity'] = events[3]['entity'] = {'type': 'Shot', 'id': 1}
+        events[0]['attribute_name'] = events[2]['attribute_name'] = 'code'
+        events[1]['attribute_name'] = events[3]['attribute_name'] = 'sg_status_list'
+        for event in events:
+            batcher.add(event)
+        self.assertEqual(self.getIds(batcher.take()), [3, 4])
+
+        # Events are all kept without coalescing.
+        batcher = daemon.Batcher(_Callback())
+        for event in events:
+            batcher.add(event)
+        self.assertEqual(self.getIds(batcher.take()), [1, 2, 3, 4])
+
+    def testDueTime(self):
+        batcher = daemon.Batcher(_Callback(window=5.0, maxEvents=3))
+        self.assertEqual(batcher.getDueTime(), None)
+        events = shotgunFake.makeEvents(1, 3)
+        batcher.add(events[0])
+        started = batcher.getDueTime() - 5.0
+        batcher.add(events[1])
+        self.assertEqual(batcher.getDueTime(), started + 5.0)
+        # A full batch is due right away.
+        batcher.add(events[2])
+        self.assertEqual(batcher.getDueTime(), started)
+
+    def testHeldEventId(self):
+        callback = _Callback()
+        batcher = daemon.Batcher(callback)
+        self.assertEqual(batcher.getHeldEventId(), None)
+        for event in shotgunFake.makeEvents(3, 5):
+            batcher.add(event)
+        self.assertEqual(batcher.getHeldEventId(), 3)
+
+        # A batch being processed holds the checkpoint back as well as the
+        # events gathered since.
+        events = batcher.take()
+        for event in shotgunFake.makeEvents(6, 7):
+            batcher.add(event)
+        self.assertEqual(batcher.getHeldEventId(), 3)
+        batcher.process(events)
+        self.assertEqual(callback.batches, [[3, 4, 5]])
+        self.assertEqual(batcher.getHeldEventId(), 6)
+        batcher.process(batcher.take())
+        self.assertEqual(batcher.getHeldEventId(), None)
+
+    def testCheckpointHeldByBatch(self):
+        self.writePlugin('batch', BATCH_PLUGIN % self.tempDir)
+        open(os.path.join(self.tempDir, 'id'), 'w').write('0\n')
+        engine = daemon.Engine(daemon.Config(self.writeConfig()))
+        engine._loadLastEventId()
+        engine.load()
+
+        for event in shotgunFake.makeEvents(1, 10):
+            engine._lastEventId = event['id']
+            engine._dispatchEvent(event, {})
+            engine._saveEventId(event['id'])
+        # The gathered events are not processed yet, so not checkpointed.
+        self.assertEqual(self.readIds('processed'), [])
+        self.assertEqual(engine._processedEventId, 0)
+
+        engine._flushBatches(True)
+        self.assertEqual(self.readIds('processed'), [4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual(engine._processedEventId, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
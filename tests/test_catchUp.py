@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+# Falls behind on its first events and stops the daemon once it has seen the
+# last one, whichever track it is on by then.
+SLOW_PLUGIN = """
+    import os, time
+
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', onEvent, %r)
+
+    def onEvent(sg, event, tempDir):
+        open(os.path.join(tempDir, 'processed'), 'a').write('%%d\\n' %% event['id'])
+        if event['id'] <= 5:
+            time.sleep(0.02)
+        if event['id'] == 50:
+            os.remove(os.path.join(tempDir, 'pid'))
+"""
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class CatchUpTest(shotgunFake.DaemonTestCase):
+    def setUp(self):
+        shotgunFake.DaemonTestCase.setUp(self)
+        shotgunFake.EVENTS.extend(shotgunFake.makeEvents(1, 50))
+        self.writePlugin('slow', SLOW_PLUGIN % self.tempDir)
+        self.config = daemon.Config(self.writeConfig({'daemon': {'callbackMaxLag': '0.05', 'pollInterval': '0.1'}}))
+        self.handler = _ListHandler()
+        logging.getLogger().addHandler(self.handler)
+        logging.getLogger().setLevel(logging.INFO)
+
+    def tearDown(self):
+        logging.getLogger().setLevel(logging.WARNING)
+        shotgunFake.DaemonTestCase.tearDown(self)
+
+    def startEngine(self):
+        # The slow callback is the one that stops the daemon.
+        engine = daemon.Engine(self.config)
+        thread = threading.Thread(target=engine.start)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.isAlive(), 'The daemon did not stop.')
+        return engine
+
+    def testFallsBehind(self):
+        open(os.path.join(self.tempDir, 'id'), 'w').write('0\n')
+        engine = self.startEngine()
+
+        # The callback is moved to the catch up track where it carries on
+        # after the last event it was given, in order.
+        self.assertTrue([m for m in self.handler.messages if m.startswith('Callback slow.onEvent is falling behind')])
+        self.assertEqual(self.readIds('processed'), range(1, 51))
+        self.assertEqual(engine._lagging, {'slow.onEvent': 50})
+
+        # It is back with the others once its cursor has reached the live one.
+        engine._promoteCallbacks()
+        self.assertEqual(engine._lagging, {})
+        engine._checkpoint.flush()
+        self.assertEqual(open(os.path.join(self.tempDir, 'id')).read(), '50\n')
+
+    def testResumesFromCursor(self):
+        # The callback was catching up when the daemon stopped.
+        open(os.path.join(self.tempDir, 'id'), 'w').write('50\nslow.onEvent 20\n')
+        engine = self.startEngine()
+
+        self.assertEqual(self.readIds('processed'), range(21, 51))
+        self.assertEqual(engine._lagging, {'slow.onEvent': 50})
+        self.assertEqual(open(os.path.join(self.tempDir, 'id')).read(), '50\nslow.onEvent 50\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
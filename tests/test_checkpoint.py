@@ -0,0 +1,63 @@
+import logging
+import os
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+PLUGIN = """
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', onEvent, None)
+
+    def onEvent(sg, event, args):
+        pass
+"""
+
+
+class CheckpointTest(shotgunFake.DaemonTestCase):
+    def testCursorsOfRemovedCallbacks(self):
+        self.writePlugin('kept', PLUGIN)
+        open(os.path.join(self.tempDir, 'id'), 'w').write('100\nkept.onEvent 50\nremoved.onEvent 20\n')
+        engine = daemon.Engine(daemon.Config(self.writeConfig()))
+        engine._loadLastEventId()
+        self.assertEqual(sorted(engine._lagging), ['kept.onEvent', 'removed.onEvent'])
+
+        engine.load()
+        self.assertEqual(engine._lagging, {'kept.onEvent': 50})
+        engine._checkpoint.flush()
+        self.assertEqual(open(os.path.join(self.tempDir, 'id')).read(), '100\nkept.onEvent 50\n')
+
+    def testCursorsOfModulesThatFailedToLoad(self):
+        self.writePlugin('broken', 'def registerCallbacks(reg):\n    raise RuntimeError()\n')
+        open(os.path.join(self.tempDir, 'id'), 'w').write('100\nbroken.onEvent 50\n')
+        engine = daemon.Engine(daemon.Config(self.writeConfig()))
+        engine._loadLastEventId()
+        logging.disable(logging.CRITICAL)
+        try:
+            engine.load()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(engine._lagging, {'broken.onEvent': 50})
+
+    def testSkippedEvents(self):
+        path = os.path.join(self.tempDir, 'id')
+        checkpoint = daemon.Checkpoint(path, maxSkipped=4)
+        checkpoint.addSkipped('plugin.onEvent', [9, 3, 5])
+        checkpoint.addSkipped('plugin.onEvent', [5, 12, 15])
+        checkpoint.addSkipped('other.onEvent', [7])
+        checkpoint.removeSkipped('other.onEvent', [7])
+        checkpoint.update(20)
+        checkpoint.flush()
+
+        # Only the newest maxSkipped events are kept, and read back by the
+        # next run.
+        checkpoint = daemon.Checkpoint(path)
+        self.assertEqual(checkpoint.load(), 20)
+        self.assertEqual(checkpoint.getSkippedCounts(), {'plugin.onEvent': 4})
+        self.assertEqual(checkpoint.getSkipped('plugin.onEvent'), [5, 9, 12, 15])
+        self.assertEqual(checkpoint.getSkipped('plugin.onEvent', afterId=9, limit=1), [12])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import logging
+import os
+import time
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+TIMEOUT_PLUGIN = """
+    import time
+
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', onEvent, None, timeout=0.05)
+
+    def onEvent(sg, event, args):
+        if event['id'] == 2:
+            time.sleep(0.3)
+"""
+
+
+class _Callback(object):
+    def __init__(self):
+        self.processed = []
+
+    def getName(self):
+        return 'plugin.onEvent'
+
+    def process(self, event):
+        self.processed.append(event['id'])
+        return True
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class CircuitBreakerTest(shotgunFake.DaemonTestCase):
+    def testOverruns(self):
+        breaker = daemon.CircuitBreaker(maxOverruns=2, failureRate=0, backoff=0.05, maxBackoff=0.15)
+        self.assertEqual(breaker.record(True, True), None)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.record(None, True), daemon.CircuitBreaker.OPEN)
+        self.assertTrue(breaker.isOpen())
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.isTrialDue())
+
+        # A single trial run is allowed once the delay is over, the delay
+        # doubles up to the maximum while trials fail.
+        for delay in (0.1, 0.15):
+            time.sleep(0.06)
+            self.assertTrue(breaker.isTrialDue())
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            self.assertEqual(breaker.record(False, False), daemon.CircuitBreaker.OPEN)
+            self.assertEqual(breaker.getDelay(), delay)
+            time.sleep(delay - 0.06)
+        self.assertEqual(breaker.getTrips(), 3)
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.record(True, False), daemon.CircuitBreaker.CLOSED)
+        self.assertFalse(breaker.isOpen())
+        self.assertEqual(breaker.getDelay(), 0.05)
+        self.assertEqual(breaker.getTrips(), 0)
+
+    def testFailureRate(self):
+        breaker = daemon.CircuitBreaker(maxOverruns=0, failureRate=0.5, minRuns=4)
+        for success in (False, False, False):
+            self.assertEqual(breaker.record(success, False), None)
+        # The rate is only looked at once there are minRuns runs.
+        self.assertEqual(breaker.record(True, False), daemon.CircuitBreaker.OPEN)
+
+    def testWindow(self):
+        breaker = daemon.CircuitBreaker(maxOverruns=2, failureRate=0, window=0.05)
+        self.assertEqual(breaker.record(None, True), None)
+        time.sleep(0.06)
+        # The first overrun is out of the window.
+        self.assertEqual(breaker.record(None, True), None)
+        self.assertEqual(breaker.record(None, True), daemon.CircuitBreaker.OPEN)
+
+    def testQuarantinedEventsAreSkipped(self):
+        open(os.path.join(self.tempDir, 'id'), 'w').write('0\n')
+        config = daemon.Config(self.writeConfig({'daemon': {'breakerOverruns': '1', 'breakerBackoff': '60'}}))
+        engine = daemon.Engine(config)
+        engine._loadLastEventId()
+        callback = _Callback()
+        events = shotgunFake.makeEvents(1, 3)
+
+        logging.disable(logging.CRITICAL)
+        try:
+            # The callback went over its budget on the first event.
+            engine._callbackDone(callback, events[0], 1.0, None)
+            for event in events[1:]:
+                engine._runCallback(callback, event)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(callback.processed, [])
+        self.assertEqual(engine._checkpoint.getSkipped('plugin.onEvent'), [1, 2, 3])
+
+
+class BudgetedRunTest(shotgunFake.DaemonTestCase):
+    def testWithinBudget(self):
+        run = daemon._BudgetedRun(lambda a, b: a + b, (1, 2), 'Adding')
+        self.assertTrue(run.start(1.0))
+        self.assertEqual(run.getResult(), 3)
+
+    def testOverBudget(self):
+        handler = _ListHandler()
+        logging.getLogger().addHandler(handler)
+        run = daemon._BudgetedRun(time.sleep, (0.2,), 'Sleeping')
+        self.assertFalse(run.start(0.05))
+        # The run carries on and tells when it is done.
+        time.sleep(0.3)
+        self.assertTrue([m for m in handler.messages if m.startswith('Sleeping finished') and m.endswith('s after its time budget.')])
+
+    def testCallbackTimeout(self):
+        path = self.writePlugin('timeout', TIMEOUT_PLUGIN)
+        module = daemon.Module('https://fake', path, daemon.ConnectionPool(1))
+        callback = list(module)[0]
+        events = shotgunFake.makeEvents(1, 2)
+        self.assertEqual(callback.process(events[0]), True)
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertEqual(callback.process(events[1]), None)
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+from shotgunFake import daemon
+
+
+CREDENTIALS = ('https://fake', 'name', 'key')
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def testReuse(self):
+        pool = daemon.ConnectionPool(2)
+        first = pool.acquire(*CREDENTIALS)
+        second = pool.acquire(*CREDENTIALS)
+        self.assertTrue(first is not second)
+        pool.release(first, *CREDENTIALS)
+        pool.release(second, *CREDENTIALS)
+
+        # The most recently released connection is handed out first.
+        self.assertTrue(pool.acquire(*CREDENTIALS) is second)
+        self.assertTrue(pool.acquire(*CREDENTIALS) is first)
+        self.assertEqual(pool.getStats(), {'hits': 2, 'misses': 2, 'connections': 2})
+
+    def testCredentials(self):
+        pool = daemon.ConnectionPool(2)
+        conn = pool.acquire(*CREDENTIALS)
+        pool.release(conn, *CREDENTIALS)
+        other = pool.acquire('https://fake', 'other', 'key')
+        self.assertTrue(other is not conn)
+        self.assertEqual(other.name, 'other')
+
+    def testMaxIdle(self):
+        pool = daemon.ConnectionPool(1)
+        conns = [pool.acquire(*CREDENTIALS) for i in range(2)]
+        closed = []
+        for conn in conns:
+            conn.close = lambda conn=conn: closed.append(conn)
+            pool.release(conn, *CREDENTIALS)
+        # Connections past maxIdle are closed rather than kept.
+        self.assertEqual(closed, [conns[1]])
+        self.assertEqual(pool.getStats()['connections'], 1)
+
+    def testEntityCache(self):
+        # Callbacks reach the shared entity cache through their connection.
+        cache = daemon.EntityCache(10)
+        conn = daemon.ConnectionPool(1, cache).acquire(*CREDENTIALS)
+        self.assertTrue(conn.entityCache._cache is cache)
+        self.assertTrue(conn.entityCache._conn is conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
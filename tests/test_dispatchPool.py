@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+class _Callback(object):
+    def __init__(self, name, ordered=False):
+        self._name = name
+        self._ordered = ordered
+
+    def getName(self):
+        return self._name
+
+    def isOrdered(self):
+        return self._ordered
+
+
+class DispatchPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.processed = []
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def runCallback(self, callback, event):
+        if event['id'] == 2:
+            raise RuntimeError('Escaped from the callback.')
+        self.processed.append(event['id'])
+
+    def shutdown(self, pool):
+        thread = threading.Thread(target=pool.shutdown)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.isAlive(), 'The pool did not shut down.')
+
+    def testShutdownAfterError(self):
+        pool = daemon.DispatchPool(2, 10, self.runCallback)
+        callback = _Callback('callback', ordered=True)
+        for event in shotgunFake.makeEvents(1, 5):
+            pool.dispatch(event, [callback])
+        self.shutdown(pool)
+
+        # The events after the failed one still run and the completed id
+        # moves past it.
+        self.assertEqual(self.processed, [1, 3, 4, 5])
+        self.assertEqual(pool.getCompletedEventId(), 5)
+        self.assertFalse(pool.hasPending(callback))
+
+    def testRetirementAfterUpdate(self):
+        processed = []
+        def runCallback(callback, event):
+            if event['id'] == 1:
+                time.sleep(0.2)
+            processed.append(event['id'])
+
+        # The retirement comes without its entity but still waits for the
+        # update of the same entity.
+        update = shotgunFake.makeEvents(1, 1)[0]
+        retirement = shotgunFake.makeEvents(8, 8, eventType='Shotgun_Shot_Retirement')[0]
+        retirement['entity'] = None
+        self.assertEqual(retirement['meta']['entity_id'], update['entity']['id'])
+
+        pool = daemon.DispatchPool(2, 10, runCallback)
+        callback = _Callback('callback')
+        pool.dispatch(update, [callback])
+        pool.dispatch(retirement, [callback])
+        self.shutdown(pool)
+        self.assertEqual(processed, [1, 8])
+
+
+if __name__ == '__main__':
+    unittest.main()
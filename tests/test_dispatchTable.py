@@ -0,0 +1,46 @@
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+SHOT_PLUGIN = """
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', onShot, None, entityTypes=['Shot'])
+
+    def onShot(sg, event, args):
+        pass
+"""
+
+
+class DispatchTableTest(shotgunFake.DaemonTestCase):
+    def getDispatchTable(self):
+        path = self.writePlugin('shot', SHOT_PLUGIN)
+        return daemon.DispatchTable([daemon.Module('https://fake', path, daemon.ConnectionPool(1))])
+
+    def testRetirement(self):
+        # Retirement events come without their entity.
+        dispatchTable = self.getDispatchTable()
+        event = shotgunFake.makeEvents(1, 1, 'Shot', 'Shotgun_Shot_Retirement')[0]
+        event['entity'] = None
+        self.assertEqual(len(dispatchTable.getCallbacks(event)), 1)
+
+        del event['meta']
+        self.assertEqual(len(dispatchTable.getCallbacks(event)), 1)
+
+        event = shotgunFake.makeEvents(2, 2, 'Asset', 'Shotgun_Asset_Retirement')[0]
+        event['entity'] = None
+        self.assertEqual(dispatchTable.getCallbacks(event), [])
+
+    def testEventWithoutEntity(self):
+        event = shotgunFake.makeEvents(1, 1, eventType='Shotgun_User_Login')[0]
+        event['entity'] = None
+        event['meta'] = {'type': 'login'}
+        self.assertEqual(daemon._getEntityType(event), None)
+
+        event['event_type'] = 'Shotgun_Shot_Retirement'
+        self.assertEqual(daemon._getEntityType(event), 'Shot')
+
+
+if __name__ == '__main__':
+    unittest.main()
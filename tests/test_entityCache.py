@@ -0,0 +1,102 @@
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+class _Conn(object):
+    # Serves Shot entities whose fields are named after their values.
+    def __init__(self):
+        self.queries = []
+        self.onQuery = None
+
+    def find_one(self, entityType, filters, fields):
+        entityId = filters[0][2]
+        self.queries.append((entityId, list(fields)))
+        if self.onQuery is not None:
+            self.onQuery()
+        entity = {'type': entityType, 'id': entityId}
+        for field in fields:
+            entity[field] = '%s %d' % (field, entityId)
+        return entity
+
+
+class EntityCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = daemon.EntityCache(2)
+        self.conn = _Conn()
+
+    def changeEvent(self, entityId, attributeName='code', eventType='Shotgun_Shot_Change'):
+        event = shotgunFake.makeEvents(1, 1, eventType=eventType)[0]
+        event['entity'] = {'type': 'Shot', 'id': entityId}
+        event['meta']['entity_id'] = entityId
+        event['attribute_name'] = attributeName
+        return event
+
+    def testReadThrough(self):
+        self.assertEqual(self.cache.get(self.conn, 'Shot', 1, ['code'])['code'], 'code 1')
+        self.assertEqual(self.cache.get(self.conn, 'Shot', 1, ['code']), {'type': 'Shot', 'id': 1, 'code': 'code 1'})
+        # Fields not cached yet are fetched and added to the entry.
+        self.cache.get(self.conn, 'Shot', 1, ['code', 'description'])
+        self.cache.get(self.conn, 'Shot', 1, ['description'])
+        self.assertEqual(len(self.conn.queries), 2)
+        self.assertEqual(self.cache.getStats()['hits'], 2)
+
+    def testLinkedFields(self):
+        self.cache.get(self.conn, 'Shot', 1, ['sg_sequence.Sequence.code'])
+        self.cache.get(self.conn, 'Shot', 1, ['sg_sequence.Sequence.code'])
+        self.assertEqual(len(self.conn.queries), 2)
+
+    def testDisabled(self):
+        cache = daemon.EntityCache(0)
+        cache.get(self.conn, 'Shot', 1, ['code'])
+        cache.get(self.conn, 'Shot', 1, ['code'])
+        self.assertEqual(len(self.conn.queries), 2)
+
+    def testEviction(self):
+        for entityId in (1, 2, 1, 3):
+            self.cache.get(self.conn, 'Shot', entityId, ['code'])
+        # Shot 2 was the least recently used.
+        self.assertEqual(self.cache.getStats()['evictions'], 1)
+        self.cache.get(self.conn, 'Shot', 1, ['code'])
+        self.cache.get(self.conn, 'Shot', 2, ['code'])
+        self.assertEqual([q[0] for q in self.conn.queries], [1, 2, 3, 2])
+
+    def testInvalidate(self):
+        self.cache.get(self.conn, 'Shot', 1, ['code', 'description'])
+        # A change only drops the changed field.
+        self.cache.invalidate(self.changeEvent(1, 'code'))
+        self.cache.get(self.conn, 'Shot', 1, ['description'])
+        self.cache.get(self.conn, 'Shot', 1, ['code'])
+        self.assertEqual(len(self.conn.queries), 2)
+
+        # Other events drop the entity.
+        self.cache.invalidate(self.changeEvent(1, None, 'Shotgun_Shot_New'))
+        self.cache.get(self.conn, 'Shot', 1, ['description'])
+        self.assertEqual(len(self.conn.queries), 3)
+
+    def testRetirement(self):
+        self.cache.get(self.conn, 'Shot', 1, ['code'])
+        self.cache.get(self.conn, 'Shot', 2, ['code'])
+        event = self.changeEvent(1, None, 'Shotgun_Shot_Retirement')
+        event['entity'] = None
+        self.cache.invalidate(event)
+        self.assertEqual(self.cache.getStats()['entries'], 1)
+
+        # Without the meta data every entity of the type is dropped.
+        del event['meta']
+        self.cache.invalidate(event)
+        self.assertEqual(self.cache.getStats()['entries'], 0)
+
+    def testReadDuringInvalidation(self):
+        # The entity changed while it was being read, what was read may be
+        # from before the change and is not cached.
+        self.conn.onQuery = lambda: self.cache.invalidate(self.changeEvent(1, 'code'))
+        self.cache.get(self.conn, 'Shot', 1, ['code'])
+        self.conn.onQuery = None
+        self.cache.get(self.conn, 'Shot', 1, ['code'])
+        self.assertEqual(len(self.conn.queries), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+class FetchTest(shotgunFake.DaemonTestCase):
+    def getEngine(self):
+        config = daemon.Config(self.writeConfig({'daemon': {'fetchPageSize': '500'}}))
+        engine = daemon.Engine(config)
+        engine._lastEventId = 0
+        return engine
+
+    def testBacklogDrained(self):
+        # The pager walks the whole backlog, nothing is left to poll again
+        # for right away.
+        shotgunFake.EVENTS.extend(shotgunFake.makeEvents(1, 1200))
+        engine = self.getEngine()
+        self.assertEqual([e['id'] for e in engine._getNewEvents()], range(1, 1201))
+        self.assertFalse(engine._lastPageFull)
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = daemon.PollScheduler(interval=1.0, maxInterval=4.0, errorMaxInterval=10.0, backoff=2.0)
+
+    def testIdle(self):
+        # The delay grows while nothing comes in and is back to the interval
+        # with the first events.
+        self.assertEqual([self.scheduler.poll(0.1, 0, False, False) for i in range(4)], [2.0, 4.0, 4.0, 4.0])
+        self.assertEqual(self.scheduler.poll(0.1, 3, False, False), 1.0)
+
+    def testFullPage(self):
+        self.assertEqual(self.scheduler.poll(0.1, 500, True, False), 0.0)
+        self.assertEqual(self.scheduler.poll(0.1, 20, False, False), 1.0)
+
+    def testErrors(self):
+        self.assertEqual([self.scheduler.poll(0.1, 0, False, True) for i in range(4)], [2.0, 4.0, 8.0, 10.0])
+        # A full page after the errors is looked past right away.
+        self.assertEqual(self.scheduler.poll(0.1, 500, True, False), 0.0)
+        self.assertEqual(self.scheduler.poll(0.1, 0, False, True), 2.0)
+
+    def testStats(self):
+        self.scheduler.poll(0.5, 0, False, False)
+        self.scheduler.poll(0.25, 0, False, False)
+        self.scheduler.slept(2.0)
+        stats = self.scheduler.getStats()
+        self.assertEqual((stats['polls'], stats['pollTime'], stats['lastPollTime']), (2, 0.75, 0.25))
+        self.assertEqual((stats['sleeps'], stats['sleepTime'], stats['lastSleepTime']), (1, 2.0, 2.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import time
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+RECORD_PLUGIN = """
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', record, %r)
+
+    def record(sg, event, path):
+        open(path, 'a').write('%%d\\n' %% event['id'])
+"""
+
+
+class GapTrackerTest(shotgunFake.DaemonTestCase):
+    def testGaps(self):
+        tracker = daemon.GapTracker(ttl=60.0, checkInterval=0.0, batchSize=2)
+        tracker.observe(None, 1)
+        tracker.observe(1, 2)
+        self.assertEqual(len(tracker), 0)
+        self.assertFalse(tracker.isDue())
+
+        tracker.observe(2, 6)
+        tracker.observe(6, 8)
+        self.assertEqual(len(tracker), 4)
+        self.assertTrue(tracker.isDue())
+        self.assertEqual(tracker.getBatches(), [[3, 4], [5, 7]])
+        tracker.fill([4, 7])
+        self.assertEqual(tracker.getBatches(), [[3, 5]])
+
+    def testCheckInterval(self):
+        tracker = daemon.GapTracker(checkInterval=60.0)
+        tracker.observe(1, 3)
+        self.assertFalse(tracker.isDue())
+
+    def testMaxIds(self):
+        # Gaps too large to look for are not tracked.
+        tracker = daemon.GapTracker(maxIds=5)
+        tracker.observe(1, 5)
+        tracker.observe(5, 10)
+        self.assertEqual(len(tracker), 3)
+
+    def testExpiry(self):
+        tracker = daemon.GapTracker(ttl=0.05, checkInterval=0.0)
+        tracker.observe(1, 3)
+        time.sleep(0.06)
+        tracker.observe(3, 5)
+        self.assertEqual(tracker.getBatches(), [[4]])
+
+    def testLateEvents(self):
+        events = shotgunFake.makeEvents(1, 5)
+        shotgunFake.EVENTS.extend(events[:2] + events[4:])
+        self.writePlugin('record', RECORD_PLUGIN % os.path.join(self.tempDir, 'processed'))
+        config = daemon.Config(self.writeConfig({'daemon': {'gapCheckInterval': '0'}}))
+        engine = daemon.Engine(config)
+        engine.load()
+        engine._lastEventId = 0
+        for event in engine._getNewEvents():
+            engine._gapTracker.observe(engine._lastEventId, event['id'])
+            engine._lastEventId = event['id']
+            engine._dispatchEvent(event, {})
+
+        # The events committed late are dispatched once they show up.
+        shotgunFake.EVENTS.extend(events[2:4])
+        engine._recoverGaps({})
+        self.assertEqual(self.readIds('processed'), [1, 2, 5, 3, 4])
+        self.assertEqual(len(engine._gapTracker), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+class EventJournalTest(shotgunFake.DaemonTestCase):
+    def setUp(self):
+        shotgunFake.DaemonTestCase.setUp(self)
+        self.path = os.path.join(self.tempDir, 'journal')
+
+    def testReadBack(self):
+        journal = daemon.EventJournal(self.path, segmentSize=2000)
+        journal.append(0, shotgunFake.makeEvents(1, 50))
+        journal.append(50, shotgunFake.makeEvents(51, 100))
+        journal.close()
+
+        # Read back across segments by a journal opened afresh.
+        journal = daemon.EventJournal(self.path)
+        self.assertTrue(len(os.listdir(self.path)) > 2)
+        events, coveredId = journal.read(0)
+        self.assertEqual([e['id'] for e in events], range(1, 101))
+        self.assertEqual(coveredId, 100)
+        self.assertEqual(events[9], shotgunFake.makeEvents(10, 10)[0])
+
+        events, coveredId = journal.read(40, limit=10)
+        self.assertEqual([e['id'] for e in events], range(41, 51))
+        self.assertEqual(coveredId, 50)
+
+        events, coveredId = journal.read(90, maxId=95)
+        self.assertEqual([e['id'] for e in events], range(91, 96))
+        self.assertEqual(coveredId, 95)
+
+    def testGapNotCovered(self):
+        # Events after a jump in the stream are in a segment of their own, the
+        # ids in between are not answered from the journal.
+        journal = daemon.EventJournal(self.path)
+        journal.append(0, shotgunFake.makeEvents(1, 10))
+        journal.append(20, shotgunFake.makeEvents(21, 30))
+        self.assertEqual(journal.read(15), ([], None))
+        events, coveredId = journal.read(5)
+        self.assertEqual([e['id'] for e in events], range(6, 11))
+        self.assertEqual(coveredId, 10)
+
+    def testTruncatedIndex(self):
+        journal = daemon.EventJournal(self.path)
+        journal.append(0, shotgunFake.makeEvents(1, 10))
+        journal.close()
+
+        # An index entry cut short by a crash is dropped and appending goes on
+        # after the last whole entry.
+        indexPath = [os.path.join(self.path, b) for b in os.listdir(self.path) if b.endswith('.index')][0]
+        fh = open(indexPath, 'ab')
+        fh.write('\0\0\0')
+        fh.close()
+        journal = daemon.EventJournal(self.path)
+        journal.append(10, shotgunFake.makeEvents(11, 20))
+        events, coveredId = journal.read(0)
+        self.assertEqual([e['id'] for e in events], range(1, 21))
+
+
+if __name__ == '__main__':
+    unittest.main()
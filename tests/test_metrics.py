@@ -0,0 +1,30 @@
+import time
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+class MetricsTest(unittest.TestCase):
+    def getValues(self, text):
+        return dict([line.split(' ', 1) for line in text.splitlines() if not line.startswith('#')])
+
+    def testLagBehindServer(self):
+        # A backlog is fetched a page at a time, the lag is measured against
+        # the newest event on the server all the same.
+        metrics = daemon.Metrics()
+        page = shotgunFake.makeEvents(1001, 1500)
+        for event in page:
+            event['created_at'] = time.time() - 60
+        metrics.observeFetch(0.1, page)
+        metrics.eventDispatched(page[0])
+        metrics.setServerHead(50000)
+
+        values = self.getValues(metrics.render(1001, {}))
+        self.assertEqual(values['shotgun_events_lag_events'], '48999')
+        self.assertEqual(values['shotgun_events_head_event_id'], '50000')
+        self.assertTrue(float(values['shotgun_events_lag_seconds']) >= 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
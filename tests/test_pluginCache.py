@@ -0,0 +1,115 @@
+import logging
+import os
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+# Leaves a marker when imported so lazy loading can be told apart.
+PLUGIN = """
+    import os
+    open(os.path.join(%(tempDir)r, 'imported'), 'a').write('x')
+
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', %(name)s, %(tempDir)r, entityTypes=['Shot'])
+
+    def %(name)s(sg, event, tempDir):
+        open(os.path.join(tempDir, 'processed'), 'a').write('%%d\\n' %% event['id'])
+"""
+
+# Only registers its callback while the register file exists.
+CONDITIONAL_PLUGIN = """
+    import os
+
+    def registerCallbacks(reg):
+        if os.path.exists(os.path.join(%r, 'register')):
+            reg.registerCallback('name', 'key', onEvent, None)
+
+    def onEvent(sg, event, args):
+        pass
+"""
+
+
+class PluginCacheTest(shotgunFake.DaemonTestCase):
+    def setUp(self):
+        shotgunFake.DaemonTestCase.setUp(self)
+        self.cache = daemon.PluginCache(os.path.join(self.tempDir, 'cache'))
+
+    def writeSource(self, name='onEvent'):
+        return self.writePlugin('plugin', PLUGIN % {'tempDir': self.tempDir, 'name': name})
+
+    def getImports(self):
+        path = os.path.join(self.tempDir, 'imported')
+        return os.path.exists(path) and len(open(path).read()) or 0
+
+    def testCode(self):
+        path = self.writeSource()
+        compiled = []
+        compileSource = daemon._compileSource
+        def countingCompile(sourcePath):
+            compiled.append(sourcePath)
+            return compileSource(sourcePath)
+        daemon._compileSource = countingCompile
+        try:
+            code = self.cache.getCode(path)
+            self.assertEqual(self.cache.getCode(path).co_filename, code.co_filename)
+            self.assertEqual(len(compiled), 1)
+
+            # A changed source is compiled again.
+            self.writeSource('onOtherEvent')
+            self.cache.getCode(path)
+            self.assertEqual(len(compiled), 2)
+        finally:
+            daemon._compileSource = compileSource
+
+    def testRegistrations(self):
+        path = self.writeSource()
+        self.assertEqual(self.cache.getRegistrations(path), None)
+        self.cache.setRegistrations(path, [{'name': 'plugin.onEvent'}])
+        self.assertEqual(self.cache.getRegistrations(path), [{'name': 'plugin.onEvent'}])
+
+        self.writeSource('onOtherEvent')
+        self.assertEqual(self.cache.getRegistrations(path), None)
+
+    def testLazyModule(self):
+        path = self.writeSource()
+        module = daemon.Module('https://fake', path, daemon.ConnectionPool(1), self.cache, lazy=True)
+        self.assertFalse(module.isLazy())
+        self.assertEqual(self.getImports(), 1)
+
+        # The next run knows the callbacks without importing the module.
+        module = daemon.Module('https://fake', path, daemon.ConnectionPool(1), self.cache, lazy=True)
+        self.assertTrue(module.isLazy())
+        self.assertEqual(self.getImports(), 1)
+        callback = list(module)[0]
+        self.assertEqual(callback.getName(), 'plugin.onEvent')
+        self.assertTrue(callback.matches('Shotgun_Shot_Change', 'Shot', 'code'))
+        self.assertFalse(callback.matches('Shotgun_Asset_Change', 'Asset', 'code'))
+
+        # It is imported for its first event.
+        self.assertTrue(callback.process(shotgunFake.makeEvents(1, 1)[0]))
+        self.assertFalse(module.isLazy())
+        self.assertEqual(self.getImports(), 2)
+        self.assertEqual(self.readIds('processed'), [1])
+
+    def testLazyCallbackNotRegistered(self):
+        path = self.writePlugin('plugin', CONDITIONAL_PLUGIN % self.tempDir)
+        marker = os.path.join(self.tempDir, 'register')
+        open(marker, 'w').close()
+        daemon.Module('https://fake', path, daemon.ConnectionPool(1), self.cache, lazy=True)
+        module = daemon.Module('https://fake', path, daemon.ConnectionPool(1), self.cache, lazy=True)
+
+        # The module no longer registers the callback by the time it is
+        # imported.
+        os.remove(marker)
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertFalse(list(module)[0].process(shotgunFake.makeEvents(1, 1)[0]))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.readIds('processed'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+# Kills the worker process running it on its first batch.
+CRASH_PLUGIN = """
+    import os
+
+    def registerCallbacks(reg):
+        reg.registerBatchCallback('name', 'key', crash, %r, window=0)
+
+    def crash(sg, events, tempDir):
+        marker = os.path.join(tempDir, 'crashed')
+        if not os.path.exists(marker):
+            open(marker, 'w').close()
+            os._exit(1)
+        for event in events:
+            open(os.path.join(tempDir, 'processed'), 'a').write('%%d\\n' %% event['id'])
+"""
+
+STOP_PLUGIN = """
+    import os, time
+
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', stop, %r)
+
+    def stop(sg, event, tempDir):
+        if event['id'] == 40:
+            os.remove(os.path.join(tempDir, 'pid'))
+        time.sleep(0.01)
+"""
+
+LOG_PLUGIN = """
+    import logging
+
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', log, None)
+
+    def log(sg, event, args):
+        logging.error('Processed event %d.', event['id'])
+"""
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ProcessWorkerTest(shotgunFake.DaemonTestCase):
+    def testWorkerDiesDuringBatch(self):
+        shotgunFake.EVENTS.extend(shotgunFake.makeEvents(1, 40))
+        self.writePlugin('crash', CRASH_PLUGIN % self.tempDir)
+        self.writePlugin('stop', STOP_PLUGIN % self.tempDir)
+        config = daemon.Config(self.writeConfig({'plugins': {'processWorkers': '1', 'processModules': 'crash'}}))
+        open(os.path.join(self.tempDir, 'id'), 'w').write('0\n')
+
+        handler = _ListHandler()
+        logging.getLogger().addHandler(handler)
+        engine = daemon.Engine(config)
+        thread = threading.Thread(target=engine.start)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(60)
+
+        self.assertFalse(thread.isAlive(), 'The daemon did not stop.')
+        self.assertTrue(os.path.exists(os.path.join(self.tempDir, 'crashed')))
+        self.assertTrue([m for m in handler.messages if m.startswith('Worker process') and 'the batch of events 1 to ' in m])
+        # The batches after the one the worker died on are processed by the
+        # worker started in its place.
+        self.assertTrue(self.readIds('processed'))
+        self.assertEqual(self.readIds('processed')[-1], 40)
+
+    def testForkedWhileLogging(self):
+        path = self.writePlugin('log', LOG_PLUGIN)
+        module = daemon.Module('https://fake', path, daemon.ConnectionPool(1))
+        handler = logging.FileHandler(os.path.join(self.tempDir, 'log'))
+        logging.getLogger().addHandler(handler)
+
+        # Another thread is writing a record when the worker is forked.
+        locked = threading.Event()
+        release = threading.Event()
+        def holdLock():
+            handler.acquire()
+            locked.set()
+            release.wait()
+            handler.release()
+        holder = threading.Thread(target=holdLock)
+        holder.start()
+        locked.wait()
+        pool = daemon.ProcessPool('https://fake', 1, 1)
+        release.set()
+        holder.join()
+
+        try:
+            thread = threading.Thread(target=pool.process, args=(module, 0, shotgunFake.makeEvents(1, 1)[0]))
+            thread.setDaemon(True)
+            thread.start()
+            thread.join(10)
+            self.assertFalse(thread.isAlive(), 'The worker did not log.')
+        finally:
+            pool.shutdown()
+            handler.close()
+        self.assertTrue('Processed event 1.' in open(os.path.join(self.tempDir, 'log')).read())
+
+
+if __name__ == '__main__':
+    unittest.main()
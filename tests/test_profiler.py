@@ -0,0 +1,48 @@
+import glob
+import os
+import threading
+import time
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+class ProfilerTest(shotgunFake.DaemonTestCase):
+    def getReports(self):
+        return glob.glob(os.path.join(self.tempDir, 'profile-*.txt'))
+
+    def testReport(self):
+        profiler = daemon.Profiler(os.path.join(self.tempDir, 'profile'), duration=0.2, interval=0.01)
+        profiler.start()
+        profiler.observeCallback('plugin.onEvent', 0.5)
+        profiler.observeCallback('plugin.onEvent', 1.5)
+        busy = threading.Thread(target=time.sleep, args=(1,), name='Busy-1')
+        busy.start()
+        profiler.request()
+        profiler._finished.wait(5)
+        busy.join()
+
+        self.assertEqual(len(self.getReports()), 1)
+        report = open(self.getReports()[0]).read()
+        self.assertTrue('samples taken every 0.01s' in report)
+        self.assertTrue('Busy' in report)
+
+    def testStopWaitsForSecondProfile(self):
+        profiler = daemon.Profiler(os.path.join(self.tempDir, 'profile'), duration=0.1, interval=0.01)
+        profiler.start()
+        profiler.request()
+        profiler._finished.wait(5)
+        os.remove(self.getReports()[0])
+
+        # The stop cuts the second profile short but waits for its report.
+        profiler._duration = 60.0
+        profiler.request()
+        while not profiler.isProfiling():
+            time.sleep(0.01)
+        profiler.stop()
+        self.assertEqual(len(self.getReports()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+RECORD_PLUGIN = """
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', record, %r)
+
+    def record(sg, event, path):
+        open(path, 'a').write('%%d\\n' %% event['id'])
+"""
+
+
+class ReplayTest(shotgunFake.DaemonTestCase):
+    def setUp(self):
+        shotgunFake.DaemonTestCase.setUp(self)
+        shotgunFake.EVENTS.extend(shotgunFake.makeEvents(1, 100))
+        self.writePlugin('record', RECORD_PLUGIN % os.path.join(self.tempDir, 'replayed'))
+        self.configPath = self.writeConfig()
+
+    def replay(self, *args):
+        return daemon.replay(['--config', self.configPath, '--workers', '2', '--chunk-size', '10'] + list(args))
+
+    def getStateDir(self):
+        stateDirs = [b for b in os.listdir(self.tempDir) if b.startswith('id.replay-')]
+        self.assertEqual(len(stateDirs), 1)
+        return os.path.join(self.tempDir, stateDirs[0])
+
+    def testReplay(self):
+        self.assertEqual(self.replay('--from-id', '1', '--to-id', '100'), 0)
+        self.assertEqual(sorted(self.readIds('replayed')), range(1, 101))
+
+    def testResumeRunsChunksThatNeverStarted(self):
+        # An interrupted replay where only the first chunk had started.
+        self.assertEqual(self.replay('--from-id', '1', '--to-id', '100'), 0)
+        stateDir = self.getStateDir()
+        for basename in os.listdir(stateDir):
+            if basename.startswith('chunk-') and basename != 'chunk-1-10':
+                os.remove(os.path.join(stateDir, basename))
+        os.remove(os.path.join(self.tempDir, 'replayed'))
+
+        self.assertEqual(self.replay('--from-id', '1', '--to-id', '100'), 0)
+        self.assertEqual(sorted(self.readIds('replayed')), range(11, 101))
+
+    def testResumeWithoutEnd(self):
+        self.assertEqual(self.replay('--from-id', '51'), 0)
+        self.assertEqual(sorted(self.readIds('replayed')), range(51, 101))
+
+        # The same replay run again once new events came in resumes in the
+        # same state directory and keeps the range it was started with.
+        shotgunFake.EVENTS.extend(shotgunFake.makeEvents(101, 120))
+        os.remove(os.path.join(self.tempDir, 'replayed'))
+        self.assertEqual(self.replay('--from-id', '51'), 0)
+        self.getStateDir()
+        self.assertEqual(self.readIds('replayed'), [])
+
+    def testStateWithoutManifest(self):
+        stateDir = os.path.join(self.tempDir, 'state')
+        os.mkdir(stateDir)
+        open(os.path.join(stateDir, 'chunk-1-10'), 'w').write('10')
+        self.assertEqual(self.replay('--from-id', '1', '--to-id', '100', '--state-dir', stateDir), 1)
+        self.assertEqual(self.readIds('replayed'), [])
+
+    def testShardJournal(self):
+        # The events are only in the journal of the second shard.
+        journalPath = os.path.join(self.tempDir, 'journal')
+        journal = daemon.EventJournal(journalPath + '.shard1')
+        journal.append(0, shotgunFake.makeEvents(1, 30))
+        journal.close()
+        shotgunFake.EVENTS[:] = []
+        self.configPath = self.writeConfig({'journal': {'path': journalPath}, 'shards': {'count': '2'}})
+
+        self.assertEqual(self.replay('--from-id', '1', '--to-id', '30'), 0)
+        self.assertEqual(sorted(self.readIds('replayed')), range(1, 31))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import signal
+import unittest
+
+import shotgunFake
+from shotgunFake import daemon
+
+
+# The plugin split puts this module in shard 0 of 2.
+STOP_PLUGIN = """
+    import glob, os
+
+    def registerCallbacks(reg):
+        reg.registerCallback('name', 'key', stop, %r)
+
+    def stop(sg, event, tempDir):
+        open(os.path.join(tempDir, 'processed'), 'a').write('%%d\\n' %% event['id'])
+        if event['id'] == 20:
+            for path in glob.glob(os.path.join(tempDir, 'pid*')):
+                os.remove(path)
+"""
+
+
+class ShardTest(shotgunFake.DaemonTestCase):
+    def setUp(self):
+        shotgunFake.DaemonTestCase.setUp(self)
+        shotgunFake.EVENTS.extend(shotgunFake.makeEvents(1, 20))
+        self.writePlugin('stop', STOP_PLUGIN % self.tempDir)
+        self.config = daemon.Config(self.writeConfig({'shards': {'count': '2', 'lockDir': self.tempDir}}))
+        open(os.path.join(self.tempDir, 'id.shard0'), 'w').write('0\n')
+
+    def killedInstance(self, shardId):
+        # Runs the shard in a child process that dies without cleaning up.
+        pid = os.fork()
+        if pid == 0:
+            shardLock = daemon.ShardLock(self.tempDir, 2)
+            shardLock.tryAcquire(shardId)
+            open(os.path.join(self.tempDir, 'pid.shard%d' % shardId), 'w').write('%d\n' % os.getpid())
+            os.kill(os.getpid(), signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    def testTakeOver(self):
+        self.killedInstance(0)
+        self.assertTrue(os.path.exists(os.path.join(self.tempDir, 'pid.shard0')))
+
+        shardLock = daemon.ShardLock(self.tempDir, 2)
+        self.assertEqual(shardLock.acquire(0, 0.1), 0)
+        try:
+            daemon.Engine(self.config, 0).start()
+        finally:
+            shardLock.release()
+        self.assertEqual(self.readIds('processed'), range(1, 21))
+
+    def testStopWaiting(self):
+        # Locks are held per process so the shards are held by a child.
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            shardLocks = [daemon.ShardLock(self.tempDir, 2) for i in range(2)]
+            for shardId, shardLock in enumerate(shardLocks):
+                shardLock.tryAcquire(shardId)
+            os.write(writeFd, 'x')
+            signal.pause()
+            os._exit(0)
+        try:
+            os.read(readFd, 1)
+            calls = []
+            def checkContinue():
+                calls.append(None)
+                return len(calls) < 3
+            self.assertEqual(daemon.ShardLock(self.tempDir, 2).acquire(None, 0.01, checkContinue), None)
+            self.assertEqual(len(calls), 3)
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()